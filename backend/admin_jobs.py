@@ -0,0 +1,332 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Firestore's guidance for new write traffic: start at 500 operations per second
+DEFAULT_OPS_PER_SECOND = 500.0
+
+# Times serve() resumes a job on its own before leaving it to an admin
+MAX_AUTO_RESUMES = 5
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once cancellation has been requested"""
+
+
+class Job:
+    """A running admin job as its function sees it.
+
+    `progress` is whatever the job last checkpointed (empty on a fresh start,
+    the saved progress when resuming). Job functions call throttle(n) before
+    issuing n database operations and checkpoint(progress) whenever their
+    progress is safe to persist; checkpoint() is also where a cancellation
+    requested from any worker is noticed.
+    """
+
+    def __init__(self, runner, job_id, progress, ops_per_second):
+        self.runner = runner
+        self.id = job_id
+        self.progress = progress
+        self.ops_per_second = ops_per_second
+        self._cancel = threading.Event()
+        self._next_slot = time.monotonic()
+
+    def throttle(self, ops=1):
+        """Sleep as needed to stay under ops_per_second"""
+        if not self.ops_per_second:
+            return
+        now = time.monotonic()
+        self._next_slot = max(self._next_slot, now)
+        wait = self._next_slot - now
+        self._next_slot += ops / self.ops_per_second
+        if wait > 0 and self._cancel.wait(wait):
+            raise JobCancelled()
+
+    def checkpoint(self, progress):
+        """Persist progress. Raises JobCancelled if the job has been asked to stop"""
+        self.progress = progress
+        self.runner._save(self.id, {'progress': progress, 'heartbeat_at': time.time()})
+        self.runner._heartbeat_queued()
+        state = self.runner.storage.load_job_state(self.id) or {}
+        if self._cancel.is_set() or state.get('cancel_requested'):
+            self._cancel.set()
+            raise JobCancelled()
+
+
+class JobRunner:
+    """Runs long admin operations on a small thread pool, off the request path.
+
+    Job state is persisted through the storage backend (admin_jobs/{id} on
+    Firestore), so status, progress and results can be read from any worker and
+    survive restarts. A job whose heartbeat is older than `stale_after` seconds
+    while it claims to be running belongs to a dead process and is reported as
+    'interrupted'; resume() restarts it from its last checkpoint, as it does
+    for failed and cancelled jobs.
+
+    Job types are registered with a function fn(job, params) -> result dict,
+    which must checkpoint at least every `stale_after` seconds. Types
+    registered with single=True run at most one job at a time.
+
+    With execute=False the runner only records jobs as queued, and a runner
+    in another process picks them up from serve(). Under gunicorn that is the
+    RunnerProcess the master starts, so a job outlives the request workers
+    that max_requests keeps recycling, and interrupted jobs are resumed from
+    their checkpoint without anyone asking.
+    """
+
+    def __init__(self, storage, max_workers=1, ops_per_second=DEFAULT_OPS_PER_SECOND, stale_after=120.0,
+                 execute=True):
+        self.storage = storage
+        self.max_workers = max_workers
+        self.ops_per_second = ops_per_second
+        self.stale_after = stale_after
+        self.execute = execute
+        self.job_types = {}
+        self._lock = threading.Lock()
+        self._running = {}  # job id -> Job, in this process
+        self._queued = set()  # job ids waiting for a pool thread in this process
+        self._executor = None
+        self._pid = None
+
+    def register(self, job_type, fn, single=False):
+        self.job_types[job_type] = (fn, single)
+
+    def _pool(self):
+        # Created on first use in each process; a pool must not cross a fork
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='admin-job')
+            self._pid = os.getpid()
+            self._running = {}
+            self._queued = set()
+        return self._executor
+
+    def _enqueue(self, job_id):
+        if not self.execute:
+            # Left queued for the process running serve()
+            return
+        self._queued.add(job_id)
+        self._pool().submit(self._execute, job_id)
+
+    def _heartbeat_queued(self):
+        # Jobs waiting behind a running one are alive too, not interrupted
+        for job_id in list(self._queued):
+            self._save(job_id, {'heartbeat_at': time.time()})
+
+    def _save(self, job_id, changes):
+        self.storage.save_job_state(job_id, changes)
+
+    def _active(self, state):
+        return state.get('status') in ('queued', 'running') and \
+            time.time() - state.get('heartbeat_at', 0) < self.stale_after
+
+    def _as_seen(self, state):
+        # Queued or running according to a process that stopped heartbeating
+        if state is not None and state.get('status') in ('queued', 'running') and not self._active(state):
+            return {**state, 'status': 'interrupted'}
+        return state
+
+    # Client side
+    def get(self, job_id):
+        """The job's state, or None. Running jobs with a dead owner show as 'interrupted'"""
+        return self._as_seen(self.storage.load_job_state(job_id))
+
+    def list(self, limit=20, job_type=None):
+        """Most recent jobs first"""
+        states = [self._as_seen(state) for state in self.storage.list_job_states(limit)]
+        return [state for state in states if job_type is None or state.get('type') == job_type]
+
+    def submit(self, job_type, params=None, ops_per_second=None):
+        """Queue a new job. Returns (state, created); created is False if a single-instance
+        job of this type is already active and its state is returned instead"""
+        if job_type not in self.job_types:
+            raise ValueError(f"Unknown job type: {job_type}")
+        _, single = self.job_types[job_type]
+        with self._lock:
+            if single:
+                for state in self.list(job_type=job_type):
+                    if self._active(state):
+                        return state, False
+
+            now = time.time()
+            state = {
+                'id': uuid.uuid4().hex,
+                'type': job_type,
+                'params': params or {},
+                'ops_per_second': self.ops_per_second if ops_per_second is None else ops_per_second,
+                'status': 'queued',
+                'created_at': now,
+                'heartbeat_at': now,
+                'progress': {},
+                'result': None,
+                'error': None,
+                'cancel_requested': False,
+            }
+            self._save(state['id'], state)
+            self._enqueue(state['id'])
+            return state, True
+
+    def resume(self, job_id):
+        """Restart an interrupted, failed or cancelled job from its last checkpoint"""
+        with self._lock:
+            state = self.get(job_id)
+            if state is None or state['status'] not in ('interrupted', 'failed', 'cancelled'):
+                return state, False
+            changes = {'status': 'queued', 'heartbeat_at': time.time(), 'error': None, 'cancel_requested': False}
+            self._save(job_id, changes)
+            self._enqueue(job_id)
+            return {**state, **changes}, True
+
+    def cancel(self, job_id):
+        """Ask a job to stop at its next checkpoint, in whichever process runs it"""
+        state = self.get(job_id)
+        if state is None or state['status'] not in ('queued', 'running'):
+            return state
+        self._save(job_id, {'cancel_requested': True})
+        job = self._running.get(job_id)
+        if job is not None:
+            job._cancel.set()
+        return {**state, 'cancel_requested': True}
+
+    # Worker side
+    def serve(self, poll_interval=2.0, stop=None):
+        """Run jobs queued by any process, and resume interrupted ones, until `stop` is set"""
+        stop = stop or threading.Event()
+        while not stop.wait(poll_interval):
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"Admin job poll failed: {e}")
+
+    def poll_once(self):
+        """Pick up queued jobs and resume interrupted ones. Returns the ids started"""
+        self._pool()
+        started = []
+        for state in self.storage.list_active_job_states():
+            job_id = state['id']
+            if job_id in self._running or job_id in self._queued or state.get('type') not in self.job_types:
+                continue
+            if self._active(state) and not self._owner_gone(state):
+                if state['status'] == 'queued':
+                    self._save(job_id, {'heartbeat_at': time.time()})
+                    self._enqueue(job_id)
+                    started.append(job_id)
+                continue
+
+            # Its process died mid-job (a restart, a deploy): carry on from the checkpoint
+            resumes = state.get('auto_resumes', 0)
+            if resumes >= MAX_AUTO_RESUMES:
+                continue
+            print(f"Resuming interrupted admin job {state['type']} {job_id}")
+            self._save(job_id, {'auto_resumes': resumes + 1, 'heartbeat_at': 0})
+            _, resumed = self.resume(job_id)
+            if resumed:
+                started.append(job_id)
+        return started
+
+    def _owner_gone(self, state):
+        # A running job owned by a process of this host that no longer exists need not
+        # wait out stale_after to be resumed
+        host, _, pid = (state.get('owner') or '').rpartition(':')
+        if state.get('status') != 'running' or host != socket.gethostname() or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def release(self):
+        """Mark this process's jobs as interrupted so the next serve() resumes them at once"""
+        for job_id in list(self._running) + list(self._queued):
+            self._save(job_id, {'heartbeat_at': 0})
+
+    def _execute(self, job_id):
+        self._queued.discard(job_id)
+        state = self.storage.load_job_state(job_id)
+        if state.get('cancel_requested'):
+            self._save(job_id, {'status': 'cancelled', 'finished_at': time.time()})
+            return
+
+        fn, _ = self.job_types[state['type']]
+        job = self._running[job_id] = Job(self, job_id, state.get('progress') or {}, state.get('ops_per_second'))
+        self._save(job_id, {
+            'status': 'running',
+            'started_at': state.get('started_at') or time.time(),
+            'heartbeat_at': time.time(),
+            'owner': f"{socket.gethostname()}:{os.getpid()}",
+        })
+        try:
+            result = fn(job, state.get('params') or {})
+            changes = {'status': 'done', 'result': result}
+        except JobCancelled:
+            changes = {'status': 'cancelled'}
+        except Exception as e:
+            print(f"Admin job {state['type']} {job_id} failed: {e}")
+            changes = {'status': 'failed', 'error': str(e)}
+        finally:
+            self._running.pop(job_id, None)
+        self._save(job_id, {**changes, 'progress': job.progress, 'finished_at': time.time(), 'heartbeat_at': time.time()})
+
+
+class RunnerProcess:
+    """The job runner as a child of the gunicorn master
+
+    Like the UID index publisher it runs in a fresh interpreter, importing
+    the app for its job types and storage, and is restarted by the master if
+    it exits.
+    """
+
+    def __init__(self):
+        self._proc = None
+
+    def ensure_running(self):
+        """Start the runner, or restart it if it has exited"""
+        if self._proc is not None:
+            code = self._proc.poll()
+            if code is None:
+                return
+            print(f"Admin job runner exited with {code}, restarting")
+        self._proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)])
+
+    def stop(self, timeout=10.0):
+        if self._proc is None or self._proc.poll() is not None:
+            return
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+
+
+def main():
+    import app
+
+    app.wait_for_libraries()
+    app.storage.connect()
+    if not app.storage.connected:
+        # The master retries us later; jobs stay queued meanwhile
+        print("Admin job runner could not connect to storage")
+        sys.exit(1)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    runner = app.job_runner
+    runner.execute = True
+    runner.serve(poll_interval=float(os.environ.get('ADMIN_JOB_POLL_INTERVAL', 2)), stop=stop)
+
+    # Running jobs are abandoned, not cancelled: the next runner resumes them
+    runner.release()
+    app.flush_pending_writes()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
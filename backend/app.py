@@ -1,139 +1,289 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore
 from datetime import datetime
 import pytz
+import base64
+import csv
+import hashlib
+import io
+import itertools
+import json
 import os
+import re
+import threading
+import time
+
+from admin_jobs import DEFAULT_OPS_PER_SECOND, JobRunner
+import firestore_trace
+from group_commit import GroupCommitter
+import metrics
+from periods import GRANULARITIES, aggregate, choose_granularity, period_bounds, periods_between
+from registration_feed import RegistrationFeed
+from scan_journal import ScanJournal
+from summary_cache import SummaryCache
+import user_import
+from user_import import REGISTRATION_FIELDS, registration_status, registration_user
+from warm_snapshot import WarmSnapshot
+from storage import DUPLICATE_ERROR, create_storage
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Global db variable declaration
-db = None
+# Storage backend (Firestore unless STORAGE_BACKEND says otherwise)
+storage = create_storage()
+
+# The Firebase SDK imports on a background thread so a cold start can bind its port
+# meanwhile; wait_for_libraries() must return before forking or connecting
+_library_loader = threading.Thread(target=storage.load_libraries, name='load-libraries', daemon=True)
+_library_loader.start()
+
+def wait_for_libraries():
+    _library_loader.join()
+
+# Firestore RPC latency histogram (only fed when the Firestore backend traces)
+firestore_trace.observers.append(metrics.observe_firestore)
+
+def _route_label():
+    # The URL rule, not the path, so IDs and dates don't become label values
+    return request.url_rule.rule if request.url_rule else 'unmatched'
 
-# Firebase initialization with better error handling
-try:
-    # Check if we have Firebase service account credentials
-    firebase_config_path = os.environ.get('FIREBASE_CONFIG_PATH', 'firebase_config.json')
+@app.before_request
+def start_storage_accounting():
+    storage.begin_request()
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.metrics_route = _route_label()
+    metrics.IN_FLIGHT.labels(request.method, g.metrics_route).inc()
+
+@app.after_request
+def report_storage_ops(response):
+    """Expose the storage round trips a request made, plus its Firestore trace"""
+    ops = storage.request_ops()
+    if ops is not None:
+        response.headers['X-Storage-Ops'] = str(ops)
     
-    if os.path.exists(firebase_config_path):
-        # Use service account file
-        cred = credentials.Certificate(firebase_config_path)
-    else:
-        # Try to use environment variables for production
-        import json
-        firebase_config = {
-            "type": "service_account",
-            "project_id": os.environ.get('FIREBASE_PROJECT_ID'),
-            "private_key_id": os.environ.get('FIREBASE_PRIVATE_KEY_ID'),
-            "private_key": os.environ.get('FIREBASE_PRIVATE_KEY', '').replace('\\n', '\n'),
-            "client_email": os.environ.get('FIREBASE_CLIENT_EMAIL'),
-            "client_id": os.environ.get('FIREBASE_CLIENT_ID'),
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-            "client_x509_cert_url": os.environ.get('FIREBASE_CLIENT_X509_CERT_URL')
-        }
-        
-        # Check if all required env vars are present
-        if not all([firebase_config[key] for key in ['project_id', 'private_key', 'client_email']]):
-            raise ValueError("Missing required Firebase environment variables")
-        
-        cred = credentials.Certificate(firebase_config)
+    route = request.url_rule.rule if request.url_rule else request.path
+    trace = storage.end_request(f"{request.method} {route}")
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request and its latency, and the scan outcome for reader posts"""
+    started = g.get('metrics_started')
+    if started is None:
+        return response
     
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Firebase connection established successfully")
-except Exception as e:
-    print(f"CRITICAL ERROR initializing Firebase: {e}")
-    # Don't exit - we'll check for db before using it
+    elapsed = time.perf_counter() - started
+    status = str(response.status_code)
+    metrics.REQUESTS.labels(request.method, g.metrics_route, status).inc()
+    metrics.REQUEST_LATENCY.labels(request.method, g.metrics_route, status).observe(elapsed)
+    if 'scan_outcome' in g:
+        metrics.observe_scan(g.scan_device, g.scan_outcome, elapsed)
+    return response
 
-# Validate Firebase connection
-if db is None:
-    print("WARNING: Firebase database not initialized. Check your credentials.")
+@app.teardown_request
+def finish_request_metrics(exc):
+    if 'metrics_route' in g:
+        metrics.IN_FLIGHT.labels(request.method, g.metrics_route).dec()
+
+# Device clocks may drift a little ahead of ours, but not by this much
+MAX_CLOCK_SKEW_SECONDS = 300
+
+# How long a reader may hold scans offline; anything older is not a real backlog
+MAX_BACKFILL_SECONDS = float(os.environ.get('MAX_BACKFILL_SECONDS', 7 * 24 * 3600))
+
+# Per-day dashboard counts, shared by the workers through a local SQLite file
+summary_cache = None
+if os.environ.get('SUMMARY_CACHE_ENABLED', '1') != '0':
+    summary_cache = SummaryCache(
+        os.environ.get('SUMMARY_CACHE_PATH', 'summary_cache.db'),
+        max_entries=int(os.environ.get('SUMMARY_CACHE_MAX_ENTRIES', 4096)),
+        open_ttl=float(os.environ.get('SUMMARY_CACHE_TTL', 30)),
+        close_grace=float(os.environ.get('SUMMARY_CACHE_CLOSE_GRACE', 3600))
+    )
+
+def _forget_closed_days(records):
+    """Drop cached summaries of past days that just gained attendance records"""
+    if summary_cache is None:
+        return
+    today = datetime.now(pytz.UTC).strftime("%Y-%m-%d")
+    dates = {record['date'] for record in records if record and record['date'] < today}
+    if dates:
+        summary_cache.invalidate(sorted(dates))
+
+# Cards registered through /api/registration, announced to every worker at once
+registration_feed = None
+if os.environ.get('REGISTRATION_FEED_ENABLED', '1') != '0':
+    registration_feed = RegistrationFeed(
+        os.environ.get('REGISTRATION_FEED_PATH', 'registration_feed.db'),
+        retention=float(os.environ.get('REGISTRATION_FEED_RETENTION', 600))
+    )
+
+def catch_up_registrations():
+    """Hand registrations other workers announced to this worker's UID cache. Returns whether there were any"""
+    if registration_feed is None:
+        return False
+    users = registration_feed.poll()
+    if users:
+        storage.remember_users(users)
+    return bool(users)
 
 # Database helper functions
 def get_user_by_uid(nfc_uid):
     """Find a user with NFC UID from registration collection"""
-    if db is None:
+    if not storage.connected:
         print("ERROR: Database not initialized")
         return None
         
     try:
-        registration_ref = db.collection('registration')
-        query = registration_ref.where('nfc_uid', '==', nfc_uid).limit(1)
-        results = query.get()
-        
-        for user in results:
-            return {**user.to_dict(), 'id': user.id}
-        return None
+        user = storage.get_user_by_uid(nfc_uid)
+        if user is None and catch_up_registrations():
+            # Possibly registered a moment ago, by another worker
+            user = storage.get_user_by_uid(nfc_uid)
+        return user
     except Exception as e:
         print(f"Error querying user: {e}")
         return None
 
+def _write_scan_group(scans):
+    """Group commit callback: a lone scan is written as before, several with one commit"""
+    if len(scans) == 1:
+        scan = scans[0]
+        return [storage.record_attendance(scan['user'], scan['nfc_uid'], scan['device_id'], scan['timestamp'])]
+    return storage.record_attendance_group(scans)
+
+# GROUP_COMMIT=1 lets the concurrent scan requests of a threaded worker
+# (GUNICORN_THREADS > 1) share commits; each still waits for its own result
+group_committer = None
+if os.environ.get('GROUP_COMMIT', '0') == '1':
+    group_committer = GroupCommitter(
+        _write_scan_group,
+        window=float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 10)) / 1000,
+        max_batch=int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 100)),
+        on_flush=metrics.observe_group_commit
+    )
+
 def record_attendance(user_id, nfc_uid, name, department, device_id="unknown"):
     """Record an attendance event using date-based subcollections without departments tracking"""
-    if db is None:
+    if not storage.connected:
         print("ERROR: Database not initialized")
         return None, "Database connection error"
-        
-    try:
-        now = datetime.now(pytz.UTC)
-        today = now.strftime("%Y-%m-%d")
-        
-        # Reference to today's attendance document
-        date_doc_ref = db.collection('attendance').document(today)
-        
-        # Create the date document if it doesn't exist, but without departments
-        date_doc = date_doc_ref.get()
-        if not date_doc.exists:
-            date_doc_ref.set({
-                'date': today,
-                'count': 0
-                # Removed departments field completely
-            })
-        
-        # Check if user already has attendance record for today
-        records_ref = date_doc_ref.collection('records')
-        query = records_ref.where('user_id', '==', user_id).get()
-        
-        if len(query) > 0:
-            return None, "Attendance already recorded for today"
-        
-        # Create new attendance record
-        attendance_data = {
-            'user_id': user_id,
+    
+    user = {'id': user_id, 'name': name, 'department': department}
+    if group_committer is not None:
+        attendance, error = group_committer.submit({
+            'user': user,
             'nfc_uid': nfc_uid,
-            'name': name,
-            'department': department,
-            'timestamp': now,
-            'date': today,
-            'action': 'check_in',
-            'device_id': device_id
-        }
-        
-        # Add to the subcollection
-        record_ref = records_ref.document()
-        record_ref.set(attendance_data)
-        
-        # Update only the count, not departments
-        date_doc_ref.update({
-            'count': firestore.Increment(1)
-            # Removed the departments update
+            'device_id': device_id,
+            'timestamp': datetime.now(pytz.UTC)
         })
-        
-        # Update user's status in registration
-        db.collection('registration').document(user_id).update({
-            'status': 'present',
-            'timestamp': now
-        })
-        
-        return {**attendance_data, 'id': record_ref.id}, None
-    except Exception as e:
-        print(f"Error in record_attendance: {e}")
-        return None, f"Database error: {str(e)}"
+    else:
+        attendance, error = storage.record_attendance(user, nfc_uid, device_id)
+    _forget_closed_days([attendance])
+    return attendance, error
+
+def flush_journaled_scans(scans):
+    """Journal flusher callback: write queued scans and report each one's fate"""
+    for scan in scans:
+        scan['timestamp'] = datetime.fromisoformat(scan['timestamp'])
+        scan['received_at'] = datetime.fromisoformat(scan['received_at'])
+    
+    outcomes = storage.record_attendance_batch(scans)
+    _forget_closed_days([attendance for attendance, _ in outcomes])
+    
+    statuses = []
+    for attendance, error in outcomes:
+        if attendance:
+            statuses.append('committed')
+        elif error == DUPLICATE_ERROR:
+            statuses.append('duplicate')
+        else:
+            statuses.append('retry')
+    return statuses
+
+# INGEST_MODE=journal acknowledges scans once they are in the local journal
+# (its flusher thread is started per worker by init_worker)
+scan_journal = None
+if os.environ.get('INGEST_MODE', 'direct') == 'journal':
+    scan_journal = ScanJournal(
+        os.environ.get('SCAN_JOURNAL_PATH', 'scan_journal.db'),
+        flush_journaled_scans,
+        batch_size=int(os.environ.get('SCAN_JOURNAL_BATCH_SIZE', 200)),
+        max_attempts=int(os.environ.get('SCAN_JOURNAL_MAX_ATTEMPTS', 50))
+    )
+
+# Process-local caches (the UID index, today's check-ins) saved for the next worker
+warm_snapshot = None
+if os.environ.get('WARM_SNAPSHOT_ENABLED', '1') != '0':
+    warm_snapshot = WarmSnapshot(
+        storage,
+        os.environ.get('WARM_SNAPSHOT_PATH', 'warm_snapshot.msgpack'),
+        interval=float(os.environ.get('WARM_SNAPSHOT_INTERVAL', 60)),
+        max_age=float(os.environ.get('WARM_SNAPSHOT_MAX_AGE', 86400))
+    )
+
+def save_warm_snapshot():
+    """Save this worker's caches now, e.g. as it exits"""
+    if warm_snapshot is not None and storage.connected:
+        warm_snapshot.save()
+
+def flush_pending_writes():
+    """Write the status updates this worker is still holding, e.g. as it exits"""
+    if storage.connected:
+        storage.flush_pending()
+
+# Scans parsed from a batch body before resolving and writing them
+BATCH_CHUNK_SIZE = 1000
+
+def _parse_timestamp(ts):
+    """Epoch seconds or ISO 8601 (naive means UTC) as an aware UTC datetime; raises ValueError"""
+    try:
+        if isinstance(ts, str):
+            try:
+                ts = float(ts)
+            except ValueError:
+                pass
+        if isinstance(ts, (int, float)):
+            return datetime.fromtimestamp(ts, pytz.UTC)
+        timestamp = datetime.fromisoformat(str(ts).replace('Z', '+00:00'))
+    except (OverflowError, OSError) as e:
+        raise ValueError(str(e))
+    if timestamp.tzinfo is None:
+        timestamp = pytz.UTC.localize(timestamp)
+    return timestamp.astimezone(pytz.UTC)
+
+def _parse_batch_line(raw, default_device, received_at):
+    """Turn one NDJSON line into a scan dict, or return an error message"""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None, "Malformed JSON"
+    if not isinstance(data, dict) or not data.get('uid'):
+        return None, "Missing NFC UID"
+    
+    ts = data.get('timestamp')
+    try:
+        timestamp = received_at if ts is None else _parse_timestamp(ts)
+    except ValueError:
+        return None, "Invalid timestamp"
+    
+    age = (received_at - timestamp).total_seconds()
+    if -age > MAX_CLOCK_SKEW_SECONDS:
+        return None, "Timestamp is in the future"
+    if age > MAX_BACKFILL_SECONDS:
+        return None, "Timestamp is older than the offline backfill window"
+    
+    return {
+        'nfc_uid': data['uid'],
+        'device_id': data.get('device_id', default_device),
+        'timestamp': timestamp,
+        'received_at': received_at
+    }, None
 
 # Routes
 @app.route("/")
@@ -141,22 +291,31 @@ def index():
     return jsonify({
         "status": "online",
         "message": "NFC Attendance API is operational",
-        "firebase": "connected" if db else "disconnected",
+        "firebase": "connected" if storage.connected else "disconnected",
+        "storage": storage.name,
         "timestamp": datetime.now(pytz.UTC).strftime("%Y-%m-%d %H:%M:%S")
     })
 
+@app.route("/ready")
+def ready():
+    """Readiness probe: 503 until this worker has connected to storage and warmed up"""
+    return jsonify({**readiness, "pid": os.getpid()}), 200 if readiness['ready'] else 503
+
 @app.route("/api/attendance", methods=["POST"])
 def process_attendance():
     """Process attendance from ESP32"""
     try:
         # Check database connection first
-        if db is None:
+        if not storage.connected:
             return jsonify({"error": "Database not connected"}), 500
             
         data = request.get_json()
+        g.scan_device = data.get('device_id', 'unknown') if isinstance(data, dict) else 'unknown'
+        g.scan_outcome = 'error'
         
         # Validate required fields
         if 'uid' not in data:
+            g.scan_outcome = 'invalid'
             return jsonify({"error": "Missing NFC UID"}), 400
             
         nfc_uid = data['uid']
@@ -165,12 +324,39 @@ def process_attendance():
         # Find user by UID
         user = get_user_by_uid(nfc_uid)
         if not user:
+            g.scan_outcome = 'unknown_card'
             return jsonify({
                 "error": "User not found", 
                 "uid": nfc_uid,
                 "timestamp": datetime.now(pytz.UTC).strftime("%Y-%m-%d %H:%M:%S")
             }), 404
         
+        # Write-behind mode: journal locally and acknowledge before Firestore sees it
+        if scan_journal is not None:
+            now = datetime.now(pytz.UTC)
+            queued = scan_journal.append(now.strftime("%Y-%m-%d"), user['id'], {
+                'user': {
+                    'id': user['id'],
+                    'name': user['name'],
+                    'department': user.get('department', 'Unknown')
+                },
+                'nfc_uid': nfc_uid,
+                'device_id': device_id,
+                'timestamp': now.isoformat(),
+                'received_at': now.isoformat()
+            })
+            if not queued:
+                g.scan_outcome = 'duplicate'
+                return jsonify({"error": DUPLICATE_ERROR}), 400
+            
+            g.scan_outcome = 'accepted'
+            return jsonify({
+                "status": "accepted",
+                "message": "Attendance queued",
+                "user": user['name'],
+                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S")
+            }), 202
+        
         # Record attendance
         attendance, error = record_attendance(
             user_id=user['id'],
@@ -181,8 +367,10 @@ def process_attendance():
         )
         
         if error:
+            g.scan_outcome = 'duplicate' if error == DUPLICATE_ERROR else 'error'
             return jsonify({"error": error}), 400
             
+        g.scan_outcome = 'accepted'
         return jsonify({
             "status": "success",
             "message": "Attendance recorded successfully",
@@ -194,130 +382,500 @@ def process_attendance():
         print(f"Error recording attendance: {e}")
         return jsonify({"error": "Attendance recording failed"}), 500
 
+@app.route("/api/attendance/batch", methods=["POST"])
+def process_attendance_batch():
+    """Ingest buffered scans from a reader as an NDJSON stream
+
+    Each line is {"uid": ..., "device_id": ..., "timestamp": ...} where the
+    timestamp is the device-side scan time, either epoch seconds or ISO 8601
+    (server time is used if it is missing). Lines timestamped more than
+    MAX_BACKFILL_SECONDS ago are rejected as invalid. The body is read line by
+    line and written in chunks, so a reader flushing thousands of queued scans
+    costs a handful of commits rather than thousands of requests.
+    """
+    try:
+        if not storage.connected:
+            return jsonify({"error": "Database not connected"}), 500
+        
+        default_device = request.args.get('device_id', 'unknown')
+        results = []
+        pending = []
+        devices = {}  # line -> device_id, for per-reader scan metrics
+        
+        def process(pending):
+            users = storage.get_users_by_uids([scan['nfc_uid'] for _, scan in pending])
+            unknown = [scan['nfc_uid'] for _, scan in pending if scan['nfc_uid'] not in users]
+            if unknown and catch_up_registrations():
+                users.update(storage.get_users_by_uids(unknown))
+            
+            accepted = []
+            for line_no, scan in pending:
+                user = users.get(scan['nfc_uid'])
+                if not user:
+                    results.append({"line": line_no, "status": "unknown_card", "uid": scan['nfc_uid']})
+                else:
+                    accepted.append((line_no, {**scan, 'user': user}))
+            
+            outcomes = storage.record_attendance_batch([scan for _, scan in accepted])
+            _forget_closed_days([attendance for attendance, _ in outcomes])
+            for (line_no, scan), (attendance, error) in zip(accepted, outcomes):
+                if attendance:
+                    results.append({"line": line_no, "status": "accepted", "user": scan['user']['name']})
+                elif error == DUPLICATE_ERROR:
+                    results.append({"line": line_no, "status": "duplicate", "uid": scan['nfc_uid']})
+                else:
+                    results.append({"line": line_no, "status": "error", "error": error})
+        
+        received_at = datetime.now(pytz.UTC)
+        line_no = 0
+        for raw in request.stream:
+            line_no += 1
+            raw = raw.strip()
+            if not raw:
+                continue
+            
+            scan, error = _parse_batch_line(raw, default_device, received_at)
+            if error:
+                results.append({"line": line_no, "status": "invalid", "error": error})
+                continue
+            
+            devices[line_no] = scan['device_id']
+            pending.append((line_no, scan))
+            if len(pending) >= BATCH_CHUNK_SIZE:
+                process(pending)
+                pending = []
+        
+        if pending:
+            process(pending)
+        
+        results.sort(key=lambda r: r['line'])
+        summary = {}
+        for result in results:
+            summary[result['status']] = summary.get(result['status'], 0) + 1
+            metrics.observe_scan(devices.get(result['line'], default_device), result['status'])
+        
+        return jsonify({
+            "status": "success",
+            "lines": line_no,
+            "summary": summary,
+            "results": results,
+            "timestamp": received_at.strftime("%Y-%m-%d %H:%M:%S")
+        }), 200
+        
+    except Exception as e:
+        print(f"Error recording attendance batch: {e}")
+        return jsonify({"error": "Batch attendance recording failed"}), 500
+
+def register_users(users):
+    """Write registrations and their UID index entries, then make the new cards
+    resolvable in every worker. Returns a (user, error) per user"""
+    results = storage.add_users(users)
+    registered = [user for user, error in results if user]
+    storage.remember_users(registered)
+    if registration_feed is not None:
+        registration_feed.publish(registered)
+    return results
+
+def _registered(user):
+    return {'id': user['id'], 'name': user['name'], 'department': user['department'], 'nfc_uid': user['nfc_uid']}
+
+@app.route("/api/registration", methods=["POST"])
+def register_user():
+    """Register one card: {"name", "nfc_uid", "email", "department"}, plus "id" to re-register a user
+    
+    The UID is stored in normalized form. A card already registered to
+    someone else is refused with 409. The card is accepted by every worker
+    from its first tap, without waiting for the registration listener.
+    """
+    try:
+        if not storage.connected:
+            return jsonify({"error": "Database not connected"}), 500
+        
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Expected a JSON object"}), 400
+        
+        user, error = registration_user(data, datetime.now(pytz.UTC))
+        if error:
+            return jsonify({"error": error}), 400
+        
+        (user, error), = register_users([user])
+        if error:
+            status = registration_status(error)
+            return jsonify({"error": error}), 409 if status == 'duplicate' else 400 if status == 'invalid' else 500
+        
+        return jsonify({
+            "status": "success",
+            "message": "Registration successful",
+            "user": _registered(user)
+        }), 201
+        
+    except Exception as e:
+        print(f"Registration error: {e}")
+        return jsonify({"error": "Registration failed"}), 500
+
+@app.route("/api/registration/bulk", methods=["POST"])
+def register_users_bulk():
+    """Register many cards from a CSV body
+    
+    The header row names the columns: name and nfc_uid are required, email,
+    department and id optional. Rows are validated one by one and written in
+    chunks; the response reports each row by its line number. Files of more
+    than a few thousand rows belong in a background import (/admin/imports).
+    """
+    try:
+        if not storage.connected:
+            return jsonify({"error": "Database not connected"}), 500
+        
+        reader = csv.DictReader(io.StringIO(request.get_data(as_text=True)))
+        columns = {(name or '').strip() for name in reader.fieldnames or []}
+        if not {'name', 'nfc_uid'} <= columns:
+            return jsonify({"error": "CSV header must include name and nfc_uid"}), 400
+        
+        registered_at = datetime.now(pytz.UTC)
+        results = []
+        pending = []
+        
+        def process(pending):
+            outcomes = register_users([user for _, user in pending])
+            for (line_no, _), (user, error) in zip(pending, outcomes):
+                if user:
+                    results.append({"line": line_no, "status": "registered", "user": _registered(user)})
+                else:
+                    results.append({"line": line_no, "status": registration_status(error), "error": error})
+        
+        for row in reader:
+            line_no = reader.line_num
+            row = {key.strip(): value for key, value in row.items() if key and key.strip() in REGISTRATION_FIELDS}
+            if not any((value or '').strip() for value in row.values()):
+                continue
+            
+            user, error = registration_user(row, registered_at)
+            if error:
+                results.append({"line": line_no, "status": "invalid", "error": error})
+                continue
+            
+            pending.append((line_no, user))
+            if len(pending) >= BATCH_CHUNK_SIZE:
+                process(pending)
+                pending = []
+        
+        if pending:
+            process(pending)
+        
+        results.sort(key=lambda r: r['line'])
+        summary = {}
+        for result in results:
+            summary[result['status']] = summary.get(result['status'], 0) + 1
+        
+        return jsonify({
+            "status": "success",
+            "rows": len(results),
+            "summary": summary,
+            "results": results
+        }), 200
+        
+    except Exception as e:
+        print(f"Bulk registration error: {e}")
+        return jsonify({"error": "Bulk registration failed"}), 500
+
+@app.route("/api/attendance/journal", methods=["GET"])
+def journal_stats():
+    """Report write-behind journal depth, flush lag, replay and failure counters"""
+    if scan_journal is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **scan_journal.stats()}), 200
+
+@app.route("/api/attendance/journal/requeue", methods=["POST"])
+def requeue_journal_failures():
+    """Give journaled scans that ran out of attempts another round of retries"""
+    if scan_journal is None:
+        return jsonify({"error": "Journal not enabled"}), 400
+    return jsonify({"requeued": scan_journal.requeue_failed()}), 200
+
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    """Report UID cache hit/miss counters and listener staleness, and dashboard cache counters"""
+    stats = storage.cache_stats()
+    report = {"enabled": False} if stats is None else {"enabled": True, **stats}
+    report["summary_cache"] = summary_cache.stats() if summary_cache is not None else {"enabled": False}
+    report["warm_snapshot"] = warm_snapshot.stats() if warm_snapshot is not None else {"enabled": False}
+    report["registration_feed"] = registration_feed.stats() if registration_feed is not None else {"enabled": False}
+    report["group_commit"] = group_committer.stats() if group_committer is not None else {"enabled": False}
+    pending = storage.pending_stats()
+    report["status_updates"] = {"enabled": False} if pending is None else {"enabled": True, **pending}
+    return jsonify(report), 200
+
+@app.route("/admin/firestore/costs", methods=["GET"])
+def firestore_costs():
+    """Per-route Firestore RPC, read and write totals for this worker"""
+    report = storage.cost_report()
+    if report is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **report}), 200
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus scrape endpoint, aggregated across gunicorn workers"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+# Listing endpoints: largest ?limit= page, and page size used while streaming
+MAX_PAGE_LIMIT = 1000
+STREAM_PAGE_SIZE = 500
+
+_FIELD_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def _parse_fields():
+    """?fields=a,b as a list of field names, None if absent; raises ValueError if malformed"""
+    if 'fields' not in request.args:
+        return None
+    fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+    if not all(_FIELD_NAME_RE.match(f) for f in fields):
+        raise ValueError("fields must be a comma-separated list of field names")
+    return fields
+
+# Polled read endpoints: how long a browser or proxy may reuse a response without revalidating
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 10))
+
+def _etag_for(*validator):
+    """ETag for this URL (path and query string) in the state `validator` describes"""
+    return hashlib.sha1(repr((request.full_path,) + validator).encode()).hexdigest()
+
+def _cacheable(response, etag=None):
+    """Let browsers and reverse proxies keep `response` briefly, then revalidate it by ETag"""
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = HTTP_CACHE_MAX_AGE
+    return response
+
+def _not_modified(etag):
+    """A 304 response if the client's If-None-Match already has `etag`, else None"""
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return _cacheable(Response(status=304), etag)
+    return None
+
+def _streamed(chunks, mimetype):
+    """Response whose body is produced while it is being sent
+    
+    The body runs after after_request has closed the request's storage
+    accounting, so its round trips are accounted under their own "(stream)" route.
+    """
+    route = f"{request.method} {_route_label()} (stream)"
+    
+    def generate():
+        storage.begin_request()
+        try:
+            yield from chunks
+        finally:
+            storage.end_request(route)
+    
+    return Response(generate(), mimetype=mimetype)
+
 @app.route("/api/users", methods=["GET"])
 def list_users():
-    """Get all registered users"""
+    """Get registered users, one page at a time or streamed
+    
+    ?limit=N returns a single page plus `next_start_after`, the cursor to pass
+    back as ?start_after= for the next one. ?fields=name,department projects
+    each user onto those fields. Without a limit the whole collection is
+    streamed page by page, as JSON or with ?format=ndjson one user per line,
+    so memory stays flat however many users there are.
+    """
     try:
-        if db is None:
+        if not storage.connected:
             return jsonify({"error": "Database not connected"}), 500
+        
+        start_after = request.args.get('start_after') or None
+        try:
+            fields = _parse_fields()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        limit = request.args.get('limit', type=int)
+        if limit is not None and not 1 <= limit <= MAX_PAGE_LIMIT:
+            return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_LIMIT}"}), 400
+        
+        # Revalidating costs one version lookup instead of reading the collection
+        version = storage.registration_version()
+        etag = _etag_for(version) if version is not None else None
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+        
+        if request.args.get('format') == 'ndjson':
+            users = storage.iter_users(start_after, fields, min(limit or STREAM_PAGE_SIZE, STREAM_PAGE_SIZE))
+            if limit is not None:
+                users = itertools.islice(users, limit)
             
-        users_ref = db.collection('registration')
-        users = users_ref.get()
-        
-        users_list = []
-        for user in users:
-            data = user.to_dict()
-            data['id'] = user.id
-            users_list.append(data)
+            def ndjson():
+                try:
+                    for user in users:
+                        yield app.json.dumps(user) + "\n"
+                except Exception as e:
+                    print(f"Error streaming users: {e}")
+                    yield app.json.dumps({"error": "Failed to retrieve users"}) + "\n"
             
-        return jsonify({"users": users_list}), 200
+            return _cacheable(_streamed(ndjson(), 'application/x-ndjson'), etag)
+        
+        if limit is not None:
+            users_list = storage.users_page(start_after, limit, fields)
+            return _cacheable(jsonify({
+                "users": users_list,
+                "next_start_after": users_list[-1]['id'] if len(users_list) == limit else None
+            }), etag), 200
+        
+        def full_dump():
+            # Same shape as the old {"users": [...]} body, written a user at a time
+            yield '{"users": ['
+            try:
+                for i, user in enumerate(storage.iter_users(start_after, fields, STREAM_PAGE_SIZE)):
+                    yield (',' if i else '') + app.json.dumps(user)
+            except Exception as e:
+                # Headers are gone; leave the document truncated so clients see the failure
+                print(f"Error streaming users: {e}")
+                return
+            yield ']}'
+        
+        return _cacheable(_streamed(full_dump(), 'application/json'), etag)
         
     except Exception as e:
         print(f"Error retrieving users: {e}")
         return jsonify({"error": "Failed to retrieve users"}), 500
 
+# Columns of the ?format=csv attendance export
+RECORD_CSV_FIELDS = ['id', 'name', 'department', 'nfc_uid', 'device_id', 'timestamp', 'received_at', 'action']
+
+def _encode_cursor(record):
+    """Opaque resume point after `record` in a (timestamp, id) ordered listing"""
+    raw = f"{record['timestamp'].isoformat()}|{record['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    """(timestamp, id) from _encode_cursor's output; raises ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, record_id = raw.split('|', 1)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    return datetime.fromisoformat(timestamp), record_id
+
+def _csv_row(record):
+    row = io.StringIO()
+    csv.writer(row).writerow([
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in (record.get(field, '') for field in RECORD_CSV_FIELDS)
+    ])
+    return row.getvalue()
+
 @app.route("/api/attendance/daily", methods=["GET"])
 def daily_attendance():
-    """Get attendance records for a specific day using new subcollection structure"""
+    """Get a day's attendance records, oldest first, as ordered by the database
+    
+    ?since=<epoch or ISO 8601> only returns records stamped after it, so live
+    boards can poll for what is new; `latest` in the response is the value to
+    send next time. ?limit=N returns one page and `next_cursor` to pass back
+    as ?cursor=. ?format=ndjson or ?format=csv streams the records for export,
+    and without a limit the JSON body is streamed as well.
+    """
     try:
-        if db is None:
+        if not storage.connected:
             return jsonify({"error": "Database not connected"}), 500
             
         today = request.args.get('date', datetime.now(pytz.UTC).strftime("%Y-%m-%d"))
         
-        # Get the date document first
-        date_doc_ref = db.collection('attendance').document(today)
-        date_doc = date_doc_ref.get()
+        try:
+            since = _parse_timestamp(request.args['since']) if 'since' in request.args else None
+            start_after = _decode_cursor(request.args['cursor']) if 'cursor' in request.args else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        limit = request.args.get('limit', type=int)
+        if limit is not None and not 1 <= limit <= MAX_PAGE_LIMIT:
+            return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_LIMIT}"}), 400
+        output = request.args.get('format', 'json')
+        if output not in ('json', 'ndjson', 'csv'):
+            return jsonify({"error": "format must be json, ndjson or csv"}), 400
         
-        if not date_doc.exists:
-            return jsonify({"date": today, "records": [], "count": 0}), 200
-            
-        # Get the summary data
-        summary = date_doc.to_dict()
-        
-        # Get all records from the subcollection
-        records_ref = date_doc_ref.collection('records')
-        query = records_ref.stream()
-        
-        records = []
-        for record in query:
-            data = record.to_dict()
-            data['id'] = record.id
-            records.append(data)
-            
-        # Sort records by timestamp
-        records.sort(key=lambda x: x.get('timestamp'))
-            
-        return jsonify({
-            "date": today, 
-            "count": summary.get('count', 0),
-            "records": records
-        }), 200
+        # The day's count and newest record change with every check-in, so they make a
+        # validator that is checked before any records are read
+        count = storage.day_count(today)
+        latest_record = storage.latest_record_time(today) if count is not None else None
+        etag = _etag_for(today, count, latest_record.isoformat() if latest_record else None)
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
         
-    except Exception as e:
-        print(f"Error retrieving attendance: {e}")
-        return jsonify({"error": "Failed to retrieve attendance records"}), 500
-
-@app.route("/api/attendance/migrate", methods=["POST"])
-def migrate_attendance_data():
-    """Migrate old attendance data to the new structure (admin only)"""
-    try:
-        # Get all attendance records from old collection
-        old_attendance_ref = db.collection('attendance').stream()
+        if count is None:
+            count, records = 0, iter(())
+        else:
+            page_size = min(limit or STREAM_PAGE_SIZE, STREAM_PAGE_SIZE)
+            records = storage.iter_records(today, since, start_after, page_size)
+        if limit is not None:
+            records = itertools.islice(records, limit)
         
-        migrated = 0
-        failed = 0
+        if output == 'json' and limit is not None:
+            records = list(records)
+            latest = records[-1]['timestamp'] if records else since
+            return _cacheable(jsonify({
+                "date": today,
+                "count": count,
+                "records": records,
+                "next_cursor": _encode_cursor(records[-1]) if len(records) == limit else None,
+                "latest": latest.isoformat() if latest else None
+            }), etag), 200
         
-        for old_record in old_attendance_ref:
+        def body():
+            latest = since
             try:
-                data = old_record.to_dict()
-                
-                # Skip records without date
-                if 'date' not in data:
-                    continue
-                    
-                date = data.get('date')
-                user_id = data.get('user_id')
-                
-                # Reference to date document
-                date_doc_ref = db.collection('attendance').document(date)
-                
-                # Create date document if it doesn't exist
-                if not date_doc_ref.get().exists:
-                    date_doc_ref.set({
-                        'date': date,
-                        'count': 0
-                    })
-                
-                # Add to subcollection
-                records_ref = date_doc_ref.collection('records')
-                record_ref = records_ref.document(old_record.id)  # Keep same ID for traceability
-                record_ref.set(data)
-                
-                # Update summary counts
-                date_doc_ref.update({
-                    'count': firestore.Increment(1)
-                })
-                
-                migrated += 1
+                if output == 'csv':
+                    yield ','.join(RECORD_CSV_FIELDS) + "\r\n"
+                elif output == 'json':
+                    yield '{"date": %s, "count": %d, "records": [' % (json.dumps(today), count)
                 
+                for i, record in enumerate(records):
+                    latest = record['timestamp']
+                    if output == 'csv':
+                        yield _csv_row(record)
+                    elif output == 'ndjson':
+                        yield app.json.dumps(record) + "\n"
+                    else:
+                        yield (',' if i else '') + app.json.dumps(record)
             except Exception as e:
-                print(f"Error migrating record {old_record.id}: {e}")
-                failed += 1
+                # Headers are gone; a truncated body is how the client learns of the failure
+                print(f"Error streaming attendance: {e}")
+                return
+            
+            if output == 'json':
+                yield '], "latest": %s}' % json.dumps(latest.isoformat() if latest else None)
         
-        return jsonify({
-            "status": "success",
-            "migrated": migrated,
-            "failed": failed
-        }), 200
+        mimetype = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}[output]
+        return _cacheable(_streamed(body(), mimetype), etag)
         
     except Exception as e:
-        print(f"Migration error: {e}")
-        return jsonify({"error": "Migration failed"}), 500
+        print(f"Error retrieving attendance: {e}")
+        return jsonify({"error": "Failed to retrieve attendance records"}), 500
+
+# ?granularity=auto picks the finest granularity that fits the range in this many buckets
+DASHBOARD_MAX_BUCKETS = int(os.environ.get('DASHBOARD_MAX_BUCKETS', 31))
+
+def _day_summaries(start_date, end_date):
+    """Per-day counts for a range, closed days from the summary cache when it is enabled"""
+    if summary_cache is not None:
+        # Closed days come from the cache; only days it lacks (normally just today) are read
+        return summary_cache.get_range(start_date, end_date, storage.range_summaries)
+    return storage.range_summaries(start_date, end_date)
 
 @app.route("/dashboard/attendance", methods=["GET"])
 def attendance_dashboard():
-    """Get attendance data for a date range"""
+    """Get attendance data for a date range
+    
+    Returns one entry per day under "days". ?granularity=week, month or year
+    returns whole ISO weeks, months or years overlapping the range under
+    "periods" instead, and ?granularity=auto picks days for ranges of up to
+    DASHBOARD_MAX_BUCKETS days and the finest coarser period otherwise.
+    Periods come from the stored roll-ups when the backend keeps them, so a
+    year costs a dozen reads, and are added up from days otherwise.
+    """
     try:
         from datetime import timedelta
         
@@ -327,68 +885,344 @@ def attendance_dashboard():
                                      (datetime.strptime(end_date, "%Y-%m-%d") - 
                                       timedelta(days=7)).strftime("%Y-%m-%d"))
         
-        # Query for date documents in range
-        date_docs = db.collection('attendance')\
-                      .where('date', '>=', start_date)\
-                      .where('date', '<=', end_date)\
-                      .stream()
+        granularity = request.args.get('granularity', 'day')
+        if granularity == 'auto':
+            granularity = choose_granularity(start_date, end_date, DASHBOARD_MAX_BUCKETS)
+        elif granularity not in GRANULARITIES:
+            return jsonify({"error": f"granularity must be auto or one of {', '.join(GRANULARITIES)}"}), 400
         
-        results = []
-        for date_doc in date_docs:
-            summary = date_doc.to_dict()
-            results.append({
-                'date': summary.get('date'),
-                'count': summary.get('count', 0)
-            })
-            
-        # Sort by date
-        results.sort(key=lambda x: x.get('date'))
+        if granularity == 'day':
+            results = _day_summaries(start_date, end_date)
+        else:
+            periods = periods_between(start_date, end_date, granularity)
+            results = []
+            if periods:
+                results = storage.period_summaries(granularity, periods[0], periods[-1])
+                if results is None:
+                    first_day = period_bounds(periods[0], granularity)[0]
+                    last_day = period_bounds(periods[-1], granularity)[1]
+                    results = aggregate(_day_summaries(first_day, last_day), granularity)
+        
+        etag = _etag_for(start_date, end_date, granularity, results)
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
             
-        return jsonify({
+        return _cacheable(jsonify({
             "start_date": start_date,
             "end_date": end_date,
-            "days": results
-        }), 200
+            "granularity": granularity,
+            "days" if granularity == 'day' else "periods": results
+        }), etag), 200
         
     except Exception as e:
         print(f"Dashboard error: {e}")
         return jsonify({"error": "Failed to load dashboard data"}), 500
 
-@app.route("/admin/cleanup/departments", methods=["POST"])
-def cleanup_departments():
-    """Remove departments field from date documents"""
+# Long admin operations run as background jobs (see admin_jobs), throttled to
+# ADMIN_JOB_OPS_PER_SECOND database operations per second unless a job asks otherwise.
+# With ADMIN_JOB_PROCESS=1 (set by gunicorn.conf.py) workers only queue them and
+# the master's job runner process runs them
+job_runner = JobRunner(
+    storage,
+    max_workers=int(os.environ.get('ADMIN_JOB_WORKERS', 1)),
+    ops_per_second=float(os.environ.get('ADMIN_JOB_OPS_PER_SECOND', DEFAULT_OPS_PER_SECOND)),
+    execute=os.environ.get('ADMIN_JOB_PROCESS') != '1'
+)
+
+def _migrate_attendance_job(job, params):
+    progress = storage.migrate_attendance(job)
+    if summary_cache is not None:
+        summary_cache.invalidate()
+    return {"migrated": progress['migrated'], "skipped": progress['skipped'], "failed": progress['failed']}
+
+def _cleanup_departments_job(job, params):
+    return storage.cleanup_departments(job)
+
+def _rebuild_rollups_job(job, params):
+    written = storage.rebuild_period_rollups(params['start'], params['end'], job)
+    return {"enabled": written is not None, "periods": written}
+
+def _check_uid_index_job(job, params):
+    report = storage.check_uid_index(repair=False, job=job)
+    return report if report is not None else {"supported": False}
+
+def _backfill_uid_index_job(job, params):
+    report = storage.check_uid_index(repair=True, job=job)
+    return report if report is not None else {"supported": False}
+
+job_runner.register('migrate_attendance', _migrate_attendance_job, single=True)
+job_runner.register('cleanup_departments', _cleanup_departments_job, single=True)
+job_runner.register('rebuild_rollups', _rebuild_rollups_job, single=True)
+job_runner.register('check_uid_index', _check_uid_index_job, single=True)
+job_runner.register('backfill_uid_index', _backfill_uid_index_job, single=True)
+
+# Bulk registration imports (see user_import), staged under IMPORT_DIR on this host
+IMPORT_DIR = os.environ.get('IMPORT_DIR', 'imports')
+user_import.register_job(job_runner, register_users, parallel=int(os.environ.get('IMPORT_PARALLEL_COMMITS', 4)))
+
+def _job_report(state):
+    """A job state for an API response, with per-date migration totals reduced to a count"""
+    progress = state.get('progress') or {}
+    if 'counts' in progress:
+        progress = {**{k: v for k, v in progress.items() if k != 'counts'}, 'dates': len(progress['counts'])}
+    return {**state, 'progress': progress}
+
+def _submit_job(job_type, params=None):
+    """Queue an admin job and answer 202 with its state"""
+    if not storage.connected:
+        return jsonify({"error": "Database not connected"}), 500
+    
+    ops_per_second = request.args.get('ops_per_second', type=float)
+    state, created = job_runner.submit(job_type, params, ops_per_second)
+    return jsonify({
+        "status": "queued" if created else "already_running",
+        "job": _job_report(state)
+    }), 202
+
+@app.route("/admin/jobs", methods=["POST"])
+def submit_admin_job():
+    """Queue an admin job: {"type": ..., "params": {...}}, optional ?ops_per_second="""
     try:
-        # Get all date documents
-        date_docs = db.collection('attendance_by_date').stream()
+        data = request.get_json(silent=True) or {}
+        if data.get('type') not in job_runner.job_types:
+            return jsonify({"error": f"type must be one of {', '.join(sorted(job_runner.job_types))}"}), 400
+        return _submit_job(data['type'], data.get('params'))
         
-        cleaned = 0
-        failed = 0
+    except Exception as e:
+        print(f"Admin job submit error: {e}")
+        return jsonify({"error": "Failed to submit job"}), 500
+
+@app.route("/admin/jobs", methods=["GET"])
+def list_admin_jobs():
+    """Recent admin jobs, newest first, optionally only one ?type="""
+    try:
+        jobs = job_runner.list(limit=request.args.get('limit', 20, type=int), job_type=request.args.get('type'))
+        return jsonify({"jobs": [_job_report(state) for state in jobs]}), 200
         
-        for date_doc in date_docs:
-            try:
-                # Get the document data to check if departments field exists
-                doc_data = date_doc.to_dict()
-                
-                if 'departments' in doc_data:
-                    # Remove the departments field
-                    db.collection('attendance_by_date').document(date_doc.id).update({
-                        'departments': firestore.DELETE_FIELD
-                    })
-                    cleaned += 1
-            except Exception as e:
-                print(f"Error cleaning document {date_doc.id}: {e}")
-                failed += 1
+    except Exception as e:
+        print(f"Admin job list error: {e}")
+        return jsonify({"error": "Failed to list jobs"}), 500
+
+@app.route("/admin/jobs/<job_id>", methods=["GET"])
+def admin_job_status(job_id):
+    """Status, progress and result of one admin job"""
+    try:
+        state = job_runner.get(job_id)
+        if state is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(_job_report(state)), 200
         
-        return jsonify({
-            "status": "success",
-            "cleaned": cleaned,
-            "failed": failed
-        }), 200
+    except Exception as e:
+        print(f"Admin job status error: {e}")
+        return jsonify({"error": "Failed to read job"}), 500
+
+@app.route("/admin/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_admin_job(job_id):
+    """Ask a queued or running job to stop at its next checkpoint"""
+    try:
+        state = job_runner.cancel(job_id)
+        if state is None:
+            return jsonify({"error": "Job not found"}), 404
+        if not state.get('cancel_requested'):
+            return jsonify({"error": f"Job is {state['status']}", "job": _job_report(state)}), 409
+        return jsonify(_job_report(state)), 202
+        
+    except Exception as e:
+        print(f"Admin job cancel error: {e}")
+        return jsonify({"error": "Failed to cancel job"}), 500
+
+@app.route("/admin/jobs/<job_id>/resume", methods=["POST"])
+def resume_admin_job(job_id):
+    """Restart an interrupted, failed or cancelled job from its last checkpoint"""
+    try:
+        state, resumed = job_runner.resume(job_id)
+        if state is None:
+            return jsonify({"error": "Job not found"}), 404
+        if not resumed:
+            return jsonify({"error": f"Job is {state['status']}", "job": _job_report(state)}), 409
+        return jsonify({"status": "queued", "job": _job_report(state)}), 202
+        
+    except Exception as e:
+        print(f"Admin job resume error: {e}")
+        return jsonify({"error": "Failed to resume job"}), 500
+
+@app.route("/api/attendance/migrate", methods=["POST"])
+def migrate_attendance_data():
+    """Migrate old attendance data to the new structure, as a background job (admin only)"""
+    try:
+        return _submit_job('migrate_attendance')
+        
+    except Exception as e:
+        print(f"Migration error: {e}")
+        return jsonify({"error": "Migration failed"}), 500
+
+@app.route("/api/attendance/migrate", methods=["GET"])
+def migration_status():
+    """The most recent attendance migration job"""
+    try:
+        jobs = job_runner.list(job_type='migrate_attendance')
+        if not jobs:
+            return jsonify({"status": "idle"}), 200
+        return jsonify(_job_report(jobs[0])), 200
+        
+    except Exception as e:
+        print(f"Migration status error: {e}")
+        return jsonify({"error": "Failed to read migration status"}), 500
+
+@app.route("/admin/rollups/rebuild", methods=["POST"])
+def rebuild_rollups():
+    """Recompute week, month and year totals over ?start= to ?end=, as a background job (admin only)"""
+    try:
+        start_date = request.args.get('start')
+        end_date = request.args.get('end', datetime.now(pytz.UTC).strftime("%Y-%m-%d"))
+        if not start_date:
+            return jsonify({"error": "Missing start date"}), 400
+        return _submit_job('rebuild_rollups', {'start': start_date, 'end': end_date})
+        
+    except Exception as e:
+        print(f"Roll-up rebuild error: {e}")
+        return jsonify({"error": "Roll-up rebuild failed"}), 500
+
+@app.route("/admin/cleanup/departments", methods=["POST"])
+def cleanup_departments():
+    """Remove departments field from date documents, as a background job"""
+    try:
+        return _submit_job('cleanup_departments')
         
     except Exception as e:
         print(f"Cleanup error: {e}")
         return jsonify({"error": f"Cleanup failed: {str(e)}"}), 500
 
+@app.route("/admin/imports", methods=["POST"])
+def start_user_import():
+    """Import registrations from a CSV or NDJSON body as a background job
+    
+    The format comes from ?format= or the Content-Type. The body is staged
+    to disk as it arrives; follow the job at /admin/jobs/<id> and fetch
+    failed rows from /admin/imports/<id>/errors.
+    """
+    try:
+        if not storage.connected:
+            return jsonify({"error": "Database not connected"}), 500
+        
+        fmt = request.args.get('format') or user_import.detect_format(content_type=request.content_type)
+        if fmt not in user_import.IMPORT_FORMATS:
+            return jsonify({"error": "Send text/csv or application/x-ndjson, or pass ?format=csv|ndjson"}), 400
+        
+        path = user_import.stage(request.stream, IMPORT_DIR, fmt)
+        response = _submit_job('import_users', user_import.import_params(path, fmt))
+        if response[0].get_json().get('status') != 'queued':
+            # Another import is still running; this upload was never used
+            os.remove(path)
+        return response
+        
+    except Exception as e:
+        print(f"User import error: {e}")
+        return jsonify({"error": "Import failed to start"}), 500
+
+@app.route("/admin/imports/<job_id>/errors", methods=["GET"])
+def user_import_errors(job_id):
+    """Every failed row of an import so far, as NDJSON"""
+    try:
+        state = job_runner.get(job_id)
+        if state is None or state.get('type') != 'import_users':
+            return jsonify({"error": "Import not found"}), 404
+        
+        path = user_import.errors_path(state['params']['path'])
+        if not os.path.exists(path):
+            return Response('', mimetype='application/x-ndjson')
+        
+        def rows():
+            with open(path) as f:
+                yield from f
+        return Response(rows(), mimetype='application/x-ndjson')
+        
+    except Exception as e:
+        print(f"User import errors error: {e}")
+        return jsonify({"error": "Failed to read import errors"}), 500
+
+@app.route("/admin/uid-index/check", methods=["POST"])
+def check_uid_index():
+    """Compare uid_index with registration, as a background job; the report is the job's result"""
+    try:
+        return _submit_job('check_uid_index')
+        
+    except Exception as e:
+        print(f"UID index check error: {e}")
+        return jsonify({"error": "UID index check failed"}), 500
+
+@app.route("/admin/uid-index/backfill", methods=["POST"])
+def backfill_uid_index():
+    """Write missing and stale uid_index entries and drop orphans, as a background job"""
+    try:
+        return _submit_job('backfill_uid_index')
+        
+    except Exception as e:
+        print(f"UID index backfill error: {e}")
+        return jsonify({"error": "UID index backfill failed"}), 500
+
+# Per-worker startup. Reported by /ready; load balancers should hold traffic until it is
+readiness = {"ready": False, "started_at": None, "finished_at": None, "error": None, "steps": {}}
+
+# Days of dashboard summaries loaded into the summary cache during warmup
+WARMUP_DAYS = int(os.environ.get('WARMUP_DAYS', 7))
+WARMUP_MAX_BACKOFF = 30
+
+def warm_up():
+    """Open the storage connection with a test read and prime the caches, retrying until it works"""
+    readiness['started_at'] = time.time()
+    backoff = 1
+    while True:
+        try:
+            if not storage.connected:
+                raise RuntimeError("Database not connected")
+            
+            started = time.perf_counter()
+            readiness['steps']['storage'] = storage.warmup()
+            
+            if summary_cache is not None and WARMUP_DAYS > 0:
+                from datetime import timedelta
+                today = datetime.now(pytz.UTC)
+                days_started = time.perf_counter()
+                _day_summaries((today - timedelta(days=WARMUP_DAYS)).strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d"))
+                readiness['steps']['summary_cache_ms'] = round((time.perf_counter() - days_started) * 1000, 1)
+            
+            readiness['steps']['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            readiness['error'] = None
+            readiness['ready'] = True
+            readiness['finished_at'] = time.time()
+            print(f"Worker {os.getpid()} ready: {readiness['steps']}")
+            return
+            
+        except Exception as e:
+            readiness['error'] = str(e)
+            print(f"Warmup failed, retrying in {backoff}s: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, WARMUP_MAX_BACKOFF)
+
+def init_worker():
+    """Connect to storage, seed caches from the warm snapshot, start this process's
+    background threads and warm up in the background
+
+    Under gunicorn (preload_app) this runs in each worker from the post_fork
+    hook, so no gRPC channel or thread is created in the master and shared
+    across fork; run directly, it runs at import.
+    """
+    wait_for_libraries()
+    storage.connect()
+    if scan_journal is not None and storage.connected:
+        scan_journal.ensure_started()
+    if warm_snapshot is not None and storage.connected:
+        # Milliseconds: serve from the previous worker's caches while warmup reconciles them
+        readiness['steps']['warm_snapshot'] = warm_snapshot.load()
+        warm_snapshot.ensure_started()
+    threading.Thread(target=warm_up, name='warmup', daemon=True).start()
+
+# gunicorn.conf.py sets DEFER_WORKER_INIT and calls init_worker() after forking
+if os.environ.get('DEFER_WORKER_INIT') != '1':
+    init_worker()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     debug_mode = os.environ.get("FLASK_ENV") != "production"
@@ -0,0 +1,154 @@
+"""Cold-start benchmark: import time and time to the first accepted scan.
+
+Render spins the service down when idle, so the first tap of the morning
+waits for gunicorn to start, import the app and bring a worker up. This
+measures both halves against the in-memory backend:
+
+- `python -X importtime -c "import app"` as the gunicorn master runs it
+  (DEFER_WORKER_INIT=1), reporting the app's total import time and its
+  heaviest direct imports;
+- gunicorn started with backend/gunicorn.conf.py, timed from launch until
+  the port answers and until POST /api/attendance first succeeds.
+
+Each is repeated --runs times and the median is checked against its budget;
+the script exits non-zero when a budget is exceeded, so it can gate CI:
+
+    python bench/cold_start.py --import-budget-ms 800 --first-scan-budget-ms 3000
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+from morning_rush import BACKEND_DIR, make_staff, request
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def base_env(workdir):
+    env = dict(os.environ)
+    env.update({
+        'STORAGE_BACKEND': 'memory',
+        'SUMMARY_CACHE_PATH': os.path.join(workdir, 'summary_cache.db'),
+        'FLASK_ENV': 'production',
+    })
+    return env
+
+
+def profile_imports(workdir):
+    """Run `import app` under -X importtime. Returns (app total ms, {direct import: ms})"""
+    env = base_env(workdir)
+    env['DEFER_WORKER_INIT'] = '1'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                          cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+    # A module's imports are printed, one level deeper, before the module itself
+    pending = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_us, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        if indent == 2:
+            pending[name] = pending.get(name, 0) + cumulative_us / 1000
+        elif indent == 0:
+            if name == 'app':
+                return cumulative_us / 1000, pending
+            pending = {}
+    raise SystemExit("importtime output did not include the app module")
+
+
+def time_first_scan(workdir, port, timeout):
+    """Start gunicorn and return (seconds until it answers, seconds until a scan succeeds)"""
+    staff = make_staff(1, seed=1)
+    seed_path = os.path.join(workdir, 'staff.json')
+    with open(seed_path, 'w') as f:
+        json.dump(staff, f)
+
+    env = base_env(workdir)
+    env['STORAGE_SEED_USERS'] = seed_path
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}', 'app:app']
+    base = urlparse(f'http://127.0.0.1:{port}')
+    scan = {'uid': staff[0]['nfc_uid'], 'device_id': 'cold-start-bench'}
+
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    answered = None
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                status = request(base, 'POST', '/api/attendance', scan, timeout=timeout)[0]
+            except OSError:
+                if proc.poll() is not None:
+                    raise SystemExit("gunicorn exited during startup")
+                time.sleep(0.02)
+                continue
+            if answered is None:
+                answered = time.perf_counter() - started
+            if status in (201, 202):
+                return answered, time.perf_counter() - started
+            time.sleep(0.02)
+        raise SystemExit(f"no successful scan within {timeout:.0f}s")
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--port', type=int, default=10098)
+    parser.add_argument('--import-budget-ms', type=float, default=1000.0,
+                        help="Budget for the median import time of the app module")
+    parser.add_argument('--first-scan-budget-ms', type=float, default=4000.0,
+                        help="Budget for the median time from launching gunicorn to the first accepted scan")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--top', type=int, default=8, help="Heaviest direct imports to list")
+    args = parser.parse_args(argv)
+
+    imports, answers, scans = [], [], []
+    heaviest = {}
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory(prefix='cold-start-') as workdir:
+            total, children = profile_imports(workdir)
+            imports.append(total)
+            for name, ms in children.items():
+                heaviest.setdefault(name, []).append(ms)
+            answered, scanned = time_first_scan(workdir, args.port, args.timeout)
+            answers.append(answered * 1000)
+            scans.append(scanned * 1000)
+
+    import_ms = statistics.median(imports)
+    first_scan_ms = statistics.median(scans)
+    print(f"Cold start over {args.runs} runs (median, in-memory backend)")
+    print()
+    print(f"{'import app':<34}{import_ms:>9.1f} ms   budget {args.import_budget_ms:.0f} ms")
+    print(f"{'gunicorn answering':<34}{statistics.median(answers):>9.1f} ms")
+    print(f"{'first accepted scan':<34}{first_scan_ms:>9.1f} ms   budget {args.first_scan_budget_ms:.0f} ms")
+    print()
+    print("Heaviest direct imports of app:")
+    ranked = sorted(((statistics.median(ms), name) for name, ms in heaviest.items()), reverse=True)
+    for ms, name in ranked[:args.top]:
+        print(f"  {name:<32}{ms:>9.1f} ms")
+
+    failures = []
+    if import_ms > args.import_budget_ms:
+        failures.append(f"import app took {import_ms:.0f} ms (budget {args.import_budget_ms:.0f} ms)")
+    if first_scan_ms > args.first_scan_budget_ms:
+        failures.append(f"first scan took {first_scan_ms:.0f} ms (budget {args.first_scan_budget_ms:.0f} ms)")
+    if failures:
+        print()
+        for failure in failures:
+            print(f"OVER BUDGET: {failure}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
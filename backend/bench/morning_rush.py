@@ -0,0 +1,324 @@
+"""Morning-rush load test: a fleet of simulated ESP32 readers against the API.
+
+Each simulated reader behaves like src/main.cpp: it POSTs {"uid", "device_id"}
+as JSON to /api/attendance on a fresh connection, handles the status code the
+same way (201/202 success, 404 not registered, 400 already recorded, anything
+else an error), spends the same time flashing LEDs, and then waits the 3 s
+re-read delay before the next card can be read. Staff queue at their
+entrance, so a slow backend shows up as a growing queue, not just as latency.
+
+Arrivals follow a bell curve over the window with its peak shortly before the
+start time (2,000 staff over 15 minutes by default). Optional admin pollers hit
+the dashboard endpoints at the same time.
+
+Run against an existing server:
+
+    python bench/morning_rush.py --url http://127.0.0.1:10000
+
+or let the script start gunicorn with backend/gunicorn.conf.py on a local
+storage backend, seeded with the simulated staff:
+
+    python bench/morning_rush.py --spawn --backend sqlite --worker-class gthread
+
+--time-scale compresses the whole run (0.1 plays 15 minutes in 90 seconds,
+device delays included).
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds a reader is busy around each request (see sendAttendanceData/loop in src/main.cpp)
+CARD_DETECTED_FLASH = 0.1
+SENDING_FLASH = 0.4           # logMessage("SENDING") flashes the green LED once
+RESULT_FLASHES = {            # flashLED(...) + logMessage(...) for each outcome
+    'success': 0.4 + 0.4,
+    'not_registered': 0.8 + 0.8,
+    'duplicate': 0.4 + 0.8,
+    'error': 0.4 + 0.8,
+    'connection_failed': 0.8 + 0.8,
+}
+REREAD_DELAY = 3.0
+LOOP_DELAY = 0.25
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def make_staff(count, seed):
+    rng = random.Random(seed)
+    staff = []
+    for i in range(count):
+        uid = ':'.join(f'{rng.randrange(256):02x}' for _ in range(7))
+        staff.append({
+            'id': f'staff-{i:05d}',
+            'name': f'Staff {i}',
+            'department': f'Dept {i % 12}',
+            'nfc_uid': uid,
+            'status': 'absent'
+        })
+    return staff
+
+
+def arrival_offsets(count, window, peak, rng):
+    """Arrival times in [0, window), normally distributed around `peak`"""
+    offsets = []
+    sigma = window / 5.0
+    while len(offsets) < count:
+        t = rng.gauss(peak, sigma)
+        if 0 <= t < window:
+            offsets.append(t)
+    offsets.sort()
+    return offsets
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}    # endpoint -> [seconds]
+        self.statuses = {}     # endpoint -> {status: count}
+        self.ops = {}          # endpoint -> [storage ops per request]
+        self.queue_waits = []  # seconds a tap waited for its reader
+        self.outcomes = {}
+
+    def add(self, endpoint, status, latency, ops=None):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+            if ops is not None:
+                self.ops.setdefault(endpoint, []).append(ops)
+
+    def add_outcome(self, outcome, queue_wait):
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.queue_waits.append(queue_wait)
+
+
+def request(base, method, path, body=None, timeout=10.0):
+    """One request on a fresh connection, like HTTPClient.begin()/end() on the ESP32"""
+    conn_cls = http.client.HTTPSConnection if base.scheme == 'https' else http.client.HTTPConnection
+    conn = conn_cls(base.hostname, base.port, timeout=timeout)
+    headers = {}
+    if body is not None:
+        body = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+    started = time.perf_counter()
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        ops = response.getheader('X-Storage-Ops')
+        return response.status, time.perf_counter() - started, int(ops) if ops is not None else None
+    finally:
+        conn.close()
+
+
+def classify(status):
+    if status in (201, 202):
+        return 'success'
+    if status == 404:
+        return 'not_registered'
+    if status == 400:
+        return 'duplicate'
+    return 'error'
+
+
+def run_reader(base, device_id, taps, t0, scale, results):
+    """Serve one entrance's queue of (arrival offset, uid) in order"""
+    free_at = 0.0
+    for arrival, uid in taps:
+        start = max(arrival, free_at)
+        delay = t0 + start * scale - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        time.sleep(CARD_DETECTED_FLASH * scale + SENDING_FLASH * scale)
+        try:
+            status, latency, ops = request(base, 'POST', '/api/attendance',
+                                           {'uid': uid, 'device_id': device_id})
+            results.add('POST /api/attendance', status, latency, ops)
+            outcome = classify(status)
+        except OSError:
+            results.add('POST /api/attendance', 'connection_failed', 0.0)
+            outcome = 'connection_failed'
+        results.add_outcome(outcome, start - arrival)
+
+        time.sleep((RESULT_FLASHES[outcome] + REREAD_DELAY + LOOP_DELAY) * scale)
+        free_at = (time.perf_counter() - t0) / scale
+
+
+def run_poller(base, paths, interval, stop, results):
+    while not stop.wait(interval):
+        for path in paths:
+            endpoint = 'GET ' + path.split('?')[0]
+            try:
+                status, latency, ops = request(base, 'GET', path, timeout=30.0)
+                results.add(endpoint, status, latency, ops)
+            except OSError:
+                results.add(endpoint, 'connection_failed', 0.0)
+
+
+def spawn_server(args, staff):
+    """Start gunicorn with backend/gunicorn.conf.py on a local backend"""
+    seed = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(staff, seed)
+    seed.close()
+    workdir = tempfile.mkdtemp(prefix='morning-rush-')
+
+    env = dict(os.environ)
+    env.update({
+        'STORAGE_BACKEND': args.backend,
+        'STORAGE_SEED_USERS': seed.name,
+        'SQLITE_PATH': os.path.join(workdir, 'attendance.db'),
+        'SCAN_JOURNAL_PATH': os.path.join(workdir, 'scan_journal.db'),
+        'MEMORY_LATENCY_MS': str(args.latency_ms),
+        'MEMORY_LATENCY_JITTER_MS': str(args.latency_jitter_ms),
+        'MEMORY_LATENCY_TAIL_MS': str(args.latency_tail_ms),
+        'MEMORY_LATENCY_TAIL_P': str(args.latency_tail_p),
+        'FLASK_ENV': 'production',
+    })
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+           '-b', f'127.0.0.1:{args.port}', 'app:app']
+    if args.worker_class:
+        cmd += ['-k', args.worker_class]
+    if args.workers:
+        cmd += ['-w', str(args.workers)]
+    proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env)
+
+    base = urlparse(f'http://127.0.0.1:{args.port}')
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            # /ready answers 503 until a worker has connected and warmed up
+            if request(base, 'GET', '/ready', timeout=1.0)[0] == 200:
+                return proc, base
+            time.sleep(0.2)
+        except OSError:
+            if proc.poll() is not None:
+                raise SystemExit("gunicorn exited during startup")
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("gunicorn did not come up within 30s")
+
+
+def report(results, wall, args):
+    print()
+    print(f"Simulated {args.staff} staff on {args.readers} readers, "
+          f"{args.window:.0f}s window x{args.time_scale} in {wall:.1f}s wall time")
+    print()
+    header = f"{'endpoint':<34}{'count':>7}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'ops/req':>9}"
+    print(header)
+    print('-' * len(header))
+    for endpoint in sorted(results.latencies):
+        lat = [x * 1000 for x in results.latencies[endpoint]]
+        ops = results.ops.get(endpoint)
+        ops_text = f"{sum(ops) / len(ops):.2f}" if ops else 'n/a'
+        print(f"{endpoint:<34}{len(lat):>7}{len(lat) / wall:>8.1f}"
+              f"{percentile(lat, 50):>9.1f}{percentile(lat, 95):>9.1f}"
+              f"{percentile(lat, 99):>9.1f}{max(lat):>9.1f}{ops_text:>9}")
+    print()
+    for endpoint in sorted(results.statuses):
+        codes = ', '.join(f"{code}: {n}" for code, n in sorted(results.statuses[endpoint].items(), key=str))
+        print(f"{endpoint}: {codes}")
+    print(f"Scan outcomes: {results.outcomes}")
+    waits = results.queue_waits
+    if waits:
+        print(f"Queue wait at readers (simulated s): p50 {percentile(waits, 50):.1f}, "
+              f"p95 {percentile(waits, 95):.1f}, max {max(waits):.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help="Base URL of a running server")
+    parser.add_argument('--spawn', action='store_true', help="Start gunicorn locally instead of using --url")
+    parser.add_argument('--backend', default='sqlite', choices=['memory', 'sqlite'],
+                        help="Storage backend for --spawn (memory state is per worker)")
+    parser.add_argument('--worker-class', help="gunicorn worker class override for --spawn")
+    parser.add_argument('--workers', type=int, help="gunicorn worker count override for --spawn")
+    parser.add_argument('--port', type=int, default=10099)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Simulated RPC latency (memory backend)")
+    parser.add_argument('--latency-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--latency-tail-ms', type=float, default=0.0)
+    parser.add_argument('--latency-tail-p', type=float, default=0.0)
+    parser.add_argument('--staff', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--window', type=float, default=900.0, help="Arrival window in seconds")
+    parser.add_argument('--peak', type=float, default=0.66, help="Arrival peak as a fraction of the window")
+    parser.add_argument('--time-scale', type=float, default=1.0)
+    parser.add_argument('--unknown-rate', type=float, default=0.01, help="Share of taps from unregistered cards")
+    parser.add_argument('--retap-rate', type=float, default=0.03, help="Share of staff who tap twice")
+    parser.add_argument('--poll-interval', type=float, default=10.0,
+                        help="Dashboard poll interval in real seconds (0 disables)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if not args.url and not args.spawn:
+        parser.error("give --url or --spawn")
+
+    rng = random.Random(args.seed)
+    staff = make_staff(args.staff, args.seed)
+
+    proc = None
+    if args.spawn:
+        proc, base = spawn_server(args, staff)
+    else:
+        base = urlparse(args.url)
+
+    # Assign everyone (plus re-taps and stray cards) to an entrance
+    taps = [(t, member['nfc_uid']) for t, member in
+            zip(arrival_offsets(len(staff), args.window, args.peak * args.window, rng), staff)]
+    for t, uid in list(taps):
+        if rng.random() < args.retap_rate:
+            taps.append((min(args.window, t + rng.uniform(5, 60)), uid))
+    for _ in range(int(args.staff * args.unknown_rate)):
+        taps.append((rng.uniform(0, args.window), 'ff:' + ':'.join(f'{rng.randrange(256):02x}' for _ in range(6))))
+    per_reader = [[] for _ in range(args.readers)]
+    for tap in taps:
+        per_reader[rng.randrange(args.readers)].append(tap)
+
+    results = Results()
+    stop = threading.Event()
+    t0 = time.perf_counter() + 0.5
+    threads = [threading.Thread(target=run_reader,
+                                args=(base, f'esp32-entrance-{i}', sorted(queue), t0, args.time_scale, results))
+               for i, queue in enumerate(per_reader)]
+    if args.poll_interval > 0:
+        threads.append(threading.Thread(
+            target=run_poller,
+            args=(base, ['/api/attendance/daily', '/dashboard/attendance'], args.poll_interval, stop, results),
+            daemon=True))
+
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            if not thread.daemon:
+                thread.join()
+        stop.set()
+        wall = time.perf_counter() - t0
+        report(results, wall, args)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+from periods import period_bounds, period_of
+
+
+class ShardedCounter:
+    """Distributed counter spread over N shard documents under a parent doc.
+
+    Firestore sustains roughly one write per second per document, so a single
+    `count` field on attendance/{date} serializes every entrance at the start
+    of the day. Increments instead go to a random shard in
+    {parent}/{subcollection}/{0..N-1}; readers add the shards up, plus any
+    count the parent held from before sharding (see legacy_count). A periodic
+    roll-up can copy the total back into the parent's `count` field so that
+    dashboards keep reading one document per day.
+
+    The shard count may be raised later but must never be lowered, otherwise
+    the counts in the dropped shards are no longer read.
+    """
+
+    def __init__(self, num_shards=10, subcollection='count_shards'):
+        self.num_shards = num_shards
+        self.subcollection = subcollection
+
+    def shard_refs(self, doc_ref):
+        return [doc_ref.collection(self.subcollection).document(str(i))
+                for i in range(self.num_shards)]
+
+    def increment(self, batch, doc_ref, amount=1):
+        """Add an increment of a random shard to `batch`"""
+        from firebase_admin import firestore  # already loaded by the backend's connect()
+        shard = doc_ref.collection(self.subcollection).document(
+            str(random.randrange(self.num_shards)))
+        batch.set(shard, {'count': firestore.Increment(amount)}, merge=True)
+
+    def totals(self, db, date_docs):
+        """Totals of several parent documents, summing their shards with a single get_all
+
+        Takes the parents' snapshots and returns {parent path: shard sum plus
+        legacy_count(), or None if the parent has no shards}.
+        """
+        refs = []
+        for date_doc in date_docs:
+            refs.extend(self.shard_refs(date_doc.reference))
+        totals = {date_doc.reference.path: None for date_doc in date_docs}
+        if not refs:
+            return totals
+        for shard in db.get_all(refs):
+            if not shard.exists:
+                continue
+            parent_path = shard.reference.parent.parent.path
+            totals[parent_path] = (totals[parent_path] or 0) + (shard.to_dict() or {}).get('count', 0)
+        for date_doc in date_docs:
+            path = date_doc.reference.path
+            if totals[path] is not None:
+                totals[path] += legacy_count(date_doc.to_dict() or {})
+        return totals
+
+    def roll_up(self, db, doc_ref):
+        """Copy the total (shards plus legacy_count()) into the parent's `count`. Returns the total
+
+        Runs in a transaction so an increment landing between the shard reads
+        and the parent write makes it retry instead of being lost. The first
+        roll-up of a day from before sharding keeps its old `count` as
+        `legacy_count`, since `count` stops meaning the same thing from then on.
+        """
+        from firebase_admin import firestore
+        refs = self.shard_refs(doc_ref)
+
+        @firestore.transactional
+        def _roll_up(transaction):
+            total = None
+            legacy = 0
+            for snapshot in transaction.get_all(refs + [doc_ref]):
+                if snapshot.reference.path == doc_ref.path:
+                    legacy = legacy_count(snapshot.to_dict() or {}) if snapshot.exists else 0
+                elif snapshot.exists:
+                    total = (total or 0) + (snapshot.to_dict() or {}).get('count', 0)
+            if total is None:
+                return None
+            total += legacy
+            transaction.set(doc_ref, {
+                'count': total,
+                'legacy_count': legacy,
+                'rolled_up_at': datetime.now(pytz.UTC),
+                'needs_rollup': firestore.DELETE_FIELD
+            }, merge=True)
+            return total
+
+        return _roll_up(db.transaction())
+
+
+def legacy_count(summary):
+    """The part of a date doc's total that is not in its shards
+
+    Days recorded before sharding kept their whole total in `count`, and a
+    scan backfilled or replayed into such a day later starts its shards from
+    zero. A `count` that no roll-up wrote is therefore that old total; the
+    first roll-up moves it to `legacy_count`.
+    """
+    if 'legacy_count' in summary:
+        return summary['legacy_count'] or 0
+    if 'rolled_up_at' in summary:
+        return 0
+    return summary.get('count') or 0
+
+
+def is_final_rollup(summary, date):
+    """True if the parent's `count` was rolled up after `date` ended (UTC)
+
+    Such a count can be read on its own without summing the shards.
+    """
+    rolled_up_at = summary.get('rolled_up_at')
+    if rolled_up_at is None or summary.get('needs_rollup'):
+        return False
+    day_end = pytz.UTC.localize(datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1))
+    return rolled_up_at >= day_end
+
+
+class PeriodRollups:
+    """Week, month and year totals in {collection}/{granularity}/periods/{period}
+
+    A period document is always recomputed whole rather than incremented:
+    weeks and months from their day counts (via `day_summaries`, the same
+    lookup the dashboard uses) and years from their twelve months. That makes a
+    recompute idempotent, so every worker's roll-up thread may do it and a
+    rebuild can run alongside them. A year view then reads 12 documents
+    instead of 365.
+    """
+
+    def __init__(self, db, day_summaries, collection='attendance_rollups'):
+        self.db = db
+        self.day_summaries = day_summaries
+        self.collection = collection
+
+    def periods_ref(self, granularity):
+        return self.db.collection(self.collection).document(granularity).collection('periods')
+
+    def _write(self, batch, granularity, period, count):
+        start, end = period_bounds(period, granularity)
+        batch.set(self.periods_ref(granularity).document(period), {
+            'granularity': granularity,
+            'period': period,
+            'start': start,
+            'end': end,
+            'count': count,
+            'updated_at': datetime.now(pytz.UTC)
+        })
+
+    def recompute(self, dates):
+        """Recompute every week, month and year containing one of `dates`"""
+        batch = self.db.batch()
+        years = set()
+        for granularity in ('week', 'month'):
+            for period in sorted({period_of(date, granularity) for date in dates}):
+                start, end = period_bounds(period, granularity)
+                days = self.day_summaries(start, end)
+                self._write(batch, granularity, period, sum(day['count'] for day in days))
+        batch.commit()
+
+        # Years add up their month documents, which were just brought up to date
+        batch = self.db.batch()
+        for year in sorted({period_of(date, 'year') for date in dates}):
+            months = self.summaries('month', f"{year}-01", f"{year}-12")
+            self._write(batch, 'year', year, sum(month['count'] for month in months))
+        batch.commit()
+
+    def rebuild(self, start_date, end_date, job=None):
+        """Recompute every period overlapping [start_date, end_date], e.g. for days
+        recorded before roll-ups were enabled. Returns the number of periods written
+
+        With an admin `job`, each year is throttled and checkpointed, and a
+        resumed job continues after the last year it finished.
+        """
+        progress = dict(job.progress if job is not None else {})
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d")
+        written = progress.get('periods', 0)
+        # A year at a time keeps each batch well under the 500-write limit
+        for year in range(max(start.year, progress.get('done_through_year', 0) + 1), end.year + 1):
+            first = max(start, datetime(year, 1, 1))
+            last = min(end, datetime(year, 12, 31))
+            dates = [(first + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((last - first).days + 1)]
+            periods = sum(len({period_of(date, g) for date in dates}) for g in ('week', 'month', 'year'))
+            if job is not None:
+                # Day documents read plus period documents written
+                job.throttle(len(dates) + periods)
+            self.recompute(dates)
+            written += periods
+            if job is not None:
+                job.checkpoint({'done_through_year': year, 'periods': written})
+        return written
+
+    def summaries(self, granularity, first_period, last_period):
+        """[{'period', 'start', 'end', 'count'}] for stored periods in [first_period, last_period]"""
+        query = self.periods_ref(granularity)\
+                    .where('period', '>=', first_period)\
+                    .where('period', '<=', last_period)
+        results = []
+        for doc in query.stream():
+            data = doc.to_dict()
+            results.append({key: data[key] for key in ('period', 'start', 'end', 'count')})
+        results.sort(key=lambda x: x['period'])
+        return results
+
+
+class CounterRollup:
+    """Background thread rolling shard totals into the parent documents
+
+    Each pass rolls up today, yesterday (so the final total of a day is written
+    once it has closed) and any older day flagged with `needs_rollup`. With
+    `periods`, the weeks, months and years of the days whose total changed are
+    then recomputed, once each per pass however many scans arrived.
+    """
+
+    def __init__(self, db, counter, collection='attendance', interval=60.0, periods=None):
+        self.db = db
+        self.counter = counter
+        self.collection = collection
+        self.interval = interval
+        self.periods = periods
+        self._last_totals = {}  # date -> total last rolled up by this process
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='counter-rollup', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.roll_up_once()
+
+    def roll_up_once(self):
+        now = datetime.now(pytz.UTC)
+        dates = {day.strftime("%Y-%m-%d") for day in (now - timedelta(days=1), now)}
+        try:
+            dirty = self.db.collection(self.collection).where('needs_rollup', '==', True).stream()
+            dates.update(doc.id for doc in dirty)
+        except Exception as e:
+            print(f"Error finding days to roll up: {e}")
+
+        today = now.strftime("%Y-%m-%d")
+        changed = []
+        for date in sorted(dates):
+            doc_ref = self.db.collection(self.collection).document(date)
+            try:
+                if date != today:
+                    # Closed days only need their one final roll-up
+                    summary = doc_ref.get()
+                    if summary.exists and is_final_rollup(summary.to_dict(), date):
+                        continue
+                total = self.counter.roll_up(self.db, doc_ref)
+                if total is not None and total != self._last_totals.get(date):
+                    self._last_totals[date] = total
+                    changed.append(date)
+            except Exception as e:
+                print(f"Counter roll-up failed for {date}: {e}")
+                time.sleep(1)
+
+        # Only the last two days are rolled up routinely; forget older totals
+        for date in [d for d in self._last_totals if d not in dates]:
+            del self._last_totals[date]
+
+        if self.periods is not None and changed:
+            try:
+                self.periods.recompute(changed)
+            except Exception as e:
+                print(f"Period roll-up failed for {changed}: {e}")
@@ -0,0 +1,280 @@
+import json
+import os
+import threading
+import time
+
+# RPCs a single request may make before it is flagged as an N+1 suspect
+DEFAULT_RPC_BUDGET = 8
+
+_current = threading.local()
+_installed = False
+
+# Callables (op, collection, docs, seconds) notified of every RPC, e.g. metrics
+observers = []
+
+# Ops whose `docs` are writes; every other op's are (billed) reads
+WRITE_OPS = ('commit', 'bulk_commit')
+
+# A count() aggregation bills one read per this many index entries it matched
+COUNT_ENTRIES_PER_READ = 1000
+
+
+def normalize_path(path):
+    """Collapse document IDs so 'attendance/2025-01-01/records' -> 'attendance/*/records'"""
+    segments = [s for s in path.split('/') if s]
+    return '/'.join('*' if i % 2 else s for i, s in enumerate(segments))
+
+
+def _collection_of_write(write_pb):
+    name = write_pb.update.name or write_pb.delete or write_pb.transform.document
+    if '/documents/' in name:
+        name = name.split('/documents/', 1)[1]
+    return normalize_path(name.rsplit('/', 1)[0])
+
+
+class RequestTrace:
+    """Firestore calls made while handling one request (or by one background thread)"""
+
+    def __init__(self, route):
+        self.route = route
+        self.ops = []  # (op, collection, docs, seconds)
+        self.started = time.perf_counter()
+
+    def add(self, op, collection, docs, seconds):
+        self.ops.append((op, collection, docs, seconds))
+
+    @property
+    def rpcs(self):
+        return len(self.ops)
+
+    @property
+    def reads(self):
+        # Billing: a query or listen event costs at least one read, get_all one per document asked for
+        return sum(max(docs, 1) for op, _, docs, _ in self.ops if op not in WRITE_OPS)
+
+    @property
+    def writes(self):
+        return sum(docs for op, _, docs, _ in self.ops if op in WRITE_OPS)
+
+    @property
+    def firestore_ms(self):
+        return sum(seconds for _, _, _, seconds in self.ops) * 1000
+
+    def server_timing(self):
+        return (f'firestore;dur={self.firestore_ms:.1f};'
+                f'desc="{self.rpcs} rpc, {self.reads} read, {self.writes} write"')
+
+    def summary(self):
+        return {
+            'route': self.route,
+            'rpcs': self.rpcs,
+            'reads': self.reads,
+            'writes': self.writes,
+            'firestore_ms': round(self.firestore_ms, 1),
+            'ops': [
+                {'op': op, 'collection': collection, 'docs': docs, 'ms': round(seconds * 1000, 1)}
+                for op, collection, docs, seconds in self.ops
+            ],
+        }
+
+
+class CostLedger:
+    """Per-route totals of requests, RPCs, reads and writes in this process"""
+
+    def __init__(self, rpc_budget=DEFAULT_RPC_BUDGET):
+        self.rpc_budget = rpc_budget
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def add(self, trace):
+        """Fold a finished trace into the totals. Returns True if it is an N+1 suspect"""
+        suspect = trace.rpcs > self.rpc_budget
+        with self._lock:
+            route = self._routes.setdefault(trace.route, {
+                'requests': 0, 'rpcs': 0, 'reads': 0, 'writes': 0,
+                'firestore_ms': 0.0, 'max_rpcs': 0, 'n_plus_one_suspects': 0,
+            })
+            route['requests'] += 1
+            route['rpcs'] += trace.rpcs
+            route['reads'] += trace.reads
+            route['writes'] += trace.writes
+            route['firestore_ms'] += trace.firestore_ms
+            route['max_rpcs'] = max(route['max_rpcs'], trace.rpcs)
+            if suspect:
+                route['n_plus_one_suspects'] += 1
+        return suspect
+
+    def report(self):
+        with self._lock:
+            routes = {}
+            for name, totals in self._routes.items():
+                requests = totals['requests'] or 1
+                routes[name] = {
+                    **totals,
+                    'firestore_ms': round(totals['firestore_ms'], 1),
+                    'reads_per_request': round(totals['reads'] / requests, 2),
+                    'writes_per_request': round(totals['writes'] / requests, 2),
+                }
+            return {'rpc_budget': self.rpc_budget, 'routes': routes}
+
+
+ledger = CostLedger(int(os.environ.get('FIRESTORE_RPC_BUDGET', DEFAULT_RPC_BUDGET)))
+
+
+def begin(route=None):
+    _current.trace = RequestTrace(route)
+    return _current.trace
+
+
+def current():
+    return getattr(_current, 'trace', None)
+
+
+def end(route):
+    """Finish the current request's trace, account it and log it"""
+    trace = getattr(_current, 'trace', None)
+    _current.trace = None
+    if trace is None:
+        return None
+    trace.route = route
+    suspect = ledger.add(trace)
+    if trace.ops and os.environ.get('FIRESTORE_TRACE_LOG', '1') != '0':
+        print(json.dumps({'event': 'firestore_trace', 'n_plus_one_suspect': suspect, **trace.summary()}))
+    elif suspect:
+        print(f"N+1 suspect: {route} made {trace.rpcs} Firestore RPCs")
+    return trace
+
+
+def record(op, collection, docs, seconds, trace=None):
+    """Account one Firestore RPC to `trace`, the current request, or its background thread"""
+    for observer in observers:
+        observer(op, collection, docs, seconds)
+    if trace is None:
+        trace = getattr(_current, 'trace', None)
+    if trace is not None:
+        trace.add(op, collection, docs, seconds)
+        return
+    background = RequestTrace(f'(background) {threading.current_thread().name}')
+    background.add(op, collection, docs, seconds)
+    ledger.add(background)
+
+
+def install():
+    """Wrap the Firestore client methods that issue RPCs. Safe to call more than once
+
+    Covered: batch and transaction commits, BulkWriter batches, document gets,
+    get_all, queries and aggregation queries. Listener events are recorded by
+    their owner (uid_cache). Not covered: transaction begin/rollback RPCs,
+    which are not billed, and the async client, which this app does not use.
+    """
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    from google.cloud.firestore_v1.aggregation import AggregationQuery
+    from google.cloud.firestore_v1.base_aggregation import CountAggregation
+    from google.cloud.firestore_v1.batch import WriteBatch
+    from google.cloud.firestore_v1.bulk_writer import BulkWriter
+    from google.cloud.firestore_v1.client import Client
+    from google.cloud.firestore_v1.document import DocumentReference
+    from google.cloud.firestore_v1.query import Query
+    from google.cloud.firestore_v1.transaction import Transaction
+
+    def wrap_commit(cls, attr, op):
+        original = getattr(cls, attr)
+
+        def traced(self, *args, **kwargs):
+            writes = list(self._write_pbs)
+            collections = sorted({_collection_of_write(pb) for pb in writes})
+            started = time.perf_counter()
+            try:
+                return original(self, *args, **kwargs)
+            finally:
+                record(op, ','.join(collections), len(writes), time.perf_counter() - started)
+
+        setattr(cls, attr, traced)
+
+    wrap_commit(WriteBatch, 'commit', 'commit')
+    wrap_commit(Transaction, '_commit', 'commit')
+
+    original_writer_init = BulkWriter.__init__
+    original_writer_send = BulkWriter._send
+
+    def traced_writer_init(self, *args, **kwargs):
+        original_writer_init(self, *args, **kwargs)
+        # Batches go out on the writer's executor threads: account them to whoever created it
+        self._trace = current()
+
+    def traced_writer_send(self, batch):
+        writes = list(batch._write_pbs)
+        collections = sorted({_collection_of_write(pb) for pb in writes})
+        started = time.perf_counter()
+        try:
+            return original_writer_send(self, batch)
+        finally:
+            record('bulk_commit', ','.join(collections), len(writes), time.perf_counter() - started,
+                   getattr(self, '_trace', None))
+
+    BulkWriter.__init__ = traced_writer_init
+    BulkWriter._send = traced_writer_send
+
+    original_doc_get = DocumentReference.get
+
+    def traced_doc_get(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original_doc_get(self, *args, **kwargs)
+        finally:
+            record('get', normalize_path('/'.join(self._path[:-1])), 1, time.perf_counter() - started)
+
+    DocumentReference.get = traced_doc_get
+
+    def wrap_stream(cls, attr, op, describe, billed=lambda stream, item: 1):
+        original = getattr(cls, attr)
+
+        def traced(self, *args, **kwargs):
+            # Generators: time and count until the caller has consumed them
+            args, collection = describe(self, args, kwargs)
+            started = time.perf_counter()
+            docs = 0
+            gen = original(self, *args, **kwargs)
+            try:
+                while True:
+                    try:
+                        item = next(gen)
+                    except StopIteration as stop:
+                        return stop.value
+                    docs += billed(self, item)
+                    yield item
+            finally:
+                record(op, collection, docs, time.perf_counter() - started)
+
+        setattr(cls, attr, traced)
+
+    def describe_query(query, args, kwargs):
+        return args, normalize_path('/'.join(query._parent._path))
+
+    def describe_get_all(client, args, kwargs):
+        # References may be a one-shot iterable; materialize it before describing it
+        if args:
+            args = (list(args[0]),) + tuple(args[1:])
+            refs = args[0]
+        else:
+            refs = kwargs['references'] = list(kwargs.get('references', []))
+        return args, ','.join(sorted({normalize_path('/'.join(ref._path[:-1])) for ref in refs}))
+
+    def describe_aggregation(aggregation, args, kwargs):
+        return args, normalize_path('/'.join(aggregation._collection_ref._path))
+
+    def billed_aggregation(aggregation, results):
+        # count() bills by index entries matched; sum() and avg() by documents, which go unseen here
+        # The server names unaliased aggregations field_1, field_2, ... by position
+        counts = {a.alias or f'field_{i}' for i, a in enumerate(aggregation._aggregations, 1)
+                  if isinstance(a, CountAggregation)}
+        entries = max([int(r.value) for r in results if r.alias in counts] or [0])
+        return max(-(-entries // COUNT_ENTRIES_PER_READ), 1)
+
+    wrap_stream(Query, '_make_stream', 'query', describe_query)
+    wrap_stream(Client, 'get_all', 'get_all', describe_get_all)
+    wrap_stream(AggregationQuery, '_make_stream', 'aggregate', describe_aggregation, billed_aggregation)
@@ -0,0 +1,101 @@
+import threading
+import time
+
+
+class _Group:
+    """Scans gathered for one commit, and the results their requests wait for"""
+
+    def __init__(self):
+        self.scans = []
+        self.results = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Group commit for attendance writes of concurrent requests in one process.
+
+    Each request thread calls submit() with its scan and blocks until the scan
+    has been written, getting back its own (attendance, error) result, so a
+    request behaves exactly as if it had committed alone. The first thread to
+    arrive leads a group: it waits up to `window` seconds for others to join
+    (or until `max_batch` have), writes them all with one
+    `write_batch(scans)` call, and hands every member its result.
+
+    The leader only waits while the process is busy, i.e. a commit is in
+    flight or the previous group had company; a lone scan on a quiet worker
+    is written straight away and pays no window. Under a morning burst the
+    scans that pile up behind one commit's round trip share the next one.
+
+    Only useful when a worker handles several requests at once (gunicorn
+    threads > 1); with one thread per worker every group has one scan.
+    """
+
+    def __init__(self, write_batch, window=0.01, max_batch=100, on_flush=None):
+        self.write_batch = write_batch
+        self.window = window
+        self.max_batch = max_batch
+        # Called with (group size, seconds the write took) after each flush
+        self.on_flush = on_flush
+
+        self._lock = threading.Lock()
+        self._open = None          # group accepting scans, if any
+        self._committing = 0       # groups being written right now
+        self._last_size = 1
+        self._stats = {'groups': 0, 'scans': 0, 'largest': 0, 'errors': 0}
+
+    def submit(self, scan):
+        """Write `scan` as part of the current group and return its (attendance, error)"""
+        with self._lock:
+            group = self._open
+            leader = group is None
+            if leader:
+                group = self._open = _Group()
+                busy = self._committing > 0 or self._last_size > 1
+            index = len(group.scans)
+            group.scans.append(scan)
+            if len(group.scans) >= self.max_batch:
+                # Closed; whoever arrives next starts a new group
+                self._open = None
+                group.full.set()
+
+        if not leader:
+            group.done.wait()
+            return group.results[index]
+
+        if busy:
+            group.full.wait(self.window)
+        with self._lock:
+            if self._open is group:
+                self._open = None
+            self._committing += 1
+
+        started = time.perf_counter()
+        try:
+            group.results = self.write_batch(group.scans)
+        except Exception as e:
+            print(f"Group commit of {len(group.scans)} scans failed: {e}")
+            group.results = [(None, f"Database error: {str(e)}")] * len(group.scans)
+            self._stats['errors'] += 1
+        finally:
+            with self._lock:
+                self._committing -= 1
+                self._last_size = len(group.scans)
+                self._stats['groups'] += 1
+                self._stats['scans'] += len(group.scans)
+                self._stats['largest'] = max(self._stats['largest'], len(group.scans))
+            group.done.set()
+
+        if self.on_flush is not None:
+            self.on_flush(len(group.scans), time.perf_counter() - started)
+        return group.results[index]
+
+    def stats(self):
+        with self._lock:
+            groups = self._stats['groups']
+            return {
+                **self._stats,
+                'mean_size': round(self._stats['scans'] / groups, 2) if groups else None,
+                'window_ms': self.window * 1000,
+                'max_batch': self.max_batch,
+            }
@@ -1,10 +1,95 @@
 # Gunicorn configuration for Render deployment
+import gc
+import os
+import shutil
+
+# Workers write Prometheus metrics here so /metrics can aggregate them (see metrics.py).
+# Must be set before the app, and with it prometheus_client, is imported.
+prometheus_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/nfc-attendance-metrics')
+os.makedirs(prometheus_dir, exist_ok=True)
+
+# The master preloads the app without connecting to Firestore: gRPC channels and
+# background threads do not survive fork, so each worker connects in post_fork
+os.environ.setdefault('DEFER_WORKER_INIT', '1')
+
+# One registration listener for all workers: a sidecar publishes the UID index to a
+# memory-mapped file that the workers search in place (see shared_uid_index)
+shared_uid_index = os.environ.get('STORAGE_BACKEND', 'firestore') == 'firestore' \
+    and os.environ.get('UID_CACHE_ENABLED', '1') != '0' \
+    and os.environ.get('UID_INDEX_SHARED', '1') != '0'
+if shared_uid_index:
+    os.environ.setdefault('UID_INDEX_PATH', '/tmp/nfc-attendance-uid-index.bin')
+uid_index_publisher = None
+
+# Admin jobs (migrations, imports, UID index checks) run in a process of their own rather
+# than in the workers, which max_requests recycles mid-job (see admin_jobs.RunnerProcess).
+# The memory backend cannot share jobs between processes, so its workers keep running them
+admin_job_process = os.environ.get('STORAGE_BACKEND', 'firestore') != 'memory' \
+    and os.environ.get('ADMIN_JOB_PROCESS', '1') != '0'
+os.environ['ADMIN_JOB_PROCESS'] = '1' if admin_job_process else '0'
+admin_job_runner = None
+
 bind = "0.0.0.0:10000"
 workers = 4
 worker_class = "sync"
+# More than one thread turns the workers into gthread workers, which GROUP_COMMIT=1
+# needs: concurrent scans in one worker can then share a commit (see group_commit)
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
 worker_connections = 1000
 timeout = 30
 keepalive = 2
 max_requests = 1000
 max_requests_jitter = 100
 preload_app = True
+
+def on_starting(server):
+    # Drop values left over from a previous run of the master
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir, exist_ok=True)
+
+def when_ready(server):
+    global uid_index_publisher, admin_job_runner
+    if shared_uid_index:
+        from shared_uid_index import PublisherProcess
+        uid_index_publisher = PublisherProcess(os.environ['UID_INDEX_PATH'])
+        uid_index_publisher.ensure_running()
+    if admin_job_process:
+        from admin_jobs import RunnerProcess
+        admin_job_runner = RunnerProcess()
+        admin_job_runner.ensure_running()
+
+def on_exit(server):
+    if uid_index_publisher is not None:
+        uid_index_publisher.stop()
+    if admin_job_runner is not None:
+        admin_job_runner.stop()
+
+def pre_fork(server, worker):
+    # Workers are forked often (max_requests), a cheap moment to revive a dead sidecar
+    if uid_index_publisher is not None:
+        uid_index_publisher.ensure_running()
+    if admin_job_runner is not None:
+        admin_job_runner.ensure_running()
+
+    # Never fork halfway through the app's background import of the Firebase SDK
+    import app
+    app.wait_for_libraries()
+
+    # Move the preloaded app's objects to the permanent generation so the
+    # workers' collections never write to (and un-share) those pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
+
+def worker_exit(server, worker):
+    # Leave this worker's caches for its replacement (max_requests recycles often),
+    # and write the registration status updates it has not flushed yet
+    import app
+    app.save_warm_snapshot()
+    app.flush_pending_writes()
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,92 @@
+"""Prometheus metrics for the attendance API.
+
+Under gunicorn every worker is a separate process, so metrics are written in
+prometheus_client's multiprocess mode: each worker keeps its values in files
+under PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py) and /metrics
+merges them, whichever worker serves the scrape. Without that variable, e.g.
+under the Flask dev server, the default in-process registry is used.
+"""
+import os
+import re
+import threading
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest)
+
+GROUP_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 500)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Device IDs come from the request body; keep label cardinality bounded
+MAX_DEVICE_LABELS = int(os.environ.get('METRICS_MAX_DEVICES', 64))
+_DEVICE_ID_RE = re.compile(r'^[A-Za-z0-9_.:-]{1,64}$')
+
+REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests handled',
+    ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'HTTP requests currently being handled',
+    ['method', 'route'], multiprocess_mode='livesum')
+FIRESTORE_LATENCY = Histogram(
+    'firestore_rpc_duration_seconds', 'Firestore RPC latency',
+    ['op', 'collection'], buckets=LATENCY_BUCKETS)
+SCANS = Counter(
+    'attendance_scans_total', 'Card scans by outcome and reader',
+    ['outcome', 'device_id'])
+SCAN_LATENCY = Histogram(
+    'attendance_scan_duration_seconds', 'Time to answer a reader scan',
+    ['outcome', 'device_id'], buckets=LATENCY_BUCKETS)
+GROUP_COMMIT_SIZE = Histogram(
+    'attendance_group_commit_size', 'Scans written per group commit',
+    buckets=GROUP_SIZE_BUCKETS)
+GROUP_COMMIT_LATENCY = Histogram(
+    'attendance_group_commit_duration_seconds', 'Time to write one group commit',
+    buckets=LATENCY_BUCKETS)
+
+_devices = set()
+_devices_lock = threading.Lock()
+
+
+def device_label(device_id):
+    """The device ID as a label value, or 'other' once too many have been seen"""
+    if not isinstance(device_id, str) or not _DEVICE_ID_RE.match(device_id):
+        return 'other'
+    with _devices_lock:
+        if device_id in _devices:
+            return device_id
+        if len(_devices) >= MAX_DEVICE_LABELS:
+            return 'other'
+        _devices.add(device_id)
+        return device_id
+
+
+def observe_scan(device_id, outcome, seconds=None):
+    """Count a scan (accepted, duplicate, unknown_card, invalid or error)"""
+    device = device_label(device_id)
+    SCANS.labels(outcome, device).inc()
+    if seconds is not None:
+        SCAN_LATENCY.labels(outcome, device).observe(seconds)
+
+
+def observe_firestore(op, collection, docs, seconds):
+    """firestore_trace observer: one Firestore RPC"""
+    FIRESTORE_LATENCY.labels(op, collection or 'unknown').observe(seconds)
+
+
+def observe_group_commit(size, seconds):
+    """GroupCommitter on_flush callback: one group written"""
+    GROUP_COMMIT_SIZE.observe(size)
+    GROUP_COMMIT_LATENCY.observe(seconds)
+
+
+def render():
+    """Body and content type for a /metrics response"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,50 @@
+import re
+
+# ISO/IEC 14443-3 UIDs are single (4 byte), double (7) or triple (10) size
+UID_BYTE_LENGTHS = (4, 7, 10)
+
+_SEPARATORS = re.compile(r'[\s:\-.]+')
+_HEX = re.compile(r'[0-9a-f]+')
+
+
+def normalize_uid(raw):
+    """Canonical form of a card UID, 'aa:bb:cc:dd', or None if it is not one
+
+    The readers send lowercase colon-separated bytes ('04:a2:b6:c8'), Web NFC's
+    serialNumber is the same, and people typing UIDs in also use uppercase,
+    dashes, spaces or no separators at all. Separated bytes may drop their
+    leading zero ('4:a2:b6:c8').
+    """
+    if not isinstance(raw, str):
+        return None
+    text = raw.strip().lower()
+    if text.startswith('0x'):
+        text = text[2:]
+    parts = [part for part in _SEPARATORS.split(text) if part]
+    if not parts or not all(_HEX.fullmatch(part) for part in parts):
+        return None
+
+    if len(parts) == 1:
+        digits = parts[0]
+        if len(digits) % 2:
+            return None
+        octets = [digits[i:i + 2] for i in range(0, len(digits), 2)]
+    elif all(len(part) <= 2 for part in parts):
+        octets = [part.zfill(2) for part in parts]
+    else:
+        return None
+
+    if len(octets) not in UID_BYTE_LENGTHS:
+        return None
+    return ':'.join(octets)
+
+
+def uid_spellings(raw):
+    """Spellings a card's UID may be stored under in registrations written before
+    normalization: as typed, and the forms readers and keyboards produce"""
+    uid = normalize_uid(raw)
+    spellings = [raw] if isinstance(raw, str) and raw else []
+    if uid is not None:
+        compact = uid.replace(':', '')
+        spellings += [uid, uid.upper(), compact, compact.upper()]
+    return list(dict.fromkeys(spellings))
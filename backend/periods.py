@@ -0,0 +1,75 @@
+from datetime import date as date_cls, datetime, timedelta
+
+# Coarser granularities roll up whole days: ISO weeks, calendar months and years
+GRANULARITIES = ('day', 'week', 'month', 'year')
+
+
+def _parse(date):
+    return datetime.strptime(date, "%Y-%m-%d").date()
+
+
+def period_of(date, granularity):
+    """ID of the period containing `date`: '2026-10-17', '2026-W42', '2026-10' or '2026'"""
+    day = _parse(date)
+    if granularity == 'day':
+        return date
+    if granularity == 'week':
+        iso_year, iso_week, _ = day.isocalendar()
+        return f"{iso_year}-W{iso_week:02d}"
+    if granularity == 'month':
+        return day.strftime("%Y-%m")
+    if granularity == 'year':
+        return day.strftime("%Y")
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+def period_bounds(period, granularity):
+    """First and last date (inclusive) of a period ID from period_of()"""
+    if granularity == 'day':
+        return period, period
+    if granularity == 'week':
+        iso_year, iso_week = period.split('-W')
+        start = date_cls.fromisocalendar(int(iso_year), int(iso_week), 1)
+        end = start + timedelta(days=6)
+    elif granularity == 'month':
+        start = datetime.strptime(period, "%Y-%m").date()
+        end = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    elif granularity == 'year':
+        start = date_cls(int(period), 1, 1)
+        end = date_cls(int(period), 12, 31)
+    else:
+        raise ValueError(f"Unknown granularity: {granularity}")
+    return start.isoformat(), end.isoformat()
+
+
+def periods_between(start_date, end_date, granularity):
+    """IDs of the periods overlapping [start_date, end_date], in order"""
+    periods = []
+    day = _parse(start_date)
+    end = _parse(end_date)
+    while day <= end:
+        period = period_of(day.isoformat(), granularity)
+        periods.append(period)
+        day = _parse(period_bounds(period, granularity)[1]) + timedelta(days=1)
+    return periods
+
+
+def choose_granularity(start_date, end_date, max_buckets):
+    """The finest granularity that spans the range in at most `max_buckets` periods"""
+    for granularity in GRANULARITIES:
+        if len(periods_between(start_date, end_date, granularity)) <= max_buckets:
+            return granularity
+    return GRANULARITIES[-1]
+
+
+def aggregate(days, granularity):
+    """Fold [{'date', 'count'}] day summaries into [{'period', 'start', 'end', 'count'}]"""
+    totals = {}
+    for day in days:
+        period = period_of(day['date'], granularity)
+        totals[period] = totals.get(period, 0) + day['count']
+    results = []
+    for period in sorted(totals):
+        start, end = period_bounds(period, granularity)
+        results.append({'period': period, 'start': start, 'end': end, 'count': totals[period]})
+    return results
@@ -0,0 +1,104 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# What a worker needs to accept a scan from a card registered elsewhere
+FEED_FIELDS = ('id', 'nfc_uid', 'name', 'department')
+
+
+class RegistrationFeed:
+    """Registrations made through the API, handed from the worker that wrote them to the others.
+
+    A worker's UID cache otherwise learns about a new card from its Firestore
+    listener (or the shared index publisher), a second or so after the write,
+    and a card tapped within that window would be turned away. The worker that
+    registered it appends the users to an SQLite file every worker shares; a
+    worker whose lookup misses reads what was appended since it last looked
+    and passes it to storage.remember_users() before giving up on the card.
+
+    Entries older than `retention` seconds are pruned, by which time every
+    listener has delivered them.
+    """
+
+    def __init__(self, path, retention=600.0):
+        self.path = path
+        self.retention = retention
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cursor = 0
+        self._pid = None
+        self._stats = {'published': 0, 'received': 0, 'polls': 0, 'errors': 0}
+        self._init_db()
+
+    def _conn(self):
+        # sqlite3 connections are per thread (and must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        self._conn().execute('''
+            CREATE TABLE IF NOT EXISTS registrations (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                published_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )
+        ''')
+
+    def publish(self, users):
+        """Announce newly registered users to every worker"""
+        if not users:
+            return
+        now = time.time()
+        rows = [(now, json.dumps({f: user[f] for f in FEED_FIELDS if f in user})) for user in users]
+        try:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT INTO registrations (published_at, data) VALUES (?, ?)', rows)
+                conn.execute('DELETE FROM registrations WHERE published_at < ?', (now - self.retention,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # The listeners still deliver the users, only later
+            print(f"Registration feed publish failed: {e}")
+            self._stats['errors'] += 1
+            return
+        self._stats['published'] += len(users)
+
+    def poll(self):
+        """Users published by any worker since this process last polled"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked worker starts from whatever is still retained
+                self._pid = os.getpid()
+                self._cursor = 0
+            cursor = self._cursor
+        try:
+            rows = self._conn().execute(
+                'SELECT seq, data FROM registrations WHERE seq > ? ORDER BY seq', (cursor,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Registration feed read failed: {e}")
+            self._stats['errors'] += 1
+            return []
+
+        with self._lock:
+            self._stats['polls'] += 1
+            if rows:
+                self._cursor = max(self._cursor, rows[-1][0])
+                self._stats['received'] += len(rows)
+        return [json.loads(data) for _, data in rows]
+
+    def stats(self):
+        return {'path': self.path, 'cursor': self._cursor, **self._stats}
@@ -0,0 +1,266 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ScanJournal:
+    """Durable local queue of accepted scans waiting to reach Firestore.
+
+    Scans are appended to an SQLite database in WAL mode and acknowledged
+    straight away; a background flusher drains them to Firestore in batches,
+    backing off while Firestore is unavailable. Rows stay in the journal until
+    the flusher has committed them, so anything still pending when the process
+    stops is replayed on the next start. Several gunicorn workers can share one
+    journal file: each flusher claims rows with a lease before writing them.
+
+    `flush_fn` receives a list of scan dicts and returns one status per scan:
+    'committed', 'duplicate' (final, nothing to write) or 'retry'.
+
+    Every retry, and every flush that raises, counts as an attempt for the
+    scans involved. After `max_attempts` a scan is moved to the 'failed' state
+    and no longer claimed, so one scan Firestore keeps refusing cannot hold
+    up the rest of the journal. Failed rows are kept (prune() leaves them)
+    and counted in stats(); requeue_failed() puts them back once the cause
+    is fixed. The default allows for an outage of about three quarters of
+    an hour at the maximum backoff.
+    """
+
+    def __init__(self, path, flush_fn, batch_size=200, interval=0.5,
+                 max_backoff=60.0, lease_seconds=120, max_attempts=50):
+        self.path = path
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats = {
+            'appended': 0,
+            'committed': 0,
+            'duplicates': 0,
+            'retries': 0,
+            'given_up': 0,
+            'flush_errors': 0,
+            'replayed': 0,
+            'last_flush_at': None,
+            'last_commit_lag': None,
+        }
+        self._init_db()
+
+    def _conn(self):
+        # sqlite3 connections are per thread (and must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS scans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                received_at REAL NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_by INTEGER,
+                claimed_until REAL,
+                committed_at REAL
+            )
+        ''')
+        # One journaled check-in per user per day, matching the Firestore record ID
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS scans_date_user ON scans (date, user_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS scans_state ON scans (state, id)')
+
+    # Producer side
+    def append(self, date, user_id, scan):
+        """Journal a scan. Returns False if this user is already journaled for `date`"""
+        self.ensure_started()
+        try:
+            self._conn().execute(
+                'INSERT INTO scans (date, user_id, payload, received_at) VALUES (?, ?, ?, ?)',
+                (date, user_id, json.dumps(scan, default=str), time.time())
+            )
+        except sqlite3.IntegrityError:
+            return False
+        self._stats['appended'] += 1
+        self._wake.set()
+        return True
+
+    # Flusher side
+    def ensure_started(self):
+        """Start this process's flusher thread if it is not running yet"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._stats['replayed'] = self._count('pending')
+        if self._stats['replayed']:
+            print(f"Scan journal: replaying {self._stats['replayed']} uncommitted scans")
+        self._thread = threading.Thread(target=self._run, name='scan-journal-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the flusher after its current batch"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        backoff = self.interval
+        last_prune = 0.0
+        while not self._stop.is_set():
+            if time.time() - last_prune > 3600:
+                # Committed rows are only needed for today's duplicate check
+                last_prune = time.time()
+                try:
+                    self.prune(time.strftime('%Y-%m-%d', time.gmtime(last_prune - 86400)))
+                except Exception as e:
+                    print(f"Scan journal prune failed: {e}")
+
+            try:
+                flushed = self.flush_once()
+                backoff = self.interval
+            except Exception as e:
+                self._stats['flush_errors'] += 1
+                print(f"Scan journal flush failed, retrying in {backoff:.1f}s: {e}")
+                flushed = 0
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            if flushed < self.batch_size:
+                # Caught up: sleep until the next append or the poll interval
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+    def _claim(self):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                '''SELECT id, payload, received_at FROM scans
+                   WHERE state = 'pending' AND (claimed_until IS NULL OR claimed_until < ?)
+                   ORDER BY id LIMIT ?''',
+                (now, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    'UPDATE scans SET claimed_by = ?, claimed_until = ? WHERE id = ?',
+                    [(os.getpid(), now + self.lease_seconds, row[0]) for row in rows]
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def flush_once(self):
+        """Drain one batch to Firestore. Returns the number of rows handled"""
+        rows = self._claim()
+        if not rows:
+            return 0
+
+        try:
+            statuses = self.flush_fn([json.loads(payload) for _, payload, _ in rows])
+        except Exception:
+            self._release([row[0] for row in rows], attempted=True)
+            raise
+
+        now = time.time()
+        done = []
+        retry = []
+        for (row_id, _, received_at), status in zip(rows, statuses):
+            if status == 'committed':
+                done.append((now, row_id))
+                self._stats['committed'] += 1
+                self._stats['last_commit_lag'] = round(now - received_at, 3)
+            elif status == 'duplicate':
+                done.append((now, row_id))
+                self._stats['duplicates'] += 1
+            else:
+                retry.append(row_id)
+
+        conn = self._conn()
+        conn.executemany(
+            "UPDATE scans SET state = 'committed', committed_at = ?, claimed_by = NULL, claimed_until = NULL WHERE id = ?",
+            done
+        )
+        if retry:
+            self._stats['retries'] += len(retry)
+            self._release(retry, attempted=True)
+        self._stats['last_flush_at'] = now
+        if retry and not done:
+            raise RuntimeError(f"{len(retry)} scans could not be committed")
+        return len(rows)
+
+    def _release(self, row_ids, attempted=False):
+        conn = self._conn()
+        conn.executemany(
+            'UPDATE scans SET claimed_by = NULL, claimed_until = NULL, attempts = attempts + ? WHERE id = ?',
+            [(1 if attempted else 0, row_id) for row_id in row_ids]
+        )
+        if not attempted:
+            return
+        given_up = 0
+        for row_id in row_ids:
+            cur = conn.execute(
+                "UPDATE scans SET state = 'failed' WHERE id = ? AND state = 'pending' AND attempts >= ?",
+                (row_id, self.max_attempts)
+            )
+            given_up += cur.rowcount
+        if given_up:
+            self._stats['given_up'] += given_up
+            print(f"Scan journal: gave up on {given_up} scans after {self.max_attempts} attempts")
+
+    def requeue_failed(self):
+        """Return failed scans to the queue with a fresh attempt count. Returns how many"""
+        cur = self._conn().execute(
+            "UPDATE scans SET state = 'pending', attempts = 0 WHERE state = 'failed'"
+        )
+        if cur.rowcount:
+            self._wake.set()
+        return cur.rowcount
+
+    def prune(self, before_date):
+        """Drop committed rows for days before `before_date` (YYYY-MM-DD)"""
+        cur = self._conn().execute(
+            "DELETE FROM scans WHERE state = 'committed' AND date < ?", (before_date,)
+        )
+        return cur.rowcount
+
+    # Metrics
+    def _count(self, state):
+        return self._conn().execute('SELECT COUNT(*) FROM scans WHERE state = ?', (state,)).fetchone()[0]
+
+    def stats(self):
+        """Journal depth, flush lag, replay and failure counters"""
+        conn = self._conn()
+        depth, oldest = conn.execute(
+            "SELECT COUNT(*), MIN(received_at) FROM scans WHERE state = 'pending'"
+        ).fetchone()
+        return {
+            **self._stats,
+            'depth': depth,
+            'flush_lag_seconds': round(time.time() - oldest, 3) if oldest else 0.0,
+            'failed': self._count('failed'),
+            'max_attempts': self.max_attempts,
+            'flusher_alive': self._thread is not None and self._thread.is_alive() and self._pid == os.getpid(),
+            'path': self.path,
+        }
@@ -0,0 +1,376 @@
+"""One registration listener for every gunicorn worker.
+
+A sidecar process (started by the gunicorn master, see gunicorn.conf.py)
+runs the only `registration` listener and publishes the UID -> user table to
+a file at UID_INDEX_PATH. Workers map that file read-only and binary-search it
+in place, so the table lives once in the page cache instead of once per
+worker, and Firestore bills one listener instead of one per worker.
+
+File layout (little-endian), one generation per file:
+
+    header   magic 'UIDX', format, entry count, generation, published_at,
+             length of the msgpack metadata that follows (the registration
+             version used for ETags)
+    entries  per UID (normalized), sorted by its UTF-8 bytes: offset and length of the
+             UID, offset and length of its msgpack-packed user
+    data     the UIDs and packed users the entries point into
+
+The publisher writes each generation to a temporary file and renames it over
+the old one, so a worker maps either the old or the new table and never a
+mix. Workers notice the new inode on their next lookup; a mapping they still
+hold keeps the old generation alive until it is dropped. The publisher
+touches the file every few seconds while its listener is healthy, and a
+worker that finds it older than `stale_after` falls back to querying
+Firestore, as UidCache does before it is warm.
+"""
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import msgpack
+
+from nfc_uid import normalize_uid
+from uid_cache import UidCache
+from warm_snapshot import msgpack_default
+
+MAGIC = b'UIDX'
+FORMAT = 1
+
+# magic, format, entry count, generation, published_at, metadata length
+HEADER = struct.Struct('<4sIIQdI')
+
+# UID offset, UID length, user offset, user length
+ENTRY = struct.Struct('<IHII')
+
+# How long a worker answers for a card it was told about before the table has it
+REMEMBER_SECONDS = 60.0
+
+
+def write_table(path, users, generation, version=None):
+    """Publish `users` (dicts with 'id' and 'nfc_uid') as a new generation at `path`"""
+    keyed = ((normalize_uid(user.get('nfc_uid')), user) for user in users)
+    items = sorted(
+        (uid.encode(), msgpack.packb(user, datetime=True, default=msgpack_default))
+        for uid, user in keyed if uid is not None
+    )
+    meta = msgpack.packb({'version': version})
+    data_start = HEADER.size + len(meta) + ENTRY.size * len(items)
+
+    entries = bytearray()
+    data = bytearray()
+    for uid, user in items:
+        uid_offset = data_start + len(data)
+        data += uid
+        user_offset = data_start + len(data)
+        data += user
+        entries += ENTRY.pack(uid_offset, len(uid), user_offset, len(user))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, len(items), generation, time.time(), len(meta)))
+        f.write(meta)
+        f.write(entries)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class UidTable:
+    """One published generation, mapped read-only and searched without unpacking it"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, file_format, self.count, self.generation, self.published_at, meta_length = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError(f"{path} is not a UID index (format {FORMAT})")
+        self.version = msgpack.unpackb(self._map[HEADER.size:HEADER.size + meta_length]).get('version')
+        self._entries = HEADER.size + meta_length
+
+    def get(self, nfc_uid):
+        """The user registered for the normalized UID `nfc_uid`, or None"""
+        key = nfc_uid.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            uid_offset, uid_length, user_offset, user_length = \
+                ENTRY.unpack_from(self._map, self._entries + mid * ENTRY.size)
+            uid = self._map[uid_offset:uid_offset + uid_length]
+            if uid < key:
+                lo = mid + 1
+            elif uid > key:
+                hi = mid
+            else:
+                return msgpack.unpackb(self._map[user_offset:user_offset + user_length], timestamp=3)
+        return None
+
+
+class SharedUidIndex:
+    """Worker side: UidCache's interface over the table the sidecar publishes"""
+
+    def __init__(self, collection_ref, path, negative_ttl=30.0, warm_timeout=10.0, stale_after=30.0,
+                 fallback=None):
+        self.collection_ref = collection_ref
+        self.fallback = fallback
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self.warm_timeout = warm_timeout
+        self.stale_after = stale_after
+
+        self._lock = threading.Lock()
+        self._table = None
+        self._negative = {}  # normalized nfc_uid -> expiry (monotonic), only used while the table is stale
+        self._recent = {}    # normalized nfc_uid -> (user, expiry), registered but maybe not published yet
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'fallback_queries': 0,
+            'generations_mapped': 0,
+            'map_errors': 0,
+            'remembered': 0,
+            'remembered_hits': 0,
+        }
+
+    def start(self, wait=True):
+        if wait:
+            self.wait_warm()
+
+    def wait_warm(self, timeout=None):
+        """Block until a live table has been published (up to warm_timeout). Returns whether it has"""
+        deadline = time.monotonic() + (self.warm_timeout if timeout is None else timeout)
+        while self._current() is None:
+            if time.monotonic() >= deadline:
+                print("Shared UID index not published yet, falling back to queries until it is")
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _current(self):
+        """The live table, remapped if a new generation was published, or None if stale"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if time.time() - st.st_mtime > self.stale_after:
+            return None
+
+        table = self._table
+        if table is None or table.inode != st.st_ino:
+            try:
+                table = UidTable(self.path)
+            except (OSError, ValueError) as e:
+                print(f"Shared UID index could not be mapped: {e}")
+                self._stats['map_errors'] += 1
+                return None
+            with self._lock:
+                self._table = table
+                self._negative.clear()
+                self._stats['generations_mapped'] += 1
+        return table
+
+    def lookup(self, nfc_uid):
+        """Return the user registered for `nfc_uid`, or None"""
+        key = normalize_uid(nfc_uid)
+        if key is None:
+            with self._lock:
+                self._stats['negative_hits'] += 1
+            return None
+
+        table = self._current()
+        if table is not None:
+            user = table.get(key)
+            if user is None:
+                user = self._recently_registered(key)
+                if user is not None:
+                    return user
+            with self._lock:
+                self._stats['hits' if user is not None else 'negative_hits'] += 1
+            return user
+
+        with self._lock:
+            expiry = self._negative.get(key)
+            if expiry is not None:
+                if expiry > time.monotonic():
+                    self._stats['negative_hits'] += 1
+                    return None
+                del self._negative[key]
+            self._stats['misses'] += 1
+            self._stats['fallback_queries'] += 1
+
+        if self.fallback is not None:
+            user = self.fallback(nfc_uid)
+        else:
+            user = next(({**doc.to_dict(), 'id': doc.id} for doc in
+                         self.collection_ref.where('nfc_uid', '==', nfc_uid).limit(1).get()), None)
+        if user is None:
+            with self._lock:
+                self._negative[key] = time.monotonic() + self.negative_ttl
+        return user
+
+    def remember(self, users):
+        """Answer for users registered through the API until the publisher includes them"""
+        expiry = time.monotonic() + REMEMBER_SECONDS
+        with self._lock:
+            for user in users:
+                uid = normalize_uid(user.get('nfc_uid'))
+                if uid is None:
+                    continue
+                self._recent[uid] = (dict(user), expiry)
+                self._negative.pop(uid, None)
+                self._stats['remembered'] += 1
+
+    def _recently_registered(self, key):
+        with self._lock:
+            found = self._recent.get(key)
+            if found is None:
+                return None
+            user, expiry = found
+            if expiry <= time.monotonic():
+                del self._recent[key]
+                return None
+            self._stats['remembered_hits'] += 1
+            return dict(user)
+
+    def invalidate(self, nfc_uid=None):
+        """Forget negative entries so the next fallback lookup re-checks Firestore"""
+        with self._lock:
+            if nfc_uid is None:
+                self._negative.clear()
+            else:
+                self._negative.pop(normalize_uid(nfc_uid), None)
+
+    def version(self):
+        """Registration version the live table was built from, or None if it is stale"""
+        table = self._current()
+        return table.version if table is not None else None
+
+    # The table already outlives the worker; nothing to carry in a warm snapshot
+    def export_state(self):
+        return None
+
+    def import_state(self, users):
+        return False
+
+    def stats(self):
+        table = self._current()
+        with self._lock:
+            return {
+                **self._stats,
+                'shared': True,
+                'listening': table is not None,
+                'ready': table is not None,
+                'size': table.count if table is not None else 0,
+                'generation': table.generation if table is not None else None,
+                'negative_size': len(self._negative),
+                'seconds_since_publish': round(time.time() - table.published_at, 3) if table is not None else None,
+            }
+
+
+class UidIndexPublisher:
+    """Sidecar side: one registration listener, republished to `path` whenever it changes"""
+
+    def __init__(self, collection_ref, path, heartbeat=5.0, debounce=0.2, warm_timeout=10.0):
+        self.path = path
+        self.heartbeat = heartbeat
+        self.debounce = debounce
+        self._changed = threading.Event()
+        self.cache = UidCache(collection_ref, warm_timeout=warm_timeout, on_change=self._changed.set)
+
+    def _last_generation(self):
+        try:
+            return UidTable(self.path).generation
+        except (OSError, ValueError):
+            return 0
+
+    def run(self):
+        generation = self._last_generation()
+        published = None
+        self.cache.start(wait=False)
+        attached = time.monotonic()
+        while True:
+            if self._changed.wait(self.heartbeat):
+                # Let a burst of registration changes land in one generation
+                time.sleep(self.debounce)
+                self._changed.clear()
+
+            users = self.cache.export_state()
+            if users is None:
+                # Not warm yet, or the listener died: stop the heartbeat so workers fall
+                # back to queries, and reattach if it has been down for a while
+                if time.monotonic() - attached > 3 * self.cache.warm_timeout:
+                    print("UID index publisher: listener down, reattaching")
+                    self.cache.stop()
+                    self.cache.start(wait=False)
+                    attached = time.monotonic()
+                continue
+
+            version = self.cache.version()
+            if version != published:
+                generation += 1
+                write_table(self.path, users, generation, version)
+                published = version
+                print(f"UID index publisher: generation {generation}, {len(users)} users")
+            else:
+                os.utime(self.path)
+
+
+class PublisherProcess:
+    """The publisher as a child of the gunicorn master
+
+    It runs in a fresh interpreter rather than a fork, so the master never
+    creates the gRPC channel its workers would inherit.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._proc = None
+
+    def ensure_running(self):
+        """Start the publisher, or restart it if it has exited"""
+        if self._proc is not None:
+            code = self._proc.poll()
+            if code is None:
+                return
+            print(f"UID index publisher exited with {code}, restarting")
+        env = {**os.environ, 'UID_INDEX_PATH': self.path}
+        self._proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    def stop(self, timeout=5.0):
+        if self._proc is None or self._proc.poll() is not None:
+            return
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+
+
+def main():
+    from storage.firestore_backend import firestore_client
+
+    try:
+        db = firestore_client()
+    except Exception as e:
+        # Workers fall back to querying Firestore themselves; the master retries us later
+        print(f"UID index publisher could not connect to Firestore: {e}")
+        sys.exit(1)
+
+    publisher = UidIndexPublisher(
+        db.collection('registration'),
+        os.environ['UID_INDEX_PATH'],
+        heartbeat=float(os.environ.get('UID_INDEX_HEARTBEAT', 5)),
+        warm_timeout=float(os.environ.get('UID_CACHE_WARM_TIMEOUT', 10))
+    )
+    publisher.run()
+
+
+if __name__ == '__main__':
+    main()
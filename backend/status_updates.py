@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+
+from storage.base import is_newer
+
+# Firestore caps a single commit at 500 writes
+MAX_BATCH_WRITES = 500
+
+
+class StatusUpdates:
+    """Registration status and last-seen updates, coalesced and written off the scan path.
+
+    Every accepted scan used to update registration/{user_id} inside its own
+    commit: a commit that failed outright if the registration had been
+    deleted, and a change event for every registration listener. Scans now
+    record() the user here once their commit has succeeded, and a background
+    thread writes the pending updates every `interval` seconds in batches of
+    up to 500. Only the newest timestamp per user is kept. With an interval of
+    0 each update is written by record() itself.
+
+    This does not make status cheaper in Firestore terms: a user has at most
+    one accepted scan a day, so coalescing rarely merges live scans and each
+    still costs one registration write. What it saves is a batch's or
+    journal's several days of one user, which become a single write.
+
+    Updates never move a registration backwards. A live scan, stamped by the
+    server as it arrived, is always the user's newest and is written blind,
+    without a read. A backdated scan (an offline reader's batch, a replayed
+    journal entry) costs a read as well: registrations whose stored timestamp
+    is already as new are skipped, and each update carries a last_update_time
+    precondition so that one racing another worker's write fails and is
+    retried against the fresh value.
+
+    Updates still pending when a worker exits are written by flush(), which
+    gunicorn's worker_exit hook calls; a hard kill loses at most `interval`
+    seconds of last-seen times, never an attendance record.
+    """
+
+    def __init__(self, db, collection='registration', interval=2.0):
+        self.db = db
+        self.collection = collection
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pending = {}  # user id -> (newest scan timestamp not yet written, whether it was live)
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats = {'recorded': 0, 'written': 0, 'checked': 0, 'not_newer': 0, 'missing_users': 0,
+                       'flush_errors': 0, 'last_flush_at': None}
+
+    def ensure_started(self):
+        if self.interval <= 0:
+            return
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        if self._pid != os.getpid():
+            # Forked child: the parent's updates are the parent's to write
+            self._pending = {}
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='status-updates', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def record(self, user_id, timestamp, live=False):
+        """Queue 'present as of `timestamp`' for a user whose scan was just committed
+
+        `live` marks a scan stamped by the server on arrival, which no stored
+        timestamp can be newer than.
+        """
+        with self._lock:
+            current = self._pending.get(user_id)
+            if current is None or current[0] < timestamp:
+                self._pending[user_id] = (timestamp, live)
+            self._stats['recorded'] += 1
+        if self.interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """Write every pending update now. Returns how many were written"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        items = [(user_id, timestamp, live) for user_id, (timestamp, live) in pending.items()]
+        written = 0
+        for start in range(0, len(items), MAX_BATCH_WRITES):
+            chunk = items[start:start + MAX_BATCH_WRITES]
+            try:
+                written += self._write(chunk)
+            except Exception as e:
+                # A registration changed under us (or was deleted); find it one update at a time
+                print(f"Status update batch failed, retrying individually: {e}")
+                written += self._write_each(chunk)
+        with self._lock:
+            self._stats['written'] += written
+            self._stats['last_flush_at'] = time.time()
+        return written
+
+    def _write(self, updates):
+        """Write the live updates, and the backdated ones newer than what is stored, in one commit"""
+        refs = {user_id: self.db.collection(self.collection).document(user_id) for user_id, _, _ in updates}
+        backdated = [refs[user_id] for user_id, _, live in updates if not live]
+        snapshots = {snapshot.id: snapshot for snapshot in (self.db.get_all(backdated) if backdated else [])}
+
+        batch = self.db.batch()
+        written = not_newer = missing = 0
+        for user_id, timestamp, live in updates:
+            if live:
+                batch.update(refs[user_id], {'status': 'present', 'timestamp': timestamp})
+                written += 1
+                continue
+            snapshot = snapshots.get(user_id)
+            if snapshot is None or not snapshot.exists:
+                missing += 1
+                continue
+            if not is_newer(timestamp, (snapshot.to_dict() or {}).get('timestamp')):
+                not_newer += 1
+                continue
+            batch.update(refs[user_id], {'status': 'present', 'timestamp': timestamp},
+                         option=self.db.write_option(last_update_time=snapshot.update_time))
+            written += 1
+        if written:
+            batch.commit()
+        with self._lock:
+            self._stats['checked'] += len(backdated)
+            self._stats['not_newer'] += not_newer
+            self._stats['missing_users'] += missing
+        return written
+
+    def _write_each(self, updates):
+        from google.api_core.exceptions import NotFound  # already loaded by the backend's connect()
+
+        written = 0
+        for user_id, timestamp, live in updates:
+            try:
+                written += self._write([(user_id, timestamp, live)])
+            except NotFound:
+                # A live update for a registration deleted since its scan
+                with self._lock:
+                    self._stats['missing_users'] += 1
+            except Exception as e:
+                print(f"Status update for {user_id} failed: {e}")
+                with self._lock:
+                    self._stats['flush_errors'] += 1
+                    # Retried next pass (read first), unless a newer scan has replaced it
+                    if user_id not in self._pending:
+                        self._pending[user_id] = (timestamp, False)
+        return written
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'pending': len(self._pending), 'interval': self.interval}
@@ -0,0 +1,53 @@
+"""Storage backends for the attendance API.
+
+STORAGE_BACKEND selects the implementation:
+
+- ``firestore`` (default): Cloud Firestore, configured as before through
+  FIREBASE_CONFIG_PATH or the FIREBASE_* variables.
+- ``memory``: per-process dicts. MEMORY_LATENCY_MS, MEMORY_LATENCY_JITTER_MS,
+  MEMORY_LATENCY_TAIL_MS and MEMORY_LATENCY_TAIL_P add simulated RPC latency.
+- ``sqlite``: a local database file at SQLITE_PATH, shared by all workers.
+
+STORAGE_SEED_USERS may point at a JSON list of users (each with 'id' and
+'nfc_uid') to load into a local backend at startup.
+"""
+import json
+import os
+
+from .base import DUPLICATE_ERROR, DUPLICATE_UID_ERROR, INVALID_UID_ERROR, StorageBackend
+
+
+def create_storage(name=None):
+    """Build the backend named by `name` or STORAGE_BACKEND"""
+    name = name or os.environ.get('STORAGE_BACKEND', 'firestore')
+
+    # Backends are imported on demand so local runs do not need the Firebase SDK
+    if name == 'firestore':
+        from .firestore_backend import FirestoreBackend
+        return FirestoreBackend()
+
+    if name == 'memory':
+        from .memory_backend import LatencyModel, MemoryBackend
+        storage = MemoryBackend(LatencyModel(
+            base_ms=float(os.environ.get('MEMORY_LATENCY_MS', 0)),
+            jitter_ms=float(os.environ.get('MEMORY_LATENCY_JITTER_MS', 0)),
+            tail_ms=float(os.environ.get('MEMORY_LATENCY_TAIL_MS', 0)),
+            tail_probability=float(os.environ.get('MEMORY_LATENCY_TAIL_P', 0))
+        ))
+    elif name == 'sqlite':
+        from .sqlite_backend import SQLiteBackend
+        storage = SQLiteBackend(os.environ.get('SQLITE_PATH', 'attendance.db'))
+    else:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {name}")
+
+    seed_path = os.environ.get('STORAGE_SEED_USERS')
+    if seed_path:
+        with open(seed_path) as f:
+            results = storage.add_users(json.load(f))
+        rejected = [error for _, error in results if error]
+        print(f"Seeded {storage.name} storage from {seed_path}"
+              + (f" ({len(rejected)} users rejected: {rejected[0]})" if rejected else ""))
+    return storage
+
+
+__all__ = ['DUPLICATE_ERROR', 'DUPLICATE_UID_ERROR', 'INVALID_UID_ERROR', 'StorageBackend', 'create_storage']
@@ -0,0 +1,361 @@
+import threading
+import time
+from datetime import datetime
+
+import pytz
+
+from nfc_uid import normalize_uid
+
+DUPLICATE_ERROR = "Attendance already recorded for today"
+DUPLICATE_UID_ERROR = "NFC UID already registered to another user"
+INVALID_UID_ERROR = "Not a valid NFC UID"
+
+# Offending ids kept per kind in a UID index check report
+UID_CHECK_EXAMPLES = 10
+
+# Legacy attendance records migrated per checkpointed page
+MIGRATION_PAGE_SIZE = 500
+
+# Recent admin jobs searched for active ones by backends that cannot query by status
+ACTIVE_JOB_SCAN_LIMIT = 100
+
+
+class StorageBackend:
+    """Operations the API performs against its database.
+
+    Routes in app.py only talk to this interface, so the same handlers can run
+    against Firestore in production or against a local backend for benchmarks
+    and load tests. Scans passed to the attendance methods are dicts with
+    'user' (at least 'id' and 'name'), 'nfc_uid', 'device_id', 'timestamp'
+    (an aware UTC datetime) and optionally 'received_at', set when the scan
+    was stamped by a reader rather than by the server on arrival.
+
+    Attendance writes report failures as (None, error) tuples rather than
+    raising, mirroring the original record_attendance helper; everything else
+    raises and leaves error reporting to the route.
+    """
+
+    name = 'base'
+
+    _ops = threading.local()
+
+    @property
+    def connected(self):
+        return True
+
+    # Process lifecycle
+    def load_libraries(self):
+        """Import the client libraries connect() needs
+
+        app.py calls this on a background thread at startup, so a heavy SDK
+        loads while the server binds its port rather than before.
+        """
+
+    def connect(self):
+        """Open connections and start background work for this process
+
+        Called once per worker process, after any fork. Local backends open
+        their connections lazily and have nothing to do here.
+        """
+
+    def warmup(self):
+        """Make a test read so the first real request does not pay for a cold connection"""
+        started = time.perf_counter()
+        self.users_page(limit=1, fields=['nfc_uid'])
+        return {'test_read_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+    # Process-local caches carried across restarts by warm_snapshot
+    def export_warm_state(self):
+        """msgpack-able copy of this process's caches, or None if it keeps none worth saving"""
+        return None
+
+    def import_warm_state(self, state, saved_at):
+        """Seed caches from an export_warm_state() taken at `saved_at`; warmup() reconciles them"""
+
+    def flush_pending(self):
+        """Write anything this process still holds back from the database, e.g. as it exits"""
+
+    def pending_stats(self):
+        """Counters of writes held back and written later, or None if this backend writes everything inline"""
+        return None
+
+    # Per-request accounting of storage round trips
+    def begin_request(self):
+        self._ops.count = 0
+
+    def request_ops(self):
+        """Round trips made since begin_request() on this thread, or None if not counted"""
+        return getattr(self._ops, 'count', None)
+
+    def end_request(self, route):
+        """Finish per-request accounting; backends with tracing return the trace"""
+        return None
+
+    def cost_report(self):
+        """Per-route database cost totals, or None if this backend does not trace"""
+        return None
+
+    def _rpc(self):
+        """Called once per round trip to the database"""
+        if getattr(self._ops, 'count', None) is not None:
+            self._ops.count += 1
+
+    # Users
+    def get_user_by_uid(self, nfc_uid):
+        """Return the user registered for `nfc_uid` (with 'id'), or None"""
+        raise NotImplementedError
+
+    def get_users_by_uids(self, nfc_uids):
+        """Resolve many UIDs at once, returning {nfc_uid: user} for the known ones"""
+        users = {}
+        for nfc_uid in set(nfc_uids):
+            user = self.get_user_by_uid(nfc_uid)
+            if user:
+                users[nfc_uid] = user
+        return users
+
+    def users_page(self, start_after=None, limit=500, fields=None):
+        """Up to `limit` users ordered by id, starting after the id `start_after`
+
+        With `fields`, each user only carries those top-level fields (and 'id').
+        """
+        raise NotImplementedError
+
+    def iter_users(self, start_after=None, fields=None, page_size=500):
+        """Every user after `start_after` by id, fetched a page at a time"""
+        while True:
+            page = self.users_page(start_after, page_size, fields)
+            yield from page
+            if len(page) < page_size:
+                return
+            start_after = page[-1]['id']
+
+    def list_users(self):
+        """Return every registered user as a list of dicts with 'id'"""
+        return list(self.iter_users())
+
+    def registration_version(self):
+        """Opaque value that changes whenever any registration changes, or None if unknown"""
+        return None
+
+    def add_users(self, users):
+        """Insert or replace users (dicts with 'id' and 'nfc_uid')
+
+        UIDs are compared in normalize_uid() form: a user whose UID is not a
+        valid one, or already belongs to another user, is rejected. Returns a
+        (user, error) tuple per user, like record_attendance_batch.
+        """
+        raise NotImplementedError
+
+    def remember_users(self, users):
+        """Make users just registered by any worker resolvable here straight away
+
+        Backends whose lookups always read the database have nothing to do.
+        """
+
+    def check_uid_index(self, repair=False, job=None):
+        """Compare the UID index with the registrations it is derived from
+
+        Reports how many entries are 'missing', 'stale' (pointing at the wrong
+        user or carrying old details) or 'orphaned' (no registration has that
+        UID any more), plus UIDs shared by several users ('conflicts') and users
+        whose UID does not normalize ('invalid'), with a few 'examples' of each.
+        With `repair`, missing and stale entries are written and orphans
+        deleted; conflicts are left for a person to resolve. Returns None if
+        this backend cannot drift because it maintains its index in memory.
+        """
+        return None
+
+    # Attendance
+    def record_attendance(self, user, nfc_uid, device_id, timestamp=None, received_at=None):
+        """Record one check-in. Returns (record, None) or (None, error)"""
+        if timestamp is None:
+            timestamp = datetime.now(pytz.UTC)
+        scan = {
+            'user': user,
+            'nfc_uid': nfc_uid,
+            'device_id': device_id,
+            'timestamp': timestamp,
+            'received_at': received_at
+        }
+        return self.record_attendance_batch([scan])[0]
+
+    def record_attendance_batch(self, scans):
+        """Record many scans. Returns (record, error) tuples in order"""
+        raise NotImplementedError
+
+    def record_attendance_group(self, scans):
+        """Record the scans of concurrent requests together (see group_commit)
+
+        Same contract as record_attendance_batch, which it defaults to, but
+        meant for live scans, where a duplicate is rare.
+        """
+        return self.record_attendance_batch(scans)
+
+    def day_count(self, date):
+        """Attendance total for `date`, or None if nobody has checked in that day"""
+        raise NotImplementedError
+
+    def records_page(self, date, since=None, start_after=None, limit=500):
+        """Up to `limit` of `date`'s records (with 'id'), ordered by (timestamp, id)
+
+        `since` keeps only records stamped strictly after that datetime, and
+        `start_after` is the (timestamp, id) of the last record already seen.
+        """
+        raise NotImplementedError
+
+    def latest_record_time(self, date):
+        """Timestamp of the newest record of `date`, or None if it has none"""
+        raise NotImplementedError
+
+    def iter_records(self, date, since=None, start_after=None, page_size=500):
+        """Every matching record of `date` in (timestamp, id) order, a page at a time"""
+        while True:
+            page = self.records_page(date, since, start_after, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            start_after = (page[-1]['timestamp'], page[-1]['id'])
+
+    def daily_records(self, date):
+        """Return (count, records sorted by timestamp) for `date`"""
+        count = self.day_count(date)
+        if count is None:
+            return 0, []
+        return count, list(self.iter_records(date))
+
+    def range_summaries(self, start_date, end_date):
+        """Return [{'date', 'count'}] for days in [start_date, end_date], by date"""
+        raise NotImplementedError
+
+    def period_summaries(self, granularity, first_period, last_period):
+        """Stored week/month/year totals [{'period', 'start', 'end', 'count'}] for periods
+        in [first_period, last_period], or None if this backend does not keep them"""
+        return None
+
+    # Admin
+    def rebuild_period_rollups(self, start_date, end_date, job=None):
+        """Recompute stored period totals over a range. Returns periods written, or None if not kept"""
+        return None
+
+    # Admin operations run as background jobs (see admin_jobs). `job`, when given,
+    # is throttled with job.throttle(ops) and checkpointed with job.checkpoint(progress)
+    def migrate_attendance(self, job=None):
+        """Move flat legacy attendance records under their date
+
+        Records already under their date are skipped and only the records this
+        run creates are added to the day counts, so running it again changes
+        nothing. Resumes from job.progress if it holds an interrupted run's
+        checkpoint. Returns the final progress, including 'migrated', 'skipped'
+        and 'failed'.
+        """
+        raise NotImplementedError
+
+    def cleanup_departments(self, job=None):
+        """Drop the legacy `departments` field from date summaries. Returns {'cleaned', 'failed'}"""
+        raise NotImplementedError
+
+    # Background job state, visible to every worker
+    def load_job_state(self, job_id):
+        """Saved state dict of admin job `job_id`, or None"""
+        raise NotImplementedError
+
+    def save_job_state(self, job_id, changes):
+        """Merge `changes` into the saved state of admin job `job_id`, creating it if needed"""
+        raise NotImplementedError
+
+    def list_job_states(self, limit):
+        """The `limit` most recently created admin job states, newest first"""
+        raise NotImplementedError
+
+    def list_active_job_states(self):
+        """Admin job states still saved as queued or running, including those of dead processes"""
+        return [state for state in self.list_job_states(ACTIVE_JOB_SCAN_LIMIT)
+                if state.get('status') in ('queued', 'running')]
+
+    # Introspection
+    def cache_stats(self):
+        """UID cache counters, or None if this backend has no cache"""
+        return None
+
+
+def project(user, fields):
+    """`user` reduced to `fields` (plus 'id'), or unchanged if fields is None"""
+    if fields is None:
+        return user
+    return {'id': user['id'], **{f: user[f] for f in fields if f in user}}
+
+
+def is_newer(timestamp, stored):
+    """Whether a scan at `timestamp` may replace a registration's stored status `timestamp`
+
+    Status only moves forward, so a backdated scan (an offline reader's
+    backlog, a retried journal entry) never overwrites a later one. A missing
+    or naive stored value is always replaced.
+    """
+    if not isinstance(stored, datetime) or stored.tzinfo is None:
+        return True
+    return timestamp > stored
+
+
+def uid_index_plan(users):
+    """The UID index `users` imply: ({uid: user}, {uid: [user ids]} shared UIDs, [invalid user ids])"""
+    owners = {}
+    invalid = []
+    for user in users:
+        uid = normalize_uid(user.get('nfc_uid'))
+        if uid is None:
+            invalid.append(user['id'])
+        else:
+            owners.setdefault(uid, []).append(user)
+    expected = {uid: found[0] for uid, found in owners.items() if len(found) == 1}
+    conflicts = {uid: sorted(user['id'] for user in found) for uid, found in owners.items() if len(found) > 1}
+    return expected, conflicts, invalid
+
+
+def uid_index_report(expected, conflicts, invalid, entries, entry_matches):
+    """Diff the implied index against the stored `entries` ({uid: entry})
+
+    `entry_matches(entry, user)` says whether a stored entry is current.
+    Returns (report, missing uids, stale uids, orphaned uids); UIDs in
+    `conflicts` count as neither stale nor orphaned.
+    """
+    missing = [uid for uid in expected if uid not in entries]
+    stale = [uid for uid, entry in entries.items()
+             if uid in expected and not entry_matches(entry, expected[uid])]
+    orphaned = [uid for uid in entries if uid not in expected and uid not in conflicts]
+    report = {
+        'users': len(expected) + sum(len(ids) for ids in conflicts.values()) + len(invalid),
+        'entries': len(entries),
+        'missing': len(missing),
+        'stale': len(stale),
+        'orphaned': len(orphaned),
+        'conflicts': len(conflicts),
+        'invalid': len(invalid),
+        'examples': {
+            'missing': sorted(missing)[:UID_CHECK_EXAMPLES],
+            'stale': sorted(stale)[:UID_CHECK_EXAMPLES],
+            'orphaned': sorted(orphaned)[:UID_CHECK_EXAMPLES],
+            'conflicts': dict(sorted(conflicts.items())[:UID_CHECK_EXAMPLES]),
+            'invalid': sorted(invalid)[:UID_CHECK_EXAMPLES],
+        },
+    }
+    return report, missing, stale, orphaned
+
+
+def attendance_record(scan, date):
+    """The stored record for an accepted scan"""
+    user = scan['user']
+    record = {
+        'user_id': user['id'],
+        'nfc_uid': scan['nfc_uid'],
+        'name': user['name'],
+        'department': user.get('department', 'Unknown'),
+        'timestamp': scan['timestamp'],
+        'date': date,
+        'action': 'check_in',
+        'device_id': scan['device_id']
+    }
+    if scan.get('received_at') is not None:
+        record['received_at'] = scan['received_at']
+    return record
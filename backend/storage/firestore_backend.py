@@ -0,0 +1,1059 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+
+import firestore_trace
+from counters import CounterRollup, PeriodRollups, ShardedCounter, is_final_rollup
+from nfc_uid import normalize_uid, uid_spellings
+from shared_uid_index import SharedUidIndex
+from status_updates import StatusUpdates
+from uid_cache import UidCache
+
+from .base import (DUPLICATE_ERROR, DUPLICATE_UID_ERROR, INVALID_UID_ERROR, MIGRATION_PAGE_SIZE, StorageBackend,
+                   attendance_record, uid_index_plan, uid_index_report)
+
+# Firestore caps a single commit at 500 writes
+MAX_BATCH_WRITES = 500
+
+# Legacy attendance migration: attempts per record write
+MIGRATION_MAX_ATTEMPTS = 5
+
+# gRPC status a create() of an existing document fails with
+GRPC_ALREADY_EXISTS = 6
+
+# Date documents per page (and per batch) when cleaning up legacy fields
+CLEANUP_PAGE_SIZE = 400
+
+# Days of check-ins remembered per process, and how far before a warm snapshot was
+# taken to look for check-ins it may have missed
+CHECKED_IN_DAYS = 2
+CHECKED_IN_RECONCILE_MARGIN = 300
+
+# Documents per page when comparing uid_index with registration
+UID_CHECK_PAGE_SIZE = 500
+
+
+# The Firebase SDK (firebase_admin, google-cloud-firestore, grpc) takes the better
+# part of a second to import, so it is bound here by load_sdk() rather than at
+# import time; nothing below touches these names before connect()
+firebase_admin = credentials = firestore = AlreadyExists = FailedPrecondition = FieldPath = None
+_sdk_lock = threading.Lock()
+
+
+def load_sdk():
+    """Import the Firebase SDK into this module. Safe to call more than once, from any thread"""
+    global firebase_admin, credentials, firestore, AlreadyExists, FailedPrecondition, FieldPath
+    with _sdk_lock:
+        if FieldPath is not None:
+            return
+        import firebase_admin as sdk
+        from firebase_admin import credentials as sdk_credentials, firestore as sdk_firestore
+        from google.api_core.exceptions import AlreadyExists as already_exists, FailedPrecondition as failed_precondition
+        from google.cloud.firestore_v1.field_path import FieldPath as field_path
+        firebase_admin, credentials, firestore, AlreadyExists = sdk, sdk_credentials, sdk_firestore, already_exists
+        FailedPrecondition = failed_precondition
+        FieldPath = field_path
+
+
+def load_credentials():
+    """Service account credentials from FIREBASE_CONFIG_PATH or the environment"""
+    # Check if we have Firebase service account credentials
+    firebase_config_path = os.environ.get('FIREBASE_CONFIG_PATH', 'firebase_config.json')
+
+    if os.path.exists(firebase_config_path):
+        # Use service account file
+        return credentials.Certificate(firebase_config_path)
+
+    # Try to use environment variables for production
+    firebase_config = {
+        "type": "service_account",
+        "project_id": os.environ.get('FIREBASE_PROJECT_ID'),
+        "private_key_id": os.environ.get('FIREBASE_PRIVATE_KEY_ID'),
+        "private_key": os.environ.get('FIREBASE_PRIVATE_KEY', '').replace('\\n', '\n'),
+        "client_email": os.environ.get('FIREBASE_CLIENT_EMAIL'),
+        "client_id": os.environ.get('FIREBASE_CLIENT_ID'),
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+        "client_x509_cert_url": os.environ.get('FIREBASE_CLIENT_X509_CERT_URL')
+    }
+
+    # Check if all required env vars are present
+    if not all([firebase_config[key] for key in ['project_id', 'private_key', 'client_email']]):
+        raise ValueError("Missing required Firebase environment variables")
+
+    return credentials.Certificate(firebase_config)
+
+
+def firestore_client():
+    """The default Firebase app's Firestore client, initializing the app on first use"""
+    load_sdk()
+    try:
+        firebase_app = firebase_admin.get_app()
+    except ValueError:
+        firebase_app = firebase_admin.initialize_app(load_credentials())
+    return firestore.client(firebase_app)
+
+
+# What uid_index/{uid} copies from a registration: enough to accept a scan
+UID_INDEX_FIELDS = ('nfc_uid', 'name', 'department')
+
+
+def uid_index_entry(user):
+    return {'user_id': user['id'], **{f: user[f] for f in UID_INDEX_FIELDS if f in user}}
+
+
+def user_from_entry(entry):
+    return {**{f: entry[f] for f in UID_INDEX_FIELDS if f in entry}, 'id': entry['user_id']}
+
+
+class FirestoreBackend(StorageBackend):
+    """Production backend on Cloud Firestore.
+
+    Layout: registration/{user_id}, attendance/{date} with its records in
+    attendance/{date}/records/{user_id} and a sharded day count in
+    attendance/{date}/count_shards/{n}.
+
+    Cards are resolved through uid_index/{normalized uid}, a copy of the
+    fields a scan needs, read with a single-document get. add_users keeps it
+    in step with registration. Registrations written by other means (the web
+    form wrote to Firestore directly until it moved to /api/registration) are
+    indexed by check_uid_index(repair=True); warmup() reports how many
+    registrations still lack an entry.
+    """
+
+    name = 'firestore'
+
+    def __init__(self):
+        self.db = None
+        self._pid = None
+
+        # FIRESTORE_TRACE=0 turns off per-request RPC tracing and cost accounting
+        self.tracing = os.environ.get('FIRESTORE_TRACE', '1') != '0'
+
+        # A card missing from uid_index is looked for with the old `nfc_uid` query
+        # too, until UID_INDEX_LEGACY_QUERY=0 once the backfill job has run
+        self.legacy_uid_query = os.environ.get('UID_INDEX_LEGACY_QUERY', '1') != '0'
+
+        # Per-day attendance counts are sharded to get past Firestore's per-document write rate
+        self.counter = ShardedCounter(num_shards=int(os.environ.get('COUNTER_SHARDS', 10)))
+
+        # Created by connect(), in the process that will use them
+        self.uid_cache = None
+        self.counter_rollup = None
+        self.period_rollups = None
+        self.status_updates = None
+
+        # Dates whose attendance doc this process has already written
+        self._ensured_dates = set()
+
+        # date -> ids of users known to have checked in, so a re-tap is turned away
+        # without a commit. Only ever a subset of the records; a miss asks Firestore
+        self._checked_in = {}
+        self._checked_in_lock = threading.Lock()
+        self._reconcile_since = None
+
+    def load_libraries(self):
+        load_sdk()
+        if self.tracing:
+            firestore_trace.install()
+
+    def connect(self):
+        """Create the Firestore client, UID listener and roll-up thread in this process
+
+        gRPC channels and threads do not survive fork, so under gunicorn's
+        preload_app this runs in each worker (post_fork) and never in the master.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.load_libraries()
+        self.db = None
+        self._ensured_dates = set()
+        self._checked_in = {}
+
+        # Firebase initialization with better error handling
+        try:
+            self.db = firestore_client()
+            print("Firebase connection established successfully")
+        except Exception as e:
+            print(f"CRITICAL ERROR initializing Firebase: {e}")
+            # Don't exit - we'll check for db before using it
+
+        # Validate Firebase connection
+        if self.db is None:
+            print("WARNING: Firebase database not initialized. Check your credentials.")
+            return
+
+        # UID -> user index kept current by a listener on `registration`; warmup() waits
+        # for it. With UID_INDEX_PATH set, one sidecar listens for every worker and
+        # publishes the index to that memory-mapped file (see shared_uid_index)
+        if os.environ.get('UID_CACHE_ENABLED', '1') != '0':
+            uid_index_path = os.environ.get('UID_INDEX_PATH')
+            if uid_index_path:
+                self.uid_cache = SharedUidIndex(
+                    self.db.collection('registration'),
+                    uid_index_path,
+                    negative_ttl=float(os.environ.get('UID_CACHE_NEGATIVE_TTL', 30)),
+                    warm_timeout=float(os.environ.get('UID_CACHE_WARM_TIMEOUT', 10)),
+                    stale_after=float(os.environ.get('UID_INDEX_STALE_AFTER', 30)),
+                    fallback=self._lookup_uid_index
+                )
+            else:
+                self.uid_cache = UidCache(
+                    self.db.collection('registration'),
+                    negative_ttl=float(os.environ.get('UID_CACHE_NEGATIVE_TTL', 30)),
+                    warm_timeout=float(os.environ.get('UID_CACHE_WARM_TIMEOUT', 10)),
+                    fallback=self._lookup_uid_index
+                )
+            self.uid_cache.start(wait=False)
+
+        # Every COUNTER_ROLLUP_INTERVAL seconds shard totals are copied into attendance/{date}.count
+        # and the week, month and year totals those days belong to recomputed (0 turns it off)
+        rollup_interval = float(os.environ.get('COUNTER_ROLLUP_INTERVAL', 60))
+        if rollup_interval > 0:
+            self.period_rollups = PeriodRollups(self.db, self.range_summaries)
+            self.counter_rollup = CounterRollup(self.db, self.counter,
+                                                interval=rollup_interval,
+                                                periods=self.period_rollups)
+            self.counter_rollup.ensure_started()
+
+        # Registration status and last-seen times are written every STATUS_UPDATE_INTERVAL
+        # seconds, newest per user, rather than in each scan's commit (0 writes each one
+        # right after its scan's commit)
+        self.status_updates = StatusUpdates(self.db, interval=float(os.environ.get('STATUS_UPDATE_INTERVAL', 2)))
+        self.status_updates.ensure_started()
+
+    def warmup(self):
+        """Open the gRPC channel with a one-document read, catch up on check-ins made
+        since the warm snapshot, then wait for the UID index"""
+        report = super().warmup()
+        if self._reconcile_since is not None:
+            since = self._reconcile_since - timedelta(seconds=CHECKED_IN_RECONCILE_MARGIN)
+            found = 0
+            for date in sorted(self._checked_in):
+                user_ids = [record['id'] for record in self.iter_records(date, since=since)]
+                self._mark_checked_in(date, user_ids)
+                found += len(user_ids)
+            self._reconcile_since = None
+            report['checked_in_reconciled'] = found
+        if self.uid_cache is not None:
+            report['uid_cache_warm'] = self.uid_cache.wait_warm()
+        report['uid_index_missing'] = self._uid_index_missing()
+        return report
+
+    def _uid_index_missing(self):
+        """How many more registrations there are than uid_index entries, by two count
+        aggregations. Duplicate detection and lookups need the backfill to be complete"""
+        try:
+            registrations = self.db.collection('registration').count().get()[0][0].value
+            entries = self.db.collection('uid_index').count().get()[0][0].value
+        except Exception as e:
+            print(f"Could not compare uid_index with registrations: {e}")
+            return None
+        missing = max(registrations - entries, 0)
+        if missing:
+            print(f"WARNING: uid_index has {entries} entries for {registrations} registrations; run "
+                  f"POST /admin/uid-index/backfill (and keep UID_INDEX_LEGACY_QUERY on) until they match")
+        return missing
+
+    # Warm restarts (see warm_snapshot)
+    def export_warm_state(self):
+        with self._checked_in_lock:
+            state = {'checked_in': {date: sorted(user_ids) for date, user_ids in self._checked_in.items()}}
+        users = self.uid_cache.export_state() if self.uid_cache is not None else None
+        if users is not None:
+            state['uid_index'] = users
+        return state
+
+    def import_warm_state(self, state, saved_at):
+        for date, user_ids in (state.get('checked_in') or {}).items():
+            self._mark_checked_in(date, user_ids)
+        if self.uid_cache is not None and state.get('uid_index'):
+            self.uid_cache.import_state(state['uid_index'])
+        self._reconcile_since = saved_at
+
+    def _mark_checked_in(self, date, user_ids):
+        with self._checked_in_lock:
+            if date not in self._checked_in:
+                self._checked_in[date] = set()
+                for old in sorted(self._checked_in)[:-CHECKED_IN_DAYS]:
+                    del self._checked_in[old]
+            self._checked_in.get(date, set()).update(user_ids)
+
+    def _already_checked_in(self, date, user_id):
+        return user_id in self._checked_in.get(date, ())
+
+    @property
+    def connected(self):
+        return self.db is not None
+
+    # Per-request tracing of every Firestore RPC (see firestore_trace)
+    def begin_request(self):
+        if self.tracing:
+            firestore_trace.begin()
+
+    def request_ops(self):
+        trace = firestore_trace.current() if self.tracing else None
+        return trace.rpcs if trace is not None else None
+
+    def end_request(self, route):
+        return firestore_trace.end(route) if self.tracing else None
+
+    def cost_report(self):
+        return firestore_trace.ledger.report() if self.tracing else None
+
+    # Users
+    def _uid_index_ref(self, uid):
+        return self.db.collection('uid_index').document(uid)
+
+    def _lookup_uid_index(self, nfc_uid):
+        """The user uid_index holds for `nfc_uid`, falling back to the legacy query"""
+        uid = normalize_uid(nfc_uid)
+        if uid is not None:
+            entry = self._uid_index_ref(uid).get()
+            if entry.exists:
+                return user_from_entry(entry.to_dict())
+        if not self.legacy_uid_query:
+            return None
+
+        spellings = uid_spellings(nfc_uid)
+        if not spellings:
+            return None
+        query = self.db.collection('registration').where('nfc_uid', 'in', spellings).limit(1)
+        for user in query.get():
+            return {**user.to_dict(), 'id': user.id}
+        return None
+
+    def get_user_by_uid(self, nfc_uid):
+        if self.uid_cache is not None:
+            return self.uid_cache.lookup(nfc_uid)
+        return self._lookup_uid_index(nfc_uid)
+
+    def get_users_by_uids(self, nfc_uids):
+        if self.uid_cache is not None:
+            return super().get_users_by_uids(nfc_uids)
+
+        requested = {}  # normalized uid -> the spellings asked for
+        for nfc_uid in set(nfc_uids):
+            uid = normalize_uid(nfc_uid)
+            if uid is not None:
+                requested.setdefault(uid, []).append(nfc_uid)
+
+        # One batched get for every entry, instead of a query per 30 UIDs
+        users = {}
+        for entry in self.db.get_all([self._uid_index_ref(uid) for uid in requested]):
+            if entry.exists:
+                for nfc_uid in requested[entry.id]:
+                    users[nfc_uid] = user_from_entry(entry.to_dict())
+        if not self.legacy_uid_query:
+            return users
+
+        pending = {}  # spelling a registration may hold -> the uids asked for
+        for nfc_uid in set(nfc_uids):
+            if nfc_uid not in users:
+                for spelling in uid_spellings(nfc_uid):
+                    pending.setdefault(spelling, []).append(nfc_uid)
+        for user_id, data in self._legacy_registrations(list(pending)):
+            for nfc_uid in pending.get(data.get('nfc_uid'), []):
+                users.setdefault(nfc_uid, {**data, 'id': user_id})
+        return users
+
+    def _legacy_registrations(self, spellings):
+        """(id, data) of registrations whose stored nfc_uid is one of `spellings`"""
+        registration_ref = self.db.collection('registration')
+        # Firestore 'in' filters take at most 30 values
+        for i in range(0, len(spellings), 30):
+            for user in registration_ref.where('nfc_uid', 'in', spellings[i:i + 30]).get():
+                yield user.id, user.to_dict()
+
+    def users_page(self, start_after=None, limit=500, fields=None):
+        # Ordered by document ID so a page can resume after the last ID it returned
+        query = self.db.collection('registration').order_by(FieldPath.document_id()).limit(limit)
+        if fields is not None:
+            # select() projects server-side, so unneeded fields are never read off the wire
+            query = query.select(fields)
+        if start_after:
+            query = query.start_after({FieldPath.document_id(): start_after})
+        return [{**(user.to_dict() or {}), 'id': user.id} for user in query.stream()]
+
+    def registration_version(self):
+        # Only the listener sees every change; without it there is no cheap version
+        return self.uid_cache.version() if self.uid_cache is not None else None
+
+    def add_users(self, users):
+        """Write registrations together with their uid_index entries
+
+        A new entry is written with create(), so if another registration
+        claims the same card between our read and our commit, the commit fails
+        rather than both succeeding; a failed chunk is retried user by user to
+        find out which one lost. Until the index is backfilled (legacy UID
+        queries on), a card without an entry is also looked up among the
+        registrations themselves, which the web form used to write directly.
+        """
+        results = [None] * len(users)
+        registration_ref = self.db.collection('registration')
+
+        planned = []  # (position, user, uid)
+        claimed = {}  # uid -> user id, within this call
+        for i, user in enumerate(users):
+            uid = normalize_uid(user.get('nfc_uid'))
+            if uid is None:
+                results[i] = (None, INVALID_UID_ERROR)
+            elif claimed.setdefault(uid, user['id']) != user['id']:
+                results[i] = (None, DUPLICATE_UID_ERROR)
+            else:
+                planned.append((i, user, uid))
+
+        # Current registrations (for UIDs that change) and entries, in one batched get
+        refs = [registration_ref.document(user['id']) for _, user, _ in planned] + \
+               [self._uid_index_ref(uid) for _, _, uid in planned]
+        snapshots = {snapshot.reference.path: snapshot
+                     for snapshot in (self.db.get_all(refs) if refs else []) if snapshot.exists}
+
+        # Entries of the UIDs re-registered users are giving up, read in a second get
+        moving = {}  # position -> previous uid
+        for i, user, uid in planned:
+            previous = snapshots.get(registration_ref.document(user['id']).path)
+            previous_uid = normalize_uid((previous.to_dict() or {}).get('nfc_uid')) if previous else None
+            if previous_uid is not None and previous_uid != uid:
+                moving[i] = previous_uid
+        refs = [self._uid_index_ref(uid) for uid in set(moving.values())
+                if self._uid_index_ref(uid).path not in snapshots]
+        snapshots.update((snapshot.reference.path, snapshot)
+                         for snapshot in (self.db.get_all(refs) if refs else []) if snapshot.exists)
+
+        writes = []  # (position, user, uid, entry exists, previous entry to remove)
+        for i, user, uid in planned:
+            entry = snapshots.get(self._uid_index_ref(uid).path)
+            if entry is not None and entry.to_dict().get('user_id') != user['id']:
+                results[i] = (None, DUPLICATE_UID_ERROR)
+                continue
+            # The old UID's entry is only removed while it is still this user's
+            previous = snapshots.get(self._uid_index_ref(moving[i]).path) if i in moving else None
+            if previous is not None and previous.to_dict().get('user_id') != user['id']:
+                previous = None
+            writes.append((i, user, uid, entry is not None, previous))
+
+        if self.legacy_uid_query:
+            unindexed = {}  # spelling -> uid, for cards without an entry
+            for _, _, uid, entry_exists, _ in writes:
+                if not entry_exists:
+                    unindexed.update((spelling, uid) for spelling in uid_spellings(uid))
+            owners = {}  # uid -> ids of registrations holding it
+            for user_id, data in self._legacy_registrations(list(unindexed)):
+                owners.setdefault(unindexed[data.get('nfc_uid')], set()).add(user_id)
+            for write in list(writes):
+                i, user, uid, *_ = write
+                if owners.get(uid, set()) - {user['id']}:
+                    results[i] = (None, DUPLICATE_UID_ERROR)
+                    writes.remove(write)
+
+        for chunk in self._user_commits(writes):
+            try:
+                self._commit_users(chunk)
+                for i, user, *_ in chunk:
+                    results[i] = (user, None)
+            except (AlreadyExists, FailedPrecondition):
+                for write in chunk:
+                    try:
+                        self._commit_users([write])
+                        results[write[0]] = (write[1], None)
+                    except FailedPrecondition:
+                        # The old entry changed since it was read; it is no longer ours to remove
+                        try:
+                            self._commit_users([write[:4] + (None,)])
+                            results[write[0]] = (write[1], None)
+                        except AlreadyExists:
+                            results[write[0]] = (None, DUPLICATE_UID_ERROR)
+                        except Exception as e:
+                            results[write[0]] = (None, f"Database error: {str(e)}")
+                    except AlreadyExists:
+                        results[write[0]] = (None, DUPLICATE_UID_ERROR)
+                    except Exception as e:
+                        results[write[0]] = (None, f"Database error: {str(e)}")
+            except Exception as e:
+                print(f"Error registering users: {e}")
+                for i, *_ in chunk:
+                    results[i] = (None, f"Database error: {str(e)}")
+        return results
+
+    def remember_users(self, users):
+        if self.uid_cache is not None:
+            self.uid_cache.remember(users)
+
+    def _user_commits(self, writes):
+        """Split add_users writes into commits of up to MAX_BATCH_WRITES writes: two per
+        user (registration and uid_index entry), three if an old entry is removed"""
+        chunk, count = [], 0
+        for write in writes:
+            needed = 3 if write[4] is not None else 2
+            if count + needed > MAX_BATCH_WRITES:
+                yield chunk
+                chunk, count = [], 0
+            chunk.append(write)
+            count += needed
+        if chunk:
+            yield chunk
+
+    def _commit_users(self, writes):
+        batch = self.db.batch()
+        registration_ref = self.db.collection('registration')
+        for _, user, uid, entry_exists, previous in writes:
+            batch.set(registration_ref.document(user['id']), {k: v for k, v in user.items() if k != 'id'})
+            if entry_exists:
+                batch.set(self._uid_index_ref(uid), uid_index_entry(user))
+            else:
+                batch.create(self._uid_index_ref(uid), uid_index_entry(user))
+            if previous is not None:
+                # Fails the commit if the entry was rewritten (say, for its card's new owner) since it was read
+                batch.delete(previous.reference,
+                             option=self.db.write_option(last_update_time=previous.update_time))
+        batch.commit()
+
+    # Attendance
+    def _touch_date_doc(self, batch, date_doc_ref, date):
+        """Upsert the date doc once per process rather than on every scan
+
+        The parent doc would otherwise take a write per scan and become the same
+        hot spot the sharded counter removes. Writes into a past day also flag it
+        for the roll-up, since its final count is changing.
+        """
+        if date < datetime.now(pytz.UTC).strftime("%Y-%m-%d"):
+            batch.set(date_doc_ref, {'date': date, 'needs_rollup': True}, merge=True)
+        elif date not in self._ensured_dates:
+            batch.set(date_doc_ref, {'date': date}, merge=True)
+
+    def record_attendance(self, user, nfc_uid, device_id, timestamp=None, received_at=None):
+        """Record one check-in for `user` in a single batch commit
+
+        The record lives at attendance/{date}/records/{user_id}, so a second
+        check-in for the same day fails the create precondition and the whole
+        commit is rejected, which also keeps concurrent taps of the same card
+        from double counting.
+        """
+        try:
+            if timestamp is None:
+                timestamp = datetime.now(pytz.UTC)
+            today = timestamp.strftime("%Y-%m-%d")
+            if self._already_checked_in(today, user['id']):
+                return None, DUPLICATE_ERROR
+
+            # Reference to the day's attendance document
+            date_doc_ref = self.db.collection('attendance').document(today)
+
+            # One record per user per day, keyed by user id
+            record_ref = date_doc_ref.collection('records').document(user['id'])
+
+            # Create new attendance record
+            attendance_data = attendance_record({
+                'user': user,
+                'nfc_uid': nfc_uid,
+                'device_id': device_id,
+                'timestamp': timestamp,
+                'received_at': received_at
+            }, today)
+
+            batch = self.db.batch()
+
+            # Fails the whole commit if the user already checked in that day
+            batch.create(record_ref, attendance_data)
+
+            # Bump a random count shard (and make sure the date doc exists) in the same commit
+            self._touch_date_doc(batch, date_doc_ref, today)
+            self.counter.increment(batch, date_doc_ref)
+
+            try:
+                batch.commit()
+            except AlreadyExists:
+                self._mark_checked_in(today, [user['id']])
+                return None, DUPLICATE_ERROR
+            self._ensured_dates.add(today)
+            self._mark_checked_in(today, [user['id']])
+            # The user's status in registration, written only if this scan is their latest
+            self.status_updates.record(user['id'], timestamp, live=received_at is None)
+
+            return {**attendance_data, 'id': record_ref.id}, None
+        except Exception as e:
+            print(f"Error in record_attendance: {e}")
+            return None, f"Database error: {str(e)}"
+
+    def _commit_scan_chunk(self, scans):
+        """Write a chunk of accepted scans in one commit"""
+        batch = self.db.batch()
+        counts = {}
+        latest = {}
+        records = []
+
+        for scan in scans:
+            user = scan['user']
+            ts = scan['timestamp']
+            date = ts.strftime("%Y-%m-%d")
+            date_doc_ref = self.db.collection('attendance').document(date)
+            record_ref = date_doc_ref.collection('records').document(user['id'])
+
+            attendance_data = attendance_record(scan, date)
+            batch.create(record_ref, attendance_data)
+            records.append({**attendance_data, 'id': record_ref.id})
+
+            counts[date] = counts.get(date, 0) + 1
+            if user['id'] not in latest or latest[user['id']][0] < ts:
+                # Scans without a received_at were stamped by the server on arrival
+                latest[user['id']] = (ts, scan.get('received_at') is None)
+
+        for date, count in counts.items():
+            date_doc_ref = self.db.collection('attendance').document(date)
+            self._touch_date_doc(batch, date_doc_ref, date)
+            self.counter.increment(batch, date_doc_ref, count)
+
+        batch.commit()
+        self._ensured_dates.update(counts)
+        for record in records:
+            self._mark_checked_in(record['date'], [record['id']])
+        for user_id, (ts, live) in latest.items():
+            self.status_updates.record(user_id, ts, live)
+        return [(record, None) for record in records]
+
+    def record_attendance_batch(self, scans):
+        """Record many scans with as few commits as possible
+
+        Duplicates (known to this process, already in Firestore, or repeated
+        within `scans`) are filtered with a single get_all before writing. If a
+        commit still loses a race on a create precondition, that chunk is retried
+        one scan at a time so only the real duplicates are rejected.
+        """
+        if not scans:
+            return []
+        results = [None] * len(scans)
+
+        # One multi-get for every record slot this batch would create
+        refs = {}
+        for i, scan in enumerate(scans):
+            date = scan['timestamp'].strftime("%Y-%m-%d")
+            key = (date, scan['user']['id'])
+            if key in refs or self._already_checked_in(*key):
+                results[i] = (None, DUPLICATE_ERROR)
+                continue
+            refs[key] = (i, self.db.collection('attendance').document(date)
+                         .collection('records').document(scan['user']['id']))
+        if not refs:
+            return results
+
+        try:
+            existing = set()
+            for snapshot in self.db.get_all([ref for _, ref in refs.values()]):
+                if snapshot.exists:
+                    existing.add(snapshot.reference.path)
+        except Exception as e:
+            print(f"Error in record_attendance_batch: {e}")
+            return [result or (None, f"Database error: {str(e)}") for result in results]
+
+        to_write = []
+        for (date, user_id), (i, ref) in refs.items():
+            if ref.path in existing:
+                self._mark_checked_in(date, [user_id])
+                results[i] = (None, DUPLICATE_ERROR)
+            else:
+                to_write.append(i)
+        self._write_scans(scans, to_write, results)
+        return results
+
+    def record_attendance_group(self, scans):
+        """Record scans that arrived together, committing without reading first
+
+        Live scans are rarely duplicates, and those that are mostly come from a
+        card this process has already seen today, so the group goes straight
+        to its commit instead of paying record_attendance_batch's get_all.
+        The records' create() preconditions still reject the commit if any of
+        them exists, in which case its scans are written one at a time.
+        """
+        results = [None] * len(scans)
+        seen = set()
+        to_write = []
+        for i, scan in enumerate(scans):
+            key = (scan['timestamp'].strftime("%Y-%m-%d"), scan['user']['id'])
+            if key in seen or self._already_checked_in(*key):
+                results[i] = (None, DUPLICATE_ERROR)
+                continue
+            seen.add(key)
+            to_write.append(i)
+        self._write_scans(scans, to_write, results)
+        return results
+
+    def _write_scans(self, scans, to_write, results):
+        """Commit scans[i] for i in `to_write` in as few commits as fit, filling in `results`"""
+        def flush(chunk):
+            chunk_scans = [scans[i] for i in chunk]
+            try:
+                outcomes = self._commit_scan_chunk(chunk_scans)
+            except AlreadyExists:
+                outcomes = [
+                    self.record_attendance(scan['user'], scan['nfc_uid'], scan['device_id'],
+                                           scan['timestamp'], scan.get('received_at'))
+                    for scan in chunk_scans
+                ]
+            except Exception as e:
+                print(f"Error writing scans: {e}")
+                outcomes = [(None, f"Database error: {str(e)}")] * len(chunk)
+            for i, outcome in zip(chunk, outcomes):
+                results[i] = outcome
+
+        # Each scan costs one write (its record), each date two more (date doc + counter shard)
+        chunk = []
+        dates = set()
+        for i in to_write:
+            date = scans[i]['timestamp'].strftime("%Y-%m-%d")
+            writes = len(chunk) + 1 + 2 * len(dates | {date})
+            if writes > MAX_BATCH_WRITES:
+                flush(chunk)
+                chunk = []
+                dates = set()
+            chunk.append(i)
+            dates.add(date)
+        if chunk:
+            flush(chunk)
+
+    def _day_counts(self, date_docs):
+        """Attendance totals for date doc snapshots, as {date: count}
+
+        A count rolled up after its day closed is used as is. Otherwise the shards
+        are summed (all days in one get_all), unless roll-ups are enabled, in which
+        case the parent count is accepted with up to one interval of lag. Days
+        from before sharding have no shards and keep their plain `count` field,
+        which is added to the shards once scans are backfilled into them.
+        """
+        counts = {}
+        need_shards = []
+        for date_doc in date_docs:
+            summary = date_doc.to_dict() or {}
+            date = summary.get('date', date_doc.id)
+            counts[date] = summary.get('count', 0)
+
+            rolled_up = 'rolled_up_at' in summary and not summary.get('needs_rollup')
+            if not is_final_rollup(summary, date) and not (self.counter_rollup is not None and rolled_up):
+                need_shards.append((date, date_doc))
+
+        if need_shards:
+            totals = self.counter.totals(self.db, [date_doc for _, date_doc in need_shards])
+            for date, date_doc in need_shards:
+                if totals[date_doc.reference.path] is not None:
+                    counts[date] = totals[date_doc.reference.path]
+        return counts
+
+    def day_count(self, date):
+        date_doc = self.db.collection('attendance').document(date).get()
+        if not date_doc.exists:
+            return None
+        return self._day_counts([date_doc]).get(date, 0)
+
+    def latest_record_time(self, date):
+        query = self.db.collection('attendance').document(date).collection('records')\
+                    .order_by('timestamp', direction=firestore.Query.DESCENDING)\
+                    .select(['timestamp']).limit(1)
+        for record in query.stream():
+            return record.get('timestamp')
+        return None
+
+    def records_page(self, date, since=None, start_after=None, limit=500):
+        # Sorted by Firestore; the document ID breaks timestamp ties so the cursor is exact.
+        # Single-field range and ordering on `timestamp` need no composite index.
+        query = self.db.collection('attendance').document(date).collection('records')
+        if since is not None:
+            query = query.where('timestamp', '>', since)
+        query = query.order_by('timestamp').order_by(FieldPath.document_id()).limit(limit)
+        if start_after is not None:
+            timestamp, record_id = start_after
+            query = query.start_after({'timestamp': timestamp, FieldPath.document_id(): record_id})
+        return [{**record.to_dict(), 'id': record.id} for record in query.stream()]
+
+    def range_summaries(self, start_date, end_date):
+        # Query for date documents in range
+        date_docs = self.db.collection('attendance')\
+                        .where('date', '>=', start_date)\
+                        .where('date', '<=', end_date)\
+                        .stream()
+
+        counts = self._day_counts(list(date_docs))
+        results = [{'date': date, 'count': count} for date, count in counts.items()]
+
+        # Sort by date
+        results.sort(key=lambda x: x.get('date'))
+        return results
+
+    def period_summaries(self, granularity, first_period, last_period):
+        if self.period_rollups is None:
+            return None
+        return self.period_rollups.summaries(granularity, first_period, last_period)
+
+    # Admin
+    def rebuild_period_rollups(self, start_date, end_date, job=None):
+        if self.period_rollups is None:
+            return None
+        return self.period_rollups.rebuild(start_date, end_date, job)
+
+    def migrate_attendance(self, job=None):
+        """Copy flat attendance/{id} records to attendance/{date}/records/{id}
+
+        The old collection is read a page at a time in document ID order and
+        each page goes to a BulkWriter, which sends batches in parallel and
+        retries throttled writes, so pages spread across many dates at once.
+        Records are created rather than set, tagged with the run that created
+        them, and counted per date only when this run created them. After
+        every page the cursor and counts are checkpointed together; a resumed
+        run redoes at most the page in flight and counts the records its own
+        earlier attempt created there.
+
+        The totals are then added to each date's counter shards, one batch per
+        date with a marker document under attendance/{date}/migrations, so a
+        date is never added twice. The date is flagged for roll-up instead of
+        having its `count` overwritten, which would drop scans recorded since.
+        """
+        state = dict(job.progress if job is not None else {})
+        state.setdefault('phase', 'records')
+        state.setdefault('cursor', None)
+        state.setdefault('counts', {})
+        state.setdefault('migrated', 0)
+        state.setdefault('skipped', 0)
+        state.setdefault('failed', 0)
+        run_id = job.id if job is not None else 'manual'
+        attendance_ref = self.db.collection('attendance')
+
+        if state['phase'] == 'records':
+            lock = threading.Lock()
+            failed_dates = []
+            existing = []
+
+            def on_write_error(failure, writer):
+                if failure.code == GRPC_ALREADY_EXISTS:
+                    with lock:
+                        existing.append(failure.operation.reference)
+                    return False
+                if failure.attempts < MIGRATION_MAX_ATTEMPTS:
+                    return True
+                print(f"Error migrating record {failure.operation.reference.id}: {failure.message}")
+                with lock:
+                    failed_dates.append(failure.operation.reference.parent.parent.id)
+                return False
+
+            writer = self.db.bulk_writer()
+            writer.on_write_error(on_write_error)
+            try:
+                while True:
+                    if job is not None:
+                        job.throttle(MIGRATION_PAGE_SIZE)
+                    query = attendance_ref.order_by(FieldPath.document_id()).limit(MIGRATION_PAGE_SIZE)
+                    if state['cursor']:
+                        query = query.start_after({FieldPath.document_id(): state['cursor']})
+                    page = list(query.stream())
+                    if not page:
+                        break
+
+                    counts = dict(state['counts'])
+                    migrated = 0
+                    for old_record in page:
+                        data = old_record.to_dict() or {}
+                        date = data.get('date')
+                        # Date documents live in the same collection, under their date
+                        if not date or old_record.id == date:
+                            continue
+                        record_ref = attendance_ref.document(date).collection('records').document(old_record.id)
+                        writer.create(record_ref, {**data, 'migrated_by': run_id})  # Keep same ID for traceability
+                        counts[date] = counts.get(date, 0) + 1
+                        migrated += 1
+                        if job is not None:
+                            job.throttle()
+                    writer.flush()
+
+                    with lock:
+                        page_existing = list(existing)
+                        existing.clear()
+                        for date in failed_dates:
+                            counts[date] -= 1
+                        failed = len(failed_dates)
+                        failed_dates.clear()
+
+                    # Records that were already there are counted only if this run created them
+                    skipped = 0
+                    if page_existing:
+                        if job is not None:
+                            job.throttle(len(page_existing))
+                        for snapshot in self.db.get_all(page_existing):
+                            if not snapshot.exists or (snapshot.to_dict() or {}).get('migrated_by') != run_id:
+                                counts[snapshot.reference.parent.parent.id] -= 1
+                                skipped += 1
+                    state.update(cursor=page[-1].id, counts=counts,
+                                 migrated=state['migrated'] + migrated - failed - skipped,
+                                 skipped=state['skipped'] + skipped,
+                                 failed=state['failed'] + failed)
+                    if job is not None:
+                        job.checkpoint(state)
+            finally:
+                writer.close()
+
+            state['phase'] = 'counts'
+            if job is not None:
+                job.checkpoint(state)
+
+        now = datetime.now(pytz.UTC)
+        for date, count in sorted(state['counts'].items()):
+            if count <= 0:
+                continue
+            date_ref = attendance_ref.document(date)
+            if job is not None:
+                job.throttle(3)
+            batch = self.db.batch()
+            batch.create(date_ref.collection('migrations').document(run_id), {'count': count, 'migrated_at': now})
+            self.counter.increment(batch, date_ref, count)
+            batch.set(date_ref, {'date': date, 'needs_rollup': True}, merge=True)
+            try:
+                batch.commit()
+            except AlreadyExists:
+                # Added by this run before it was interrupted
+                pass
+
+        state['phase'] = 'done'
+        return state
+
+    def load_job_state(self, job_id):
+        snapshot = self.db.collection('admin_jobs').document(job_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def save_job_state(self, job_id, changes):
+        self.db.collection('admin_jobs').document(job_id).set(changes, merge=True)
+
+    def list_job_states(self, limit):
+        query = self.db.collection('admin_jobs')\
+                    .order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit)
+        return [snapshot.to_dict() for snapshot in query.stream()]
+
+    def list_active_job_states(self):
+        # Polled by the job runner process; reads only the handful of active jobs
+        query = self.db.collection('admin_jobs').where('status', 'in', ['queued', 'running'])
+        return [snapshot.to_dict() for snapshot in query.stream()]
+
+    def cleanup_departments(self, job=None):
+        progress = dict(job.progress if job is not None else {})
+        progress.setdefault('cursor', None)
+        progress.setdefault('cleaned', 0)
+        progress.setdefault('failed', 0)
+        date_docs_ref = self.db.collection('attendance_by_date')
+
+        while True:
+            if job is not None:
+                job.throttle(CLEANUP_PAGE_SIZE)
+            # Only the field being removed is fetched
+            query = date_docs_ref.order_by(FieldPath.document_id())\
+                        .select(['departments']).limit(CLEANUP_PAGE_SIZE)
+            if progress['cursor']:
+                query = query.start_after({FieldPath.document_id(): progress['cursor']})
+            page = list(query.stream())
+            if not page:
+                break
+
+            batch = self.db.batch()
+            pending = 0
+            for date_doc in page:
+                if 'departments' in (date_doc.to_dict() or {}):
+                    # Remove the departments field
+                    batch.update(date_doc.reference, {'departments': firestore.DELETE_FIELD})
+                    pending += 1
+            if pending:
+                if job is not None:
+                    job.throttle(pending)
+                try:
+                    batch.commit()
+                    progress['cleaned'] += pending
+                except Exception as e:
+                    print(f"Error cleaning documents after {progress['cursor']}: {e}")
+                    progress['failed'] += pending
+
+            progress['cursor'] = page[-1].id
+            if job is not None:
+                job.checkpoint(progress)
+
+        return {'cleaned': progress['cleaned'], 'failed': progress['failed']}
+
+    def check_uid_index(self, repair=False, job=None):
+        """See StorageBackend.check_uid_index
+
+        Both collections are read in full, a throttled page at a time, so a
+        resumed job simply starts over; writing the same entries twice is
+        harmless.
+        """
+        progress = {'phase': 'registration', 'read': 0, 'repaired': 0, 'failed': 0}
+
+        def checkpoint(phase):
+            progress['phase'] = phase
+            if job is not None:
+                job.checkpoint(dict(progress))
+
+        users = []
+        start_after = None
+        while True:
+            if job is not None:
+                job.throttle(UID_CHECK_PAGE_SIZE)
+            page = self.users_page(start_after, UID_CHECK_PAGE_SIZE, fields=list(UID_INDEX_FIELDS))
+            users.extend(page)
+            progress['read'] += len(page)
+            checkpoint('registration')
+            if len(page) < UID_CHECK_PAGE_SIZE:
+                break
+            start_after = page[-1]['id']
+
+        entries = {}
+        index_ref = self.db.collection('uid_index')
+        start_after = None
+        while True:
+            if job is not None:
+                job.throttle(UID_CHECK_PAGE_SIZE)
+            query = index_ref.order_by(FieldPath.document_id()).limit(UID_CHECK_PAGE_SIZE)
+            if start_after:
+                query = query.start_after({FieldPath.document_id(): start_after})
+            page = list(query.stream())
+            entries.update((entry.id, entry.to_dict() or {}) for entry in page)
+            progress['read'] += len(page)
+            checkpoint('uid_index')
+            if len(page) < UID_CHECK_PAGE_SIZE:
+                break
+            start_after = page[-1].id
+
+        expected, conflicts, invalid = uid_index_plan(users)
+        report, missing, stale, orphaned = uid_index_report(
+            expected, conflicts, invalid, entries, lambda entry, user: entry == uid_index_entry(user))
+        if not repair:
+            return report
+
+        fixes = [(uid, expected[uid]) for uid in missing + stale] + [(uid, None) for uid in orphaned]
+        for start in range(0, len(fixes), MAX_BATCH_WRITES):
+            chunk = fixes[start:start + MAX_BATCH_WRITES]
+            if job is not None:
+                job.throttle(len(chunk))
+            batch = self.db.batch()
+            for uid, user in chunk:
+                if user is None:
+                    batch.delete(self._uid_index_ref(uid))
+                else:
+                    batch.set(self._uid_index_ref(uid), uid_index_entry(user))
+            try:
+                batch.commit()
+                progress['repaired'] += len(chunk)
+            except Exception as e:
+                print(f"Error repairing uid_index entries from {chunk[0][0]}: {e}")
+                progress['failed'] += len(chunk)
+            checkpoint('repair')
+
+        return {**report, 'repaired': progress['repaired'], 'failed': progress['failed']}
+
+    def flush_pending(self):
+        if self.status_updates is not None and self._pid == os.getpid():
+            self.status_updates.flush()
+
+    def pending_stats(self):
+        return self.status_updates.stats() if self.status_updates is not None else None
+
+    def cache_stats(self):
+        if self.uid_cache is None:
+            return None
+        return self.uid_cache.stats()
@@ -0,0 +1,221 @@
+import copy
+import random
+import threading
+import time
+
+from nfc_uid import normalize_uid
+
+from .base import (DUPLICATE_ERROR, DUPLICATE_UID_ERROR, INVALID_UID_ERROR, MIGRATION_PAGE_SIZE, StorageBackend,
+                   attendance_record, is_newer, project)
+
+
+class LatencyModel:
+    """Simulated round-trip time for one storage RPC.
+
+    Each call sleeps `base_ms` plus uniform jitter, and with probability
+    `tail_probability` an extra `tail_ms`, which is enough to reproduce the
+    long tail a real network round trip has and watch how it propagates to
+    request latency under load.
+    """
+
+    def __init__(self, base_ms=0.0, jitter_ms=0.0, tail_ms=0.0, tail_probability=0.0, seed=None):
+        self.base_ms = base_ms
+        self.jitter_ms = jitter_ms
+        self.tail_ms = tail_ms
+        self.tail_probability = tail_probability
+        self._random = random.Random(seed)
+
+    @property
+    def enabled(self):
+        return self.base_ms > 0 or self.jitter_ms > 0 or (self.tail_ms > 0 and self.tail_probability > 0)
+
+    def sample_ms(self):
+        delay = self.base_ms + self._random.uniform(0, self.jitter_ms)
+        if self.tail_probability and self._random.random() < self.tail_probability:
+            delay += self.tail_ms
+        return delay
+
+    def wait(self):
+        if self.enabled:
+            time.sleep(self.sample_ms() / 1000.0)
+
+
+class MemoryBackend(StorageBackend):
+    """Process-local backend for benchmarks and load tests.
+
+    State lives in dicts guarded by one lock, so it is per process: under
+    gunicorn every worker has its own copy. Every operation that would be a
+    network round trip against Firestore calls the latency model once, so the
+    handlers see the same number of waits they would in production.
+    """
+
+    name = 'memory'
+
+    def __init__(self, latency=None):
+        self.latency = latency or LatencyModel()
+        self._lock = threading.Lock()
+        self.users = {}           # user id -> user dict
+        self._uid_index = {}      # normalized nfc_uid -> user id
+        self.days = {}            # date -> {'date', 'count', ...}
+        self.records = {}         # date -> {user_id: record}
+        self.legacy_records = {}  # record id -> flat pre-subcollection record
+        self._registration_version = 0
+        self.job_states = {}      # admin job name -> state
+
+    def _rpc(self):
+        super()._rpc()
+        self.latency.wait()
+
+    # Users
+    def get_user_by_uid(self, nfc_uid):
+        self._rpc()
+        with self._lock:
+            user_id = self._uid_index.get(normalize_uid(nfc_uid))
+            if user_id is None:
+                return None
+            return dict(self.users[user_id])
+
+    def get_users_by_uids(self, nfc_uids):
+        self._rpc()
+        with self._lock:
+            found = {uid: self._uid_index.get(normalize_uid(uid)) for uid in set(nfc_uids)}
+            return {uid: dict(self.users[user_id]) for uid, user_id in found.items() if user_id is not None}
+
+    def users_page(self, start_after=None, limit=500, fields=None):
+        self._rpc()
+        with self._lock:
+            ids = sorted(i for i in self.users if start_after is None or i > start_after)[:limit]
+            return [project(dict(self.users[i]), fields) for i in ids]
+
+    def add_users(self, users):
+        self._rpc()
+        results = []
+        with self._lock:
+            for user in users:
+                uid = normalize_uid(user.get('nfc_uid'))
+                if uid is None:
+                    results.append((None, INVALID_UID_ERROR))
+                    continue
+                if self._uid_index.get(uid, user['id']) != user['id']:
+                    results.append((None, DUPLICATE_UID_ERROR))
+                    continue
+                old = self.users.get(user['id'])
+                if old is not None:
+                    self._uid_index.pop(normalize_uid(old.get('nfc_uid')), None)
+                self.users[user['id']] = dict(user)
+                self._uid_index[uid] = user['id']
+                results.append((dict(user), None))
+            self._registration_version += 1
+        return results
+
+    def registration_version(self):
+        with self._lock:
+            return str(self._registration_version)
+
+    # Attendance
+    def record_attendance_batch(self, scans):
+        self._rpc()
+        results = []
+        with self._lock:
+            for scan in scans:
+                user = scan['user']
+                date = scan['timestamp'].strftime("%Y-%m-%d")
+                day_records = self.records.setdefault(date, {})
+                if user['id'] in day_records:
+                    results.append((None, DUPLICATE_ERROR))
+                    continue
+
+                record = {**attendance_record(scan, date), 'id': user['id']}
+                day_records[user['id']] = record
+                day = self.days.setdefault(date, {'date': date, 'count': 0})
+                day['count'] = day.get('count', 0) + 1
+
+                registered = self.users.get(user['id'])
+                if registered is not None and is_newer(scan['timestamp'], registered.get('timestamp')):
+                    registered['status'] = 'present'
+                    registered['timestamp'] = scan['timestamp']
+                    self._registration_version += 1
+                results.append((dict(record), None))
+        return results
+
+    def day_count(self, date):
+        self._rpc()
+        with self._lock:
+            day = self.days.get(date)
+            return None if day is None else day.get('count', 0)
+
+    def latest_record_time(self, date):
+        self._rpc()
+        with self._lock:
+            return max((r['timestamp'] for r in self.records.get(date, {}).values()), default=None)
+
+    def records_page(self, date, since=None, start_after=None, limit=500):
+        self._rpc()
+        with self._lock:
+            records = [dict(r) for r in self.records.get(date, {}).values()
+                       if since is None or r['timestamp'] > since]
+        records.sort(key=lambda x: (x['timestamp'], x['id']))
+        if start_after is not None:
+            records = [r for r in records if (r['timestamp'], r['id']) > tuple(start_after)]
+        return records[:limit]
+
+    def range_summaries(self, start_date, end_date):
+        self._rpc()
+        with self._lock:
+            results = [{'date': date, 'count': day.get('count', 0)}
+                       for date, day in self.days.items() if start_date <= date <= end_date]
+        results.sort(key=lambda x: x.get('date'))
+        return results
+
+    # Admin
+    def migrate_attendance(self, job=None):
+        state = {'cursor': '', 'migrated': 0, 'skipped': 0, 'failed': 0,
+                 **(job.progress if job is not None else {})}
+        record_ids = sorted(record_id for record_id in self.legacy_records if record_id > state['cursor'])
+        for start in range(0, len(record_ids), MIGRATION_PAGE_SIZE):
+            page = record_ids[start:start + MIGRATION_PAGE_SIZE]
+            if job is not None:
+                job.throttle(len(page))
+            self._rpc()
+            with self._lock:
+                for record_id in page:
+                    data = self.legacy_records[record_id]
+                    if 'date' not in data:
+                        continue
+                    date = data['date']
+                    records = self.records.setdefault(date, {})
+                    if record_id in records:
+                        # Migrated by an earlier run, and counted then
+                        state['skipped'] += 1
+                        continue
+                    self.days.setdefault(date, {'date': date, 'count': 0})
+                    records[record_id] = {**data, 'id': record_id}
+                    self.days[date]['count'] += 1
+                    state['migrated'] += 1
+            state['cursor'] = page[-1]
+            if job is not None:
+                job.checkpoint(dict(state))
+        return state
+
+    def load_job_state(self, job_id):
+        with self._lock:
+            return copy.deepcopy(self.job_states.get(job_id))
+
+    def save_job_state(self, job_id, changes):
+        with self._lock:
+            self.job_states.setdefault(job_id, {}).update(copy.deepcopy(changes))
+
+    def list_job_states(self, limit):
+        with self._lock:
+            states = sorted(self.job_states.values(), key=lambda s: s.get('created_at', 0), reverse=True)
+            return copy.deepcopy(states[:limit])
+
+    def cleanup_departments(self, job=None):
+        cleaned = 0
+        self._rpc()
+        with self._lock:
+            for day in self.days.values():
+                if 'departments' in day:
+                    del day['departments']
+                    cleaned += 1
+        return {'cleaned': cleaned, 'failed': 0}
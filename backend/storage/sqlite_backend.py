@@ -0,0 +1,373 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from nfc_uid import normalize_uid
+
+from .base import (DUPLICATE_ERROR, DUPLICATE_UID_ERROR, INVALID_UID_ERROR, MIGRATION_PAGE_SIZE, StorageBackend,
+                   attendance_record, is_newer, project, uid_index_plan, uid_index_report)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _decode(obj):
+    if len(obj) == 1 and '$dt' in obj:
+        return datetime.fromisoformat(obj['$dt'])
+    return obj
+
+
+def dumps(data):
+    return json.dumps(data, default=_encode)
+
+
+def loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+class SQLiteBackend(StorageBackend):
+    """Single-file backend for local runs and multi-worker load tests.
+
+    Unlike the memory backend the database file is shared by every gunicorn
+    worker, so duplicate detection and counts behave as they do against
+    Firestore. Documents are stored as JSON next to the columns that are
+    queried; the (date, user_id) primary key on records gives the same
+    create-if-absent duplicate check as attendance/{date}/records/{user_id}.
+    Cards are looked up through uid_index, keyed by the normalized UID, which
+    add_users maintains alongside registration.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_db()
+
+    def _conn(self):
+        # sqlite3 connections are per thread (and must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS registration (
+                id TEXT PRIMARY KEY,
+                nfc_uid TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS registration_nfc_uid ON registration (nfc_uid);
+            CREATE TABLE IF NOT EXISTS uid_index (
+                uid TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS attendance_days (
+                date TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0,
+                data TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS attendance_records (
+                date TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (date, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS attendance_records_by_time
+                ON attendance_records (date, timestamp, user_id);
+            CREATE TABLE IF NOT EXISTS legacy_attendance (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS admin_jobs (
+                id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS registration_version (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO registration_version (id, value) VALUES (0, 0);
+        ''')
+        # Databases created before uid_index existed
+        if conn.execute('SELECT 1 FROM uid_index LIMIT 1').fetchone() is None \
+                and conn.execute('SELECT 1 FROM registration LIMIT 1').fetchone() is not None:
+            report = self.check_uid_index(repair=True)
+            print(f"Backfilled uid_index with {report['repaired']} entries")
+
+    # Users
+    def get_user_by_uid(self, nfc_uid):
+        self._rpc()
+        row = self._conn().execute(
+            'SELECT r.id, r.data FROM uid_index u JOIN registration r ON r.id = u.user_id WHERE u.uid = ?',
+            (normalize_uid(nfc_uid),)
+        ).fetchone()
+        if row is None:
+            return None
+        return {**loads(row[1]), 'id': row[0]}
+
+    def get_users_by_uids(self, nfc_uids):
+        self._rpc()
+        requested = {}  # normalized uid -> the spellings asked for
+        for nfc_uid in set(nfc_uids):
+            uid = normalize_uid(nfc_uid)
+            if uid is not None:
+                requested.setdefault(uid, []).append(nfc_uid)
+        uids = list(requested)
+        users = {}
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i + 500]
+            rows = self._conn().execute(
+                f"""SELECT u.uid, r.id, r.data FROM uid_index u JOIN registration r ON r.id = u.user_id
+                    WHERE u.uid IN ({','.join('?' * len(chunk))})""",
+                chunk
+            ).fetchall()
+            for uid, user_id, data in rows:
+                for nfc_uid in requested[uid]:
+                    users[nfc_uid] = {**loads(data), 'id': user_id}
+        return users
+
+    def users_page(self, start_after=None, limit=500, fields=None):
+        self._rpc()
+        rows = self._conn().execute(
+            'SELECT id, data FROM registration WHERE id > ? ORDER BY id LIMIT ?',
+            (start_after or '', limit)
+        ).fetchall()
+        return [project({**loads(data), 'id': user_id}, fields) for user_id, data in rows]
+
+    def add_users(self, users):
+        self._rpc()
+        conn = self._conn()
+        results = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for user in users:
+                uid = normalize_uid(user.get('nfc_uid'))
+                if uid is None:
+                    results.append((None, INVALID_UID_ERROR))
+                    continue
+                owner = conn.execute('SELECT user_id FROM uid_index WHERE uid = ?', (uid,)).fetchone()
+                if owner is not None and owner[0] != user['id']:
+                    results.append((None, DUPLICATE_UID_ERROR))
+                    continue
+                conn.execute('DELETE FROM uid_index WHERE user_id = ?', (user['id'],))
+                conn.execute('INSERT INTO uid_index (uid, user_id) VALUES (?, ?)', (uid, user['id']))
+                conn.execute(
+                    'INSERT OR REPLACE INTO registration (id, nfc_uid, data) VALUES (?, ?, ?)',
+                    (user['id'], user['nfc_uid'], dumps({k: v for k, v in user.items() if k != 'id'}))
+                )
+                results.append((user, None))
+            conn.execute('UPDATE registration_version SET value = value + 1')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return results
+
+    def registration_version(self):
+        self._rpc()
+        return str(self._conn().execute('SELECT value FROM registration_version').fetchone()[0])
+
+    # Attendance
+    def record_attendance_batch(self, scans):
+        self._rpc()
+        results = []
+        conn = self._conn()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for scan in scans:
+                user = scan['user']
+                date = scan['timestamp'].strftime("%Y-%m-%d")
+                record = attendance_record(scan, date)
+                try:
+                    conn.execute(
+                        'INSERT INTO attendance_records (date, user_id, timestamp, data) VALUES (?, ?, ?, ?)',
+                        (date, user['id'], scan['timestamp'].isoformat(), dumps(record))
+                    )
+                except sqlite3.IntegrityError:
+                    results.append((None, DUPLICATE_ERROR))
+                    continue
+
+                conn.execute(
+                    '''INSERT INTO attendance_days (date, count, data) VALUES (?, 1, ?)
+                       ON CONFLICT (date) DO UPDATE SET count = count + 1''',
+                    (date, dumps({'date': date}))
+                )
+                row = conn.execute('SELECT data FROM registration WHERE id = ?', (user['id'],)).fetchone()
+                data = loads(row[0]) if row is not None else None
+                if data is not None and is_newer(scan['timestamp'], data.get('timestamp')):
+                    data['status'] = 'present'
+                    data['timestamp'] = scan['timestamp']
+                    conn.execute('UPDATE registration SET data = ? WHERE id = ?', (dumps(data), user['id']))
+                    conn.execute('UPDATE registration_version SET value = value + 1')
+                results.append(({**record, 'id': user['id']}, None))
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            print(f"Error in record_attendance_batch: {e}")
+            return [(None, f"Database error: {str(e)}")] * len(scans)
+        return results
+
+    def day_count(self, date):
+        self._rpc()
+        row = self._conn().execute('SELECT count FROM attendance_days WHERE date = ?', (date,)).fetchone()
+        return None if row is None else row[0]
+
+    def latest_record_time(self, date):
+        self._rpc()
+        row = self._conn().execute(
+            'SELECT data FROM attendance_records WHERE date = ? ORDER BY timestamp DESC LIMIT 1', (date,)
+        ).fetchone()
+        return loads(row[0])['timestamp'] if row is not None else None
+
+    def records_page(self, date, since=None, start_after=None, limit=500):
+        self._rpc()
+        # Timestamps are stored as UTC ISO strings, which sort chronologically
+        sql = 'SELECT user_id, data FROM attendance_records WHERE date = ?'
+        params = [date]
+        if since is not None:
+            sql += ' AND timestamp > ?'
+            params.append(since.isoformat())
+        if start_after is not None:
+            timestamp, record_id = start_after
+            sql += ' AND (timestamp, user_id) > (?, ?)'
+            params += [timestamp.isoformat(), record_id]
+        sql += ' ORDER BY timestamp, user_id LIMIT ?'
+        params.append(limit)
+        rows = self._conn().execute(sql, params).fetchall()
+        return [{**loads(data), 'id': user_id} for user_id, data in rows]
+
+    def range_summaries(self, start_date, end_date):
+        self._rpc()
+        rows = self._conn().execute(
+            'SELECT date, count FROM attendance_days WHERE date >= ? AND date <= ? ORDER BY date',
+            (start_date, end_date)
+        ).fetchall()
+        return [{'date': date, 'count': count} for date, count in rows]
+
+    # Admin
+    def migrate_attendance(self, job=None):
+        # A page of records and its day counts commit together; a record that
+        # is already there is not counted again, so a resumed or repeated run is harmless
+        conn = self._conn()
+        state = {'cursor': '', 'migrated': 0, 'skipped': 0, 'failed': 0,
+                 **(job.progress if job is not None else {})}
+        while True:
+            if job is not None:
+                job.throttle(MIGRATION_PAGE_SIZE)
+            page = conn.execute('SELECT id, data FROM legacy_attendance WHERE id > ? ORDER BY id LIMIT ?',
+                                (state['cursor'], MIGRATION_PAGE_SIZE)).fetchall()
+            if not page:
+                break
+
+            migrated = skipped = failed = 0
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for record_id, data in page:
+                    try:
+                        record = loads(data)
+                    except ValueError as e:
+                        print(f"Error migrating record {record_id}: {e}")
+                        failed += 1
+                        continue
+                    if 'date' not in record:
+                        continue
+                    timestamp = record.get('timestamp')
+                    created = conn.execute(
+                        'INSERT OR IGNORE INTO attendance_records (date, user_id, timestamp, data) VALUES (?, ?, ?, ?)',
+                        (record['date'], record_id,
+                         timestamp.isoformat() if isinstance(timestamp, datetime) else str(timestamp or ''), data)
+                    ).rowcount
+                    if not created:
+                        skipped += 1
+                        continue
+                    conn.execute(
+                        '''INSERT INTO attendance_days (date, count, data) VALUES (?, 1, ?)
+                           ON CONFLICT (date) DO UPDATE SET count = count + 1''',
+                        (record['date'], dumps({'date': record['date']}))
+                    )
+                    migrated += 1
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+            state.update(cursor=page[-1][0], migrated=state['migrated'] + migrated,
+                         skipped=state['skipped'] + skipped, failed=state['failed'] + failed)
+            if job is not None:
+                job.checkpoint(dict(state))
+        return state
+
+    def check_uid_index(self, repair=False, job=None):
+        conn = self._conn()
+        # Hold the write lock while comparing so the repair matches what was read
+        conn.execute('BEGIN IMMEDIATE' if repair else 'BEGIN')
+        try:
+            users = [{'id': user_id, 'nfc_uid': nfc_uid}
+                     for user_id, nfc_uid in conn.execute('SELECT id, nfc_uid FROM registration')]
+            entries = dict(conn.execute('SELECT uid, user_id FROM uid_index').fetchall())
+            expected, conflicts, invalid = uid_index_plan(users)
+            report, missing, stale, orphaned = uid_index_report(
+                expected, conflicts, invalid, entries, lambda user_id, user: user_id == user['id'])
+            if repair:
+                conn.executemany('DELETE FROM uid_index WHERE uid = ?', [(uid,) for uid in orphaned])
+                conn.executemany('INSERT OR REPLACE INTO uid_index (uid, user_id) VALUES (?, ?)',
+                                 [(uid, expected[uid]['id']) for uid in missing + stale])
+                report['repaired'] = len(missing) + len(stale) + len(orphaned)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return report
+
+    def load_job_state(self, job_id):
+        row = self._conn().execute('SELECT data FROM admin_jobs WHERE id = ?', (job_id,)).fetchone()
+        return loads(row[0]) if row is not None else None
+
+    def save_job_state(self, job_id, changes):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM admin_jobs WHERE id = ?', (job_id,)).fetchone()
+            state = {**(loads(row[0]) if row is not None else {}), **changes}
+            conn.execute(
+                'INSERT OR REPLACE INTO admin_jobs (id, created_at, data) VALUES (?, ?, ?)',
+                (job_id, state.get('created_at', 0), dumps(state))
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def list_job_states(self, limit):
+        rows = self._conn().execute(
+            'SELECT data FROM admin_jobs ORDER BY created_at DESC LIMIT ?', (limit,)
+        ).fetchall()
+        return [loads(data) for data, in rows]
+
+    def cleanup_departments(self, job=None):
+        self._rpc()
+        conn = self._conn()
+        cleaned = 0
+        for date, data in conn.execute('SELECT date, data FROM attendance_days').fetchall():
+            summary = loads(data)
+            if 'departments' in summary:
+                del summary['departments']
+                conn.execute('UPDATE attendance_days SET data = ? WHERE date = ?', (dumps(summary), date))
+                cleaned += 1
+        return {'cleaned': cleaned, 'failed': 0}
@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pytz
+
+# Stored for a day known to have no attendance document, so it is not fetched again
+_ABSENT = None
+
+
+def _runs(dates):
+    """Sorted "%Y-%m-%d" dates as (first, last) pairs of consecutive days"""
+    runs = []
+    previous = None
+    for date in dates:
+        day = datetime.strptime(date, "%Y-%m-%d")
+        if previous is not None and day - previous == timedelta(days=1):
+            runs[-1][1] = date
+        else:
+            runs.append([date, date])
+        previous = day
+    return [tuple(run) for run in runs]
+
+
+class SummaryCache:
+    """Two-tier cache of per-day attendance counts for the dashboard.
+
+    An in-process LRU sits in front of an SQLite file that every gunicorn
+    worker shares, so a day fetched by one worker is a disk hit for the others.
+    Once a day has closed (plus `close_grace` seconds for late uploads from
+    readers that were offline) its count no longer changes and the entry is
+    pinned; today, and days still within the grace period, expire after
+    `open_ttl` seconds. A range lookup fetches each run of consecutive days it
+    is missing with one call, so in steady state a long range only fetches
+    today, and a day evicted from the middle of it costs one more small fetch
+    rather than a re-read of everything in between.
+
+    Writes this process makes into a closed day must call invalidate() for it,
+    as must admin operations that rewrite history. Invalidation bumps a
+    generation number on disk, and the other workers drop their LRU when they
+    see it change.
+    """
+
+    def __init__(self, path, max_entries=4096, open_ttl=30.0, close_grace=3600.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.open_ttl = open_ttl
+        self.close_grace = close_grace
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()  # date -> (count or _ABSENT, expires_at or None)
+        self._generation = None
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'fetches': 0, 'disk_errors': 0}
+        self._init_db()
+
+    def _conn(self):
+        # sqlite3 connections are per thread (and must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS day_summaries (
+                date TEXT PRIMARY KEY,
+                count INTEGER,
+                expires_at REAL
+            )
+        ''')
+        conn.execute('CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER)')
+        conn.execute('INSERT OR IGNORE INTO generation (id, value) VALUES (0, 0)')
+
+    def _sync_generation(self):
+        """Drop the LRU if any process has invalidated entries since we last looked"""
+        try:
+            generation = self._conn().execute('SELECT value FROM generation').fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"Summary cache read failed: {e}")
+            self._stats['disk_errors'] += 1
+            return
+        with self._lock:
+            if generation != self._generation:
+                self._lru.clear()
+                self._generation = generation
+
+    def _expires_at(self, date, now):
+        """None (pinned) for a day that closed more than close_grace ago, else now + open_ttl"""
+        day_end = pytz.UTC.localize(datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1))
+        if now >= day_end.timestamp() + self.close_grace:
+            return None
+        return now + self.open_ttl
+
+    def _remember(self, date, entry):
+        with self._lock:
+            self._lru[date] = entry
+            self._lru.move_to_end(date)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def get_range(self, start_date, end_date, fetch):
+        """[{'date', 'count'}] for days in [start_date, end_date] that have attendance
+
+        `fetch(start, end)` is the uncached lookup with the same result shape;
+        it is called once per run of consecutive days not cached.
+        """
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d")
+        dates = [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end - start).days + 1)]
+        now = time.time()
+        self._sync_generation()
+
+        counts = {}
+        missing = []
+        with self._lock:
+            for date in dates:
+                entry = self._lru.get(date)
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    self._lru.move_to_end(date)
+                    counts[date] = entry[0]
+                else:
+                    missing.append(date)
+        self._stats['memory_hits'] += len(dates) - len(missing)
+
+        if missing:
+            rows = []
+            try:
+                for first, last in _runs(missing):
+                    rows += self._conn().execute(
+                        'SELECT date, count, expires_at FROM day_summaries WHERE date >= ? AND date <= ?',
+                        (first, last)
+                    ).fetchall()
+            except sqlite3.Error as e:
+                print(f"Summary cache read failed: {e}")
+                self._stats['disk_errors'] += 1
+            wanted = set(missing)
+            for date, count, expires_at in rows:
+                if date in wanted and (expires_at is None or expires_at > now):
+                    counts[date] = count
+                    self._remember(date, (count, expires_at))
+                    self._stats['disk_hits'] += 1
+            missing = [date for date in missing if date not in counts]
+
+        if missing:
+            self._stats['misses'] += len(missing)
+            fetched = {}
+            for first, last in _runs(missing):
+                self._stats['fetches'] += 1
+                fetched.update((day['date'], day['count']) for day in fetch(first, last))
+            entries = []
+            for date in missing:
+                entry = (fetched.get(date, _ABSENT), self._expires_at(date, now))
+                counts[date] = entry[0]
+                self._remember(date, entry)
+                entries.append((date,) + entry)
+            try:
+                self._conn().executemany(
+                    'INSERT OR REPLACE INTO day_summaries (date, count, expires_at) VALUES (?, ?, ?)',
+                    entries
+                )
+            except sqlite3.Error as e:
+                print(f"Summary cache write failed: {e}")
+                self._stats['disk_errors'] += 1
+
+        return [{'date': date, 'count': counts[date]} for date in dates if counts[date] is not _ABSENT]
+
+    def invalidate(self, dates=None):
+        """Forget the given dates, or everything, in this process and on disk"""
+        with self._lock:
+            if dates is None:
+                self._lru.clear()
+            else:
+                for date in dates:
+                    self._lru.pop(date, None)
+        conn = self._conn()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if dates is None:
+                conn.execute('DELETE FROM day_summaries')
+            else:
+                conn.executemany('DELETE FROM day_summaries WHERE date = ?', [(d,) for d in dates])
+            conn.execute('UPDATE generation SET value = value + 1')
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            print(f"Summary cache invalidation failed: {e}")
+            self._stats['disk_errors'] += 1
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._lru)
+        return {**self._stats, 'memory_entries': entries}
@@ -0,0 +1,110 @@
+"""Test setup: the app runs against a throwaway SQLite backend.
+
+app.py reads its configuration from the environment at import time, so
+everything it writes is pointed at a temporary directory before any test
+imports it.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+_tmp = tempfile.mkdtemp(prefix='nfc-attendance-tests-')
+os.environ.update({
+    'STORAGE_BACKEND': 'sqlite',
+    'SQLITE_PATH': os.path.join(_tmp, 'attendance.db'),
+    'SUMMARY_CACHE_PATH': os.path.join(_tmp, 'summary_cache.db'),
+    'REGISTRATION_FEED_PATH': os.path.join(_tmp, 'registration_feed.db'),
+    'IMPORT_DIR': os.path.join(_tmp, 'imports'),
+    'WARM_SNAPSHOT_ENABLED': '0',
+    'ADMIN_JOB_OPS_PER_SECOND': '0',
+})
+for name in ('DEFER_WORKER_INIT', 'ADMIN_JOB_PROCESS', 'GROUP_COMMIT', 'INGEST_MODE'):
+    os.environ.pop(name, None)
+
+APP_TABLES = ('registration', 'uid_index', 'attendance_days', 'attendance_records', 'legacy_attendance',
+              'admin_jobs')
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+@pytest.fixture
+def app_module():
+    import app
+
+    conn = app.storage._conn()
+    for table in APP_TABLES:
+        conn.execute(f'DELETE FROM {table}')
+    if app.summary_cache is not None:
+        app.summary_cache.invalidate()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def firestore_backend(monkeypatch, **env):
+    """A FirestoreBackend connected to a fresh FakeFirestore (its `db`)
+
+    Background threads are off unless `env` turns them on: status updates
+    are written as each scan commits and counts are summed from the shards.
+    """
+    from fake_firestore import FakeFirestore
+    from storage import create_storage, firestore_backend as module
+
+    settings = {'FIRESTORE_TRACE': '0', 'UID_CACHE_ENABLED': '0', 'COUNTER_ROLLUP_INTERVAL': '0',
+                'STATUS_UPDATE_INTERVAL': '0', **env}
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    db = FakeFirestore()
+    monkeypatch.setattr(module, 'firestore_client', lambda: db)
+    backend = create_storage('firestore')
+    backend.connect()
+    return backend
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'firestore'])
+def storage(request, tmp_path, monkeypatch):
+    """A fresh backend of each kind, Firestore on a fake client"""
+    from storage import create_storage
+
+    if request.param == 'firestore':
+        return firestore_backend(monkeypatch)
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'storage.db'))
+    backend = create_storage(request.param)
+    backend.connect()
+    return backend
+
+
+def add_legacy_records(storage, records):
+    """Flat pre-subcollection attendance records, {record id: data}"""
+    if storage.name == 'memory':
+        storage.legacy_records.update(records)
+        return
+    if storage.name == 'firestore':
+        for record_id, data in records.items():
+            storage.db.put(f'attendance/{record_id}', data)
+        return
+    from storage.sqlite_backend import dumps
+    storage._conn().executemany('INSERT INTO legacy_attendance (id, data) VALUES (?, ?)',
+                                [(record_id, dumps(data)) for record_id, data in records.items()])
+
+
+def wait_for_job(runner, job_id, timeout=10.0):
+    """The job's state once it is no longer queued or running"""
+    deadline = time.monotonic() + timeout
+    while True:
+        state = runner.get(job_id)
+        if state['status'] not in ('queued', 'running') or time.monotonic() > deadline:
+            return state
+        time.sleep(0.02)
@@ -0,0 +1,431 @@
+"""An in-memory stand-in for the parts of the Firestore client the backend uses.
+
+Documents live in one dict keyed by path. Commits check create, update and
+last_update_time preconditions the way Firestore does, so tests see
+AlreadyExists, NotFound and FailedPrecondition where production would, and
+apply Increment and DELETE_FIELD transforms. `reads`, `commits` and `writes`
+count what Firestore would bill, so tests can check what a code path costs.
+"""
+import copy
+import threading
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytz
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore_v1 import transforms
+
+DOCUMENT_ID = '__name__'
+_EPOCH = datetime(2026, 1, 1, tzinfo=pytz.UTC)
+
+
+class Snapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class DocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._db, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name):
+        return CollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        self._db.reads += 1
+        return self._db._snapshot(self)
+
+    def set(self, data, merge=False):
+        batch = self._db.batch()
+        batch.set(self, data, merge=merge)
+        batch.commit()
+
+    def create(self, data):
+        batch = self._db.batch()
+        batch.create(self, data)
+        batch.commit()
+
+    def update(self, data, option=None):
+        batch = self._db.batch()
+        batch.update(self, data, option=option)
+        batch.commit()
+
+    def delete(self, option=None):
+        batch = self._db.batch()
+        batch.delete(self, option=option)
+        batch.commit()
+
+
+class Query:
+    def __init__(self, db, path, filters=(), orders=(), limit=None, fields=None, cursor=None):
+        self._db = db
+        self._path = path
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._fields = fields
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = {'filters': self._filters, 'orders': self._orders, 'limit': self._limit,
+                 'fields': self._fields, 'cursor': self._cursor, **changes}
+        return Query(self._db, self._path, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self._orders + [(field, direction)])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, values):
+        return self._copy(cursor=values)
+
+    def _matches(self, doc_id, data):
+        for field, op, value in self._filters:
+            if field != DOCUMENT_ID and field not in data:
+                return False
+            current = doc_id if field == DOCUMENT_ID else data[field]
+            if op == '==' and current != value or op == 'in' and current not in value:
+                return False
+            if op in ('<', '<=', '>', '>=') and not {
+                    '<': current < value, '<=': current <= value,
+                    '>': current > value, '>=': current >= value}[op]:
+                return False
+        return True
+
+    def _results(self):
+        orders = self._orders or [(DOCUMENT_ID, 'ASCENDING')]
+        if orders[-1][0] != DOCUMENT_ID:
+            orders = orders + [(DOCUMENT_ID, orders[-1][1])]
+        found = []
+        for ref, data, update_time in self._db._children(self._path):
+            if not self._matches(ref.id, data):
+                continue
+            if any(field != DOCUMENT_ID and field not in data for field, _ in orders):
+                continue
+            found.append((ref, data, update_time))
+        for field, direction in reversed(orders):
+            found.sort(key=lambda doc: doc[0].id if field == DOCUMENT_ID else doc[1][field],
+                       reverse=direction == 'DESCENDING')
+        if self._cursor is not None:
+            def after(doc):
+                for field, direction in orders:
+                    if field not in self._cursor:
+                        continue
+                    current = doc[0].id if field == DOCUMENT_ID else doc[1][field]
+                    if current != self._cursor[field]:
+                        return (current > self._cursor[field]) == (direction == 'ASCENDING')
+                return False
+            found = [doc for doc in found if after(doc)]
+        if self._limit is not None:
+            found = found[:self._limit]
+
+        self._db.reads += max(len(found), 1)
+        snapshots = []
+        for ref, data, update_time in found:
+            if self._fields is not None:
+                data = {field: data[field] for field in self._fields if field in data}
+            snapshots.append(Snapshot(ref, copy.deepcopy(data), update_time))
+        return snapshots
+
+    def get(self, transaction=None):
+        return self._results()
+
+    def stream(self, transaction=None):
+        yield from self._results()
+
+    def count(self):
+        query = self
+
+        class Aggregation:
+            def get(self):
+                matching = len(query._copy(fields=[])._results())
+                return [[SimpleNamespace(alias='count', value=matching)]]
+        return Aggregation()
+
+
+class CollectionReference(Query):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        if '/' not in self.path:
+            return None
+        return DocumentReference(self._db, self.path.rsplit('/', 1)[0])
+
+    def document(self, document_id=None):
+        return DocumentReference(self._db, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+    def on_snapshot(self, callback):
+        return self._db._listen(self.path, callback)
+
+
+class _Writes:
+    """Writes queued by a batch or transaction, applied together by commit()"""
+
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(('set', reference, data, merge, None))
+
+    def create(self, reference, data):
+        self._ops.append(('create', reference, data, False, None))
+
+    def update(self, reference, data, option=None):
+        self._ops.append(('update', reference, data, True, option))
+
+    def delete(self, reference, option=None):
+        self._ops.append(('delete', reference, None, False, option))
+
+    def __len__(self):
+        return len(self._ops)
+
+
+class WriteBatch(_Writes):
+    def commit(self):
+        ops, self._ops = self._ops, []
+        return self._db._commit(ops)
+
+
+class Transaction(_Writes):
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self._ops = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        ops = self._ops
+        self._clean_up()
+        return self._db._commit(ops)
+
+    def get_all(self, references):
+        return self._db.get_all(references)
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return iter([ref_or_query.get()])
+        return ref_or_query.stream()
+
+
+class BulkWriter:
+    """Writes each operation on its own, passing failures to the on_write_error callback"""
+
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+        self._on_error = None
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def create(self, reference, data):
+        self._ops.append(('create', reference, data, False, None))
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(('set', reference, data, merge, None))
+
+    def flush(self):
+        ops, self._ops = self._ops, []
+        self._db.bulk_flushes += 1
+        for op in ops:
+            attempts = 0
+            while True:
+                attempts += 1
+                try:
+                    self._db._commit([op], writer=True)
+                    break
+                except (AlreadyExists, NotFound, FailedPrecondition) as e:
+                    failure = SimpleNamespace(code=e.grpc_status_code.value[0], message=str(e), attempts=attempts,
+                                              operation=SimpleNamespace(reference=op[1]))
+                    if self._on_error is None or not self._on_error(failure, self):
+                        break
+
+    def close(self):
+        self.flush()
+
+
+class FakeFirestore:
+    """A Firestore client holding its documents in memory"""
+
+    def __init__(self):
+        self.docs = {}  # path -> (data, update time)
+        self.reads = 0
+        self.commits = 0
+        self.writes = 0
+        self.bulk_flushes = 0
+        # Set to an exception to make the next commit raise it
+        self.fail_next_commit = None
+        self._lock = threading.RLock()
+        self._ticks = 0
+        self._listeners = []
+
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return Transaction(self)
+
+    def bulk_writer(self, **kwargs):
+        return BulkWriter(self)
+
+    def write_option(self, **kwargs):
+        return kwargs
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        self.reads += len(references)
+        return [self._snapshot(reference) for reference in references]
+
+    # Test helpers
+    def data(self, path):
+        """A document's fields, or None"""
+        found = self.docs.get(path)
+        return copy.deepcopy(found[0]) if found else None
+
+    def put(self, path, data):
+        """Store a document without counting a commit"""
+        with self._lock:
+            self.docs[path] = (copy.deepcopy(data), self._tick())
+
+    def reset_counts(self):
+        self.reads = self.commits = self.writes = self.bulk_flushes = 0
+
+    # Internals
+    def _tick(self):
+        self._ticks += 1
+        return _EPOCH + timedelta(microseconds=self._ticks)
+
+    def _snapshot(self, reference):
+        with self._lock:
+            found = self.docs.get(reference.path)
+        if found is None:
+            return Snapshot(reference, None)
+        return Snapshot(reference, copy.deepcopy(found[0]), found[1])
+
+    def _children(self, path):
+        prefix = path + '/'
+        with self._lock:
+            return [(DocumentReference(self, doc_path), data, update_time)
+                    for doc_path, (data, update_time) in sorted(self.docs.items())
+                    if doc_path.startswith(prefix) and '/' not in doc_path[len(prefix):]]
+
+    def _commit(self, ops, writer=False):
+        with self._lock:
+            if self.fail_next_commit is not None and not writer:
+                error, self.fail_next_commit = self.fail_next_commit, None
+                raise error
+            for kind, reference, data, merge, option in ops:
+                current = self.docs.get(reference.path)
+                if kind == 'create' and current is not None:
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+                if kind == 'update' and current is None:
+                    raise NotFound(f"No document to update: {reference.path}")
+                if option and 'last_update_time' in option and \
+                        (current is None or current[1] != option['last_update_time']):
+                    raise FailedPrecondition(f"Document changed: {reference.path}")
+
+            self.commits += 0 if writer else 1
+            self.writes += len(ops)
+            update_time = self._tick()
+            changed = {}
+            for kind, reference, data, merge, option in ops:
+                current = self.docs.get(reference.path)
+                if kind == 'delete':
+                    if current is not None:
+                        del self.docs[reference.path]
+                        changed[reference.path] = 'REMOVED'
+                    continue
+                fields = dict(current[0]) if current is not None and merge else {}
+                for field, value in data.items():
+                    if value is transforms.DELETE_FIELD:
+                        fields.pop(field, None)
+                    elif isinstance(value, transforms.Increment):
+                        fields[field] = (fields.get(field) or 0) + value.value
+                    elif value is transforms.SERVER_TIMESTAMP:
+                        fields[field] = update_time
+                    else:
+                        fields[field] = copy.deepcopy(value)
+                self.docs[reference.path] = (fields, update_time)
+                changed[reference.path] = 'MODIFIED' if current is not None else 'ADDED'
+            listeners = list(self._listeners)
+
+        for path, callback in listeners:
+            changes = [(doc_path, kind) for doc_path, kind in changed.items()
+                       if doc_path.rsplit('/', 1)[0] == path]
+            if changes:
+                self._deliver(path, callback, changes)
+        return [SimpleNamespace(update_time=update_time) for _ in ops]
+
+    def _listen(self, path, callback):
+        watch = SimpleNamespace(_closed=False)
+        entry = (path, callback)
+
+        def unsubscribe():
+            watch._closed = True
+            with self._lock:
+                if entry in self._listeners:
+                    self._listeners.remove(entry)
+        watch.unsubscribe = unsubscribe
+
+        with self._lock:
+            self._listeners.append(entry)
+            existing = [(ref.path, 'ADDED') for ref, _, _ in self._children(path)]
+        # Like the real watch, the first snapshot arrives on another thread
+        threading.Thread(target=self._deliver, args=(path, callback, existing), daemon=True).start()
+        return watch
+
+    def _deliver(self, path, callback, changes):
+        documents = [Snapshot(ref, copy.deepcopy(data), update_time)
+                     for ref, data, update_time in self._children(path)]
+        self.reads += max(len(changes), 1)
+        events = []
+        for doc_path, kind in changes:
+            snapshot = self._snapshot(DocumentReference(self, doc_path))
+            events.append(SimpleNamespace(type=SimpleNamespace(name=kind), document=snapshot))
+        callback(documents, events, datetime.now(pytz.UTC))
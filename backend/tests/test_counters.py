@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from conftest import firestore_backend
+from counters import CounterRollup, legacy_count
+
+YESTERDAY = (datetime.now(pytz.UTC) - timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0)
+DATE = YESTERDAY.strftime("%Y-%m-%d")
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    return firestore_backend(monkeypatch)
+
+
+def scan(user_id, timestamp=YESTERDAY):
+    return {'user': {'id': user_id, 'name': user_id.title()}, 'nfc_uid': '04:a2:b6:c8', 'device_id': 'gate-1',
+            'timestamp': timestamp}
+
+
+def test_legacy_count():
+    assert legacy_count({'count': 40}) == 40
+    assert legacy_count({'count': 41, 'legacy_count': 40, 'rolled_up_at': YESTERDAY}) == 40
+    assert legacy_count({'count': 3, 'rolled_up_at': YESTERDAY}) == 0
+    assert legacy_count({}) == 0
+
+
+def test_shards_add_to_a_count_from_before_sharding(backend):
+    # Written by the pre-sharding code, which kept the whole total in `count`
+    backend.db.put(f'attendance/{DATE}', {'date': DATE, 'count': 40})
+    assert backend.day_count(DATE) == 40
+
+    backend.record_attendance_batch([scan('alice')])
+    assert backend.day_count(DATE) == 41
+    assert backend.range_summaries(DATE, DATE) == [{'date': DATE, 'count': 41}]
+
+    date_ref = backend.db.collection('attendance').document(DATE)
+    assert backend.counter.roll_up(backend.db, date_ref) == 41
+    summary = backend.db.data(f'attendance/{DATE}')
+    assert (summary['count'], summary['legacy_count']) == (41, 40)
+
+    # Later scans and roll-ups neither lose nor double the old total
+    backend.record_attendance_batch([scan('bob'), scan('carol')])
+    assert backend.day_count(DATE) == 43
+    assert backend.counter.roll_up(backend.db, date_ref) == 43
+    assert backend.counter.roll_up(backend.db, date_ref) == 43
+
+
+def test_rollup_pass_finalizes_a_backfilled_day(backend):
+    backend.db.put(f'attendance/{DATE}', {'date': DATE, 'count': 7})
+    backend.record_attendance_batch([scan('alice')])
+    assert backend.db.data(f'attendance/{DATE}')['needs_rollup'] is True
+
+    backend.counter_rollup = CounterRollup(backend.db, backend.counter)
+    backend.counter_rollup.roll_up_once()
+    summary = backend.db.data(f'attendance/{DATE}')
+    assert summary['count'] == 8
+    assert 'needs_rollup' not in summary
+
+    # A final roll-up is read on its own, without the shards
+    backend.db.reset_counts()
+    assert backend.day_count(DATE) == 8
+    assert backend.db.reads == 1
+
+
+def test_migration_keeps_the_legacy_count(backend):
+    backend.db.put(f'attendance/{DATE}', {'date': DATE, 'count': 5})
+    for i in range(3):
+        backend.db.put(f'attendance/old{i}', {'date': DATE, 'user_id': f'u{i}'})
+
+    assert backend.migrate_attendance()['migrated'] == 3
+    assert backend.day_count(DATE) == 8
+    date_ref = backend.db.collection('attendance').document(DATE)
+    assert backend.counter.roll_up(backend.db, date_ref) == 8
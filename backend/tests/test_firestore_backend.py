@@ -0,0 +1,114 @@
+"""FirestoreBackend behaviour that the shared storage tests cannot see: what it
+writes where, and how it handles preconditions failing under it"""
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from google.api_core.exceptions import ServiceUnavailable
+
+from conftest import firestore_backend
+from storage import DUPLICATE_ERROR, DUPLICATE_UID_ERROR
+
+T0 = datetime(2026, 3, 2, 8, 0, tzinfo=pytz.UTC)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    return firestore_backend(monkeypatch)
+
+
+def user(user_id, nfc_uid):
+    return {'id': user_id, 'name': user_id.title(), 'department': 'Ops', 'nfc_uid': nfc_uid,
+            'timestamp': T0, 'status': 'registered'}
+
+
+def scan(user_id, nfc_uid='04:a2:b6:c8', timestamp=T0):
+    return {'user': {'id': user_id, 'name': user_id.title()}, 'nfc_uid': nfc_uid, 'device_id': 'gate-1',
+            'timestamp': timestamp}
+
+
+def shard_total(db, date):
+    return sum(data['count'] for path, (data, _) in db.docs.items()
+               if path.startswith(f'attendance/{date}/count_shards/'))
+
+
+def test_registration_writes_the_uid_index(backend):
+    backend.add_users([user('alice', '04A2B6C8')])
+    assert backend.db.data('uid_index/04:a2:b6:c8') == {
+        'user_id': 'alice', 'nfc_uid': '04A2B6C8', 'name': 'Alice', 'department': 'Ops'}
+
+    backend.add_users([user('alice', '04:b2:b6:c8')])
+    assert backend.db.data('uid_index/04:a2:b6:c8') is None
+    assert backend.db.data('uid_index/04:b2:b6:c8')['user_id'] == 'alice'
+
+
+def test_unindexed_registration_still_counts_as_a_duplicate(backend):
+    # Written by the old web form straight to Firestore, before uid_index existed
+    backend.db.put('registration/legacy', {'name': 'Legacy', 'nfc_uid': '04A2B6C8'})
+
+    assert backend.get_user_by_uid('04:a2:b6:c8')['id'] == 'legacy'
+    assert backend.get_users_by_uids(['04a2b6c8'])['04a2b6c8']['id'] == 'legacy'
+    assert backend.add_users([user('alice', '04:a2:b6:c8')]) == [(None, DUPLICATE_UID_ERROR)]
+
+
+def test_check_uid_index_repairs_drift(backend):
+    backend.add_users([user('alice', '04:a2:b6:c8')])
+    backend.db.put('registration/legacy', {'name': 'Legacy', 'nfc_uid': '04B2B6C8'})
+    backend.db.put('uid_index/11:22:33:44', {'user_id': 'gone', 'nfc_uid': '11:22:33:44'})
+    assert backend.warmup()['uid_index_missing'] == 0
+
+    report = backend.check_uid_index()
+    assert (report['missing'], report['orphaned'], report['stale']) == (1, 1, 0)
+    backend.check_uid_index(repair=True)
+    assert backend.db.data('uid_index/04:b2:b6:c8')['user_id'] == 'legacy'
+    assert backend.db.data('uid_index/11:22:33:44') is None
+    report = backend.check_uid_index()
+    assert (report['missing'], report['orphaned'], report['stale']) == (0, 0, 0)
+
+
+def test_a_scan_writes_its_record_count_and_status(backend):
+    backend.add_users([user('alice', '04:a2:b6:c8')])
+    backend.db.reset_counts()
+
+    later = T0 + timedelta(hours=1)
+    record, error = backend.record_attendance({'id': 'alice', 'name': 'Alice'}, '04:a2:b6:c8', 'gate-1', later)
+    assert error is None
+    assert backend.db.data('attendance/2026-03-02/records/alice')['device_id'] == 'gate-1'
+    assert shard_total(backend.db, '2026-03-02') == 1
+    registration = backend.db.data('registration/alice')
+    assert (registration['status'], registration['timestamp']) == ('present', later)
+
+    # Known to this process: turned away without a round trip
+    backend.db.reset_counts()
+    assert backend.record_attendance({'id': 'alice', 'name': 'Alice'}, '04:a2:b6:c8', 'gate-1', T0) == \
+        (None, DUPLICATE_ERROR)
+    assert backend.db.commits == backend.db.reads == 0
+
+
+def test_group_commit_loses_a_race_for_one_scan_only(backend):
+    # Another worker recorded bob's check-in; this process has not seen it
+    backend.db.put('attendance/2026-03-02/records/bob', {'user_id': 'bob'})
+
+    results = backend.record_attendance_group([scan('alice'), scan('bob', '04:b2:b6:c8'), scan('alice')])
+    assert results[0][1] is None
+    assert results[1:] == [(None, DUPLICATE_ERROR), (None, DUPLICATE_ERROR)]
+    assert shard_total(backend.db, '2026-03-02') == 1
+    assert backend.day_count('2026-03-02') == 1
+
+
+def test_batch_is_one_commit(backend):
+    backend.db.reset_counts()
+    results = backend.record_attendance_batch([scan(f'u{i}', timestamp=T0) for i in range(50)])
+    assert all(error is None for _, error in results)
+    assert backend.db.commits == 1
+    assert shard_total(backend.db, '2026-03-02') == 50
+
+
+def test_commit_errors_are_reported_per_scan(backend):
+    backend.db.fail_next_commit = ServiceUnavailable('try again')
+    results = backend.record_attendance_group([scan('alice'), scan('bob')])
+    assert [error.startswith('Database error') for _, error in results] == [True, True]
+    assert backend.day_count('2026-03-02') is None
+
+    # Nothing was remembered as checked in, so the retry goes through
+    assert [error for _, error in backend.record_attendance_group([scan('alice'), scan('bob')])] == [None, None]
@@ -0,0 +1,65 @@
+"""firestore_trace against the real client library, with its RPC stub replaced"""
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+from google.cloud.firestore_v1.types import aggregation_result, document, firestore as firestore_pb, write
+from google.rpc import status_pb2
+
+import firestore_trace
+
+
+class Api:
+    """Just the Firestore RPCs these tests make"""
+
+    def __init__(self, count=0):
+        self.count = count
+
+    def batch_write(self, request, **kwargs):
+        writes = request['writes']
+        return firestore_pb.BatchWriteResponse(
+            write_results=[write.WriteResult() for _ in writes],
+            status=[status_pb2.Status(code=0) for _ in writes],
+        )
+
+    def run_aggregation_query(self, request, **kwargs):
+        result = aggregation_result.AggregationResult(
+            aggregate_fields={'field_1': document.Value(integer_value=self.count)})
+        return iter([firestore_pb.RunAggregationQueryResponse(result=result)])
+
+
+@pytest.fixture
+def client():
+    firestore_trace.install()
+    db = firestore.Client(project='test', credentials=AnonymousCredentials())
+    db._firestore_api_internal = Api()
+    return db
+
+
+def test_bulk_writer_batches_are_writes_of_the_request(client):
+    trace = firestore_trace.begin('/migrate')
+    try:
+        writer = client.bulk_writer()
+        for i in range(30):
+            writer.create(client.collection('attendance').document('2026-03-02').collection('records')
+                          .document(f'u{i}'), {'user_id': f'u{i}'})
+        writer.close()
+    finally:
+        firestore_trace.end('/migrate')
+
+    # The writer sends batches of up to 20 writes, so 30 take two
+    assert {(op, collection) for op, collection, _, _ in trace.ops} == {('bulk_commit', 'attendance/*/records')}
+    assert trace.writes == 30
+    assert trace.reads == 0
+
+
+@pytest.mark.parametrize('entries, reads', [(0, 1), (999, 1), (1000, 1), (2500, 3)])
+def test_count_bills_a_read_per_thousand_entries(client, entries, reads):
+    client._firestore_api_internal.count = entries
+    trace = firestore_trace.begin('/health')
+    try:
+        assert client.collection('registration').count().get()[0][0].value == entries
+    finally:
+        firestore_trace.end('/health')
+
+    assert [(op, collection) for op, collection, _, _ in trace.ops] == [('aggregate', 'registration')]
+    assert (trace.reads, trace.writes) == (reads, 0)
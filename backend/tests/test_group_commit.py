@@ -0,0 +1,78 @@
+import threading
+import time
+
+from group_commit import GroupCommitter
+
+
+class Writes:
+    """write_batch stand-in recording each group; the first write waits for `release`"""
+
+    def __init__(self, fail=None):
+        self.groups = []
+        self.fail = fail
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def __call__(self, scans):
+        self.groups.append(list(scans))
+        if len(self.groups) == 1:
+            self.started.set()
+            assert self.release.wait(5)
+        elif self.fail is not None:
+            raise self.fail
+        return [({'scan': scan}, None) for scan in scans]
+
+
+def submit_all(committer, scans):
+    results = {}
+
+    def submit(scan):
+        results[scan] = committer.submit(scan)
+
+    threads = [threading.Thread(target=submit, args=(scan,)) for scan in scans]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def behind_a_slow_commit(writes, scans):
+    """Submit `scans` while a first, lone scan's commit is in flight"""
+    committer = GroupCommitter(writes, window=5, max_batch=len(scans))
+    first, first_result = submit_all(committer, ['first'])
+    assert writes.started.wait(5)
+    threads, results = submit_all(committer, scans)
+    # The group is written once it is full, without waiting for the first commit
+    deadline = time.time() + 5
+    while len(writes.groups) < 2 and time.time() < deadline:
+        time.sleep(0.001)
+    writes.release.set()
+    for thread in first + threads:
+        thread.join(5)
+    return committer, {**first_result, **results}
+
+
+def test_a_lone_scan_is_written_at_once():
+    writes = Writes()
+    writes.release.set()
+    committer = GroupCommitter(writes, window=5)
+    assert committer.submit('alice') == ({'scan': 'alice'}, None)
+    assert writes.groups == [['alice']]
+
+
+def test_scans_arriving_during_a_commit_share_the_next_one():
+    writes = Writes()
+    committer, results = behind_a_slow_commit(writes, ['alice', 'bob', 'carol'])
+    assert writes.groups[0] == ['first']
+    assert sorted(writes.groups[1]) == ['alice', 'bob', 'carol']
+    assert all(results[scan] == ({'scan': scan}, None) for scan in results)
+    stats = committer.stats()
+    assert (stats['groups'], stats['scans'], stats['largest'], stats['errors']) == (2, 4, 3, 0)
+
+
+def test_a_failed_write_is_every_members_error():
+    writes = Writes(fail=RuntimeError('deadline exceeded'))
+    committer, results = behind_a_slow_commit(writes, ['alice', 'bob', 'carol'])
+    assert results['first'] == ({'scan': 'first'}, None)
+    for scan in ('alice', 'bob', 'carol'):
+        assert results[scan] == (None, 'Database error: deadline exceeded')
+    assert committer.stats()['errors'] == 1
@@ -0,0 +1,154 @@
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from admin_jobs import MAX_AUTO_RESUMES, JobRunner
+from conftest import add_legacy_records, wait_for_job
+from storage import create_storage
+
+
+@pytest.fixture
+def memory_storage():
+    backend = create_storage('memory')
+    backend.connect()
+    return backend
+
+
+def count_to(job, params):
+    """Counts to params['to'], checkpointing every step"""
+    done = job.progress.get('done', 0)
+    while done < params['to']:
+        done += 1
+        job.checkpoint({'done': done})
+    return {'done': done}
+
+
+def runner_for(storage, execute=True):
+    runner = JobRunner(storage, ops_per_second=0, execute=execute)
+    runner.register('count', count_to, single=True)
+    return runner
+
+
+def test_queued_jobs_run_in_the_serving_process(memory_storage):
+    web = runner_for(memory_storage, execute=False)
+    state, created = web.submit('count', {'to': 3})
+    assert created
+    assert web.submit('count', {'to': 3}) == (state, False)
+    time.sleep(0.05)
+    assert web.get(state['id'])['status'] == 'queued'
+
+    worker = runner_for(memory_storage)
+    assert worker.poll_once() == [state['id']]
+    finished = wait_for_job(worker, state['id'])
+    assert (finished['status'], finished['result']) == ('done', {'done': 3})
+    assert worker.poll_once() == []
+
+
+def test_stale_job_is_resumed_from_its_checkpoint(memory_storage):
+    memory_storage.save_job_state('stale', {
+        'id': 'stale', 'type': 'count', 'params': {'to': 5}, 'status': 'running', 'created_at': 1,
+        'heartbeat_at': time.time() - 600, 'progress': {'done': 3}, 'cancel_requested': False,
+    })
+    runner = runner_for(memory_storage)
+    assert runner.get('stale')['status'] == 'interrupted'
+
+    assert runner.poll_once() == ['stale']
+    finished = wait_for_job(runner, 'stale')
+    assert finished['result'] == {'done': 5}
+    assert finished['auto_resumes'] == 1
+
+
+def test_job_of_a_dead_process_is_resumed_at_once(memory_storage):
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    memory_storage.save_job_state('orphan', {
+        'id': 'orphan', 'type': 'count', 'params': {'to': 2}, 'status': 'running', 'created_at': 1,
+        'heartbeat_at': time.time(), 'owner': f"{socket.gethostname()}:{dead.pid}", 'progress': {},
+    })
+    runner = runner_for(memory_storage)
+    assert runner.poll_once() == ['orphan']
+    assert wait_for_job(runner, 'orphan')['status'] == 'done'
+
+
+def test_auto_resume_gives_up(memory_storage):
+    memory_storage.save_job_state('flaky', {
+        'id': 'flaky', 'type': 'count', 'params': {'to': 2}, 'status': 'running', 'created_at': 1,
+        'heartbeat_at': 0, 'auto_resumes': MAX_AUTO_RESUMES, 'progress': {},
+    })
+    runner = runner_for(memory_storage)
+    assert runner.poll_once() == []
+    assert runner.get('flaky')['status'] == 'interrupted'
+
+
+def test_cancel_stops_at_the_next_checkpoint(memory_storage):
+    started = threading.Event()
+
+    def forever(job, params):
+        started.set()
+        while True:
+            job.checkpoint({})
+            time.sleep(0.01)
+
+    runner = runner_for(memory_storage)
+    runner.register('forever', forever)
+    state, _ = runner.submit('forever')
+    assert started.wait(5)
+    assert runner.cancel(state['id'])['cancel_requested']
+    assert wait_for_job(runner, state['id'])['status'] == 'cancelled'
+
+    state, resumed = runner.resume(state['id'])
+    assert resumed
+    started.clear()
+    assert started.wait(5)
+    runner.cancel(state['id'])
+    assert wait_for_job(runner, state['id'])['status'] == 'cancelled'
+
+
+def test_migrate_route(client, app_module):
+    add_legacy_records(app_module.storage, {
+        f'r{i}': {'date': '2026-01-05', 'user_id': f'u{i}', 'name': f'User {i}'} for i in range(30)
+    })
+
+    response = client.post('/api/attendance/migrate')
+    assert response.status_code == 202
+    job_id = response.get_json()['job']['id']
+    finished = wait_for_job(app_module.job_runner, job_id)
+    assert finished['result'] == {'migrated': 30, 'skipped': 0, 'failed': 0}
+    assert client.get('/api/attendance/migrate').get_json()['id'] == job_id
+
+    again = client.post('/api/attendance/migrate').get_json()['job']['id']
+    assert wait_for_job(app_module.job_runner, again)['result'] == {'migrated': 0, 'skipped': 30, 'failed': 0}
+    days = client.get('/dashboard/attendance?start=2026-01-05&end=2026-01-05').get_json()['days']
+    assert [day['count'] for day in days] == [30]
+
+
+def test_import_route(client, app_module):
+    csv_body = 'name,nfc_uid\nAlice,04:a2:b6:c8\nBob,04a2b6c8\nCarol,zz\n'
+    response = client.post('/admin/imports', data=csv_body, content_type='text/csv')
+    assert response.status_code == 202
+    job_id = response.get_json()['job']['id']
+    finished = wait_for_job(app_module.job_runner, job_id)
+    assert finished['status'] == 'done'
+
+    errors = client.get(f'/admin/imports/{job_id}/errors').get_data(as_text=True).splitlines()
+    assert sorted(json.loads(error)['status'] for error in errors) == ['duplicate', 'invalid']
+    assert client.post('/api/attendance', json={'uid': '04:a2:b6:c8'}).status_code == 201
+
+    assert client.post('/admin/imports', data='x', content_type='application/pdf').status_code == 400
+    assert client.get('/admin/imports/nope/errors').status_code == 404
+
+
+def test_admin_jobs_routes(client, app_module):
+    assert client.post('/admin/jobs', json={'type': 'nope'}).status_code == 400
+    response = client.post('/admin/jobs', json={'type': 'check_uid_index'})
+    assert response.status_code == 202
+    job_id = response.get_json()['job']['id']
+    assert wait_for_job(app_module.job_runner, job_id)['status'] == 'done'
+    assert client.get(f'/admin/jobs/{job_id}').get_json()['result'] is not None
+    assert job_id in [job['id'] for job in client.get('/admin/jobs').get_json()['jobs']]
+    assert client.get('/admin/jobs/nope').status_code == 404
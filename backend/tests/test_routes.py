@@ -0,0 +1,108 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+
+def register(client, name, nfc_uid, **fields):
+    return client.post('/api/registration', json={'name': name, 'nfc_uid': nfc_uid, **fields})
+
+
+def ndjson(*lines):
+    return '\n'.join(json.dumps(line) for line in lines) + '\n'
+
+
+def test_registration(client):
+    response = register(client, 'Alice', '04A2B6C8', department='Ops')
+    assert response.status_code == 201
+    assert response.get_json()['user']['nfc_uid'] == '04:a2:b6:c8'
+
+    assert register(client, 'Bob', '04-a2-b6-c8').status_code == 409
+    assert register(client, 'Carol', 'not a uid').status_code == 400
+    assert register(client, '', '04:b2:b6:c8').status_code == 400
+    assert client.post('/api/registration', json=['Alice']).status_code == 400
+
+
+def test_single_scan(client):
+    register(client, 'Alice', '04:a2:b6:c8')
+
+    response = client.post('/api/attendance', json={'uid': '04:a2:b6:c8', 'device_id': 'gate-1'})
+    assert response.status_code == 201
+    assert response.get_json()['user'] == 'Alice'
+
+    assert client.post('/api/attendance', json={'uid': '04:a2:b6:c8'}).status_code == 400
+    assert client.post('/api/attendance', json={'uid': '11:22:33:44'}).status_code == 404
+    assert client.post('/api/attendance', json={'device_id': 'gate-1'}).status_code == 400
+
+
+def test_batch(client):
+    register(client, 'Alice', '04:a2:b6:c8')
+    register(client, 'Bob', '04:b2:b6:c8')
+    now = time.time()
+
+    response = client.post('/api/attendance/batch?device_id=gate-1', data=ndjson(
+        {'uid': '04:a2:b6:c8', 'timestamp': now - 3600},
+        {'uid': '04:a2:b6:c8', 'timestamp': now - 60},
+        {'uid': '04B2B6C8', 'timestamp': datetime.fromtimestamp(now, pytz.UTC).isoformat()},
+        {'uid': '11:22:33:44'},
+        {'uid': '04:b2:b6:c8', 'timestamp': now + 3600},
+        {'uid': '04:b2:b6:c8', 'timestamp': now - 30 * 24 * 3600},
+        {'device_id': 'gate-2'},
+    ) + 'not json\n', content_type='application/x-ndjson')
+    body = response.get_json()
+
+    assert response.status_code == 200
+    assert body['lines'] == 8
+    statuses = [result['status'] for result in body['results']]
+    assert statuses == ['accepted', 'duplicate', 'accepted', 'unknown_card', 'invalid', 'invalid', 'invalid',
+                        'invalid']
+    errors = [result.get('error') for result in body['results'][4:]]
+    assert errors == ["Timestamp is in the future", "Timestamp is older than the offline backfill window",
+                      "Missing NFC UID", "Malformed JSON"]
+    assert body['summary'] == {'accepted': 2, 'duplicate': 1, 'unknown_card': 1, 'invalid': 4}
+
+
+def test_bulk_registration(client):
+    csv_body = ('name,nfc_uid,department\n'
+                'Alice,04A2B6C8,Ops\n'
+                'Bob,04:a2:b6:c8,Ops\n'
+                '\n'
+                'Carol,zz,Ops\n'
+                'Dave,04 b2 b6 c8,\n')
+    response = client.post('/api/registration/bulk', data=csv_body, content_type='text/csv')
+    body = response.get_json()
+
+    assert response.status_code == 200
+    assert [(result['line'], result['status']) for result in body['results']] == [
+        (2, 'registered'), (3, 'duplicate'), (5, 'invalid'), (6, 'registered')]
+    assert body['summary'] == {'registered': 2, 'duplicate': 1, 'invalid': 1}
+    assert client.post('/api/attendance', json={'uid': '04:b2:b6:c8'}).status_code == 201
+
+    missing_column = client.post('/api/registration/bulk', data='name\nAlice\n', content_type='text/csv')
+    assert missing_column.status_code == 400
+
+
+def test_dashboard_granularity(client, app_module):
+    days = [datetime(2026, 1, 1, 9, tzinfo=pytz.UTC) + timedelta(days=n) for n in (0, 1, 40)]
+    register(client, 'Alice', '04:a2:b6:c8')
+    user = app_module.get_user_by_uid('04:a2:b6:c8')
+    app_module.storage.record_attendance_batch([
+        {'user': user, 'nfc_uid': '04:a2:b6:c8', 'device_id': 'gate-1', 'timestamp': day} for day in days
+    ])
+
+    # Long ranges still get days unless the caller asks otherwise
+    body = client.get('/dashboard/attendance?start=2026-01-01&end=2026-03-31').get_json()
+    assert body['granularity'] == 'day'
+    assert [(day['date'], day['count']) for day in body['days']] == [
+        ('2026-01-01', 1), ('2026-01-02', 1), ('2026-02-10', 1)]
+
+    body = client.get('/dashboard/attendance?start=2026-01-01&end=2026-03-31&granularity=month').get_json()
+    assert [(period['period'], period['count']) for period in body['periods']] == [
+        ('2026-01', 2), ('2026-02', 1)]
+
+    body = client.get('/dashboard/attendance?start=2026-01-01&end=2026-03-31&granularity=auto').get_json()
+    assert body['granularity'] == 'week'
+    assert [(period['period'], period['count']) for period in body['periods']] == [('2026-W01', 2), ('2026-W07', 1)]
+
+    assert client.get('/dashboard/attendance?granularity=hour').status_code == 400
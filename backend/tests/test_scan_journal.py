@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+from scan_journal import ScanJournal
+
+
+class Firestore:
+    """flush_fn stand-in: commits every scan except those of users in `refuse`"""
+
+    def __init__(self):
+        self.committed = []
+        self.refuse = set()
+        self.down = False
+
+    def __call__(self, scans):
+        if self.down:
+            raise ConnectionError('Firestore unavailable')
+        statuses = []
+        for scan in scans:
+            if scan['user_id'] in self.refuse:
+                statuses.append('retry')
+            else:
+                self.committed.append(scan['user_id'])
+                statuses.append('committed')
+        return statuses
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'scan_journal.db')
+
+
+def journal_for(path, firestore, monkeypatch, **kwargs):
+    journal = ScanJournal(path, firestore, interval=0.01, max_backoff=0.01, **kwargs)
+    # Flushed by hand, not by a background thread
+    monkeypatch.setattr(journal, 'ensure_started', lambda: None)
+    return journal
+
+
+def test_append_is_once_per_user_and_day(path, monkeypatch):
+    journal = journal_for(path, Firestore(), monkeypatch)
+    assert journal.append('2026-03-02', 'alice', {'user_id': 'alice'})
+    assert not journal.append('2026-03-02', 'alice', {'user_id': 'alice'})
+    assert journal.append('2026-03-03', 'alice', {'user_id': 'alice'})
+    assert journal.stats()['depth'] == 2
+
+
+def test_pending_scans_are_replayed_on_the_next_start(path, monkeypatch):
+    down = Firestore()
+    down.down = True
+    crashed = journal_for(path, down, monkeypatch)
+    for user_id in ('alice', 'bob', 'carol'):
+        crashed.append('2026-03-02', user_id, {'user_id': user_id})
+    with pytest.raises(ConnectionError):
+        crashed.flush_once()
+
+    firestore = Firestore()
+    restarted = ScanJournal(path, firestore, interval=0.01)
+    restarted.ensure_started()
+    try:
+        deadline = time.time() + 5
+        while restarted.stats()['depth'] and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        restarted.stop()
+    assert sorted(firestore.committed) == ['alice', 'bob', 'carol']
+    stats = restarted.stats()
+    assert (stats['replayed'], stats['committed'], stats['depth'], stats['failed']) == (3, 3, 0, 0)
+
+
+def test_a_refused_scan_is_given_up_on(path, monkeypatch):
+    firestore = Firestore()
+    firestore.refuse.add('mallory')
+    journal = journal_for(path, firestore, monkeypatch, max_attempts=3)
+    journal.append('2026-03-02', 'mallory', {'user_id': 'mallory'})
+    journal.append('2026-03-02', 'alice', {'user_id': 'alice'})
+
+    assert journal.flush_once() == 2
+    with pytest.raises(RuntimeError):
+        journal.flush_once()
+    with pytest.raises(RuntimeError):
+        journal.flush_once()
+    # Out of attempts: no longer claimed, kept and counted
+    assert journal.flush_once() == 0
+    stats = journal.stats()
+    assert (stats['depth'], stats['failed'], stats['given_up'], stats['retries']) == (0, 1, 1, 3)
+    journal.prune('2026-03-03')
+    assert journal.stats()['failed'] == 1
+
+    firestore.refuse.clear()
+    assert journal.requeue_failed() == 1
+    assert journal.flush_once() == 1
+    assert firestore.committed == ['alice', 'mallory']
+    assert journal.stats()['failed'] == 0
+
+
+def test_failed_flushes_count_as_attempts(path, monkeypatch):
+    firestore = Firestore()
+    firestore.down = True
+    journal = journal_for(path, firestore, monkeypatch, max_attempts=2)
+    journal.append('2026-03-02', 'alice', {'user_id': 'alice'})
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            journal.flush_once()
+    assert journal.stats()['failed'] == 1
@@ -0,0 +1,82 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+import pytz
+
+from fake_firestore import FakeFirestore
+from shared_uid_index import SharedUidIndex, UidTable, write_table
+
+T0 = datetime(2026, 3, 2, 8, 0, tzinfo=pytz.UTC)
+
+USERS = [
+    {'id': 'alice', 'name': 'Alice', 'nfc_uid': '04A2B6C8', 'timestamp': T0},
+    {'id': 'bob', 'name': 'Bob', 'nfc_uid': '04:b2:b6:c8', 'timestamp': T0},
+    {'id': 'nouid', 'name': 'No UID', 'nfc_uid': ''},
+]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'uid_index.bin')
+
+
+@pytest.fixture
+def db():
+    db = FakeFirestore()
+    db.put('registration/carol', {'name': 'Carol', 'nfc_uid': '04:c2:b6:c8'})
+    db.reset_counts()
+    return db
+
+
+def test_table_round_trip(path):
+    users = USERS + [{'id': f'u{i}', 'name': f'User {i}', 'nfc_uid': f'{i:08x}'} for i in range(500)]
+    write_table(path, users, generation=7, version='3-1700000000.0')
+    table = UidTable(path)
+    assert (table.count, table.generation, table.version) == (502, 7, '3-1700000000.0')
+    assert table.get('04:a2:b6:c8') == USERS[0]
+    assert table.get('04:b2:b6:c8')['id'] == 'bob'
+    assert table.get('00:00:01:f3')['id'] == 'u499'
+    assert table.get('ff:ff:ff:ff') is None
+
+
+def test_table_rejects_other_files(path):
+    with open(path, 'wb') as f:
+        f.write(b'not an index' * 10)
+    with pytest.raises(ValueError):
+        UidTable(path)
+
+
+def test_live_table_answers_without_reads(path, db):
+    write_table(path, USERS, generation=1)
+    index = SharedUidIndex(db.collection('registration'), path)
+    assert index.wait_warm(timeout=1)
+    assert index.lookup('04a2b6c8')['id'] == 'alice'
+    assert index.lookup('04:c2:b6:c8') is None
+    assert index.lookup('junk') is None
+    assert db.reads == 0
+
+    # A registration through this worker is answered before the publisher has it
+    index.remember([{'id': 'carol', 'name': 'Carol', 'nfc_uid': '04:c2:b6:c8'}])
+    assert index.lookup('04:c2:b6:c8')['id'] == 'carol'
+
+    write_table(path, USERS[1:], generation=2)
+    assert index.lookup('04:a2:b6:c8') is None
+    stats = index.stats()
+    assert (stats['generation'], stats['generations_mapped'], stats['size']) == (2, 2, 1)
+
+
+def test_stale_table_falls_back_to_queries(path, db):
+    write_table(path, USERS, generation=1)
+    stale = time.time() - 120
+    os.utime(path, (stale, stale))
+    index = SharedUidIndex(db.collection('registration'), path, stale_after=30)
+    assert not index.wait_warm(timeout=0)
+
+    assert index.lookup('04:c2:b6:c8')['id'] == 'carol'
+    assert index.lookup('11:22:33:44') is None
+    assert index.lookup('11:22:33:44') is None
+    assert db.reads == 2
+    assert index.stats()['listening'] is False
+    assert index.version() is None
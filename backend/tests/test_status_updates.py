@@ -0,0 +1,92 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from fake_firestore import FakeFirestore
+from status_updates import StatusUpdates
+
+T0 = datetime(2026, 3, 2, 8, 0, tzinfo=pytz.UTC)
+
+
+@pytest.fixture
+def db():
+    db = FakeFirestore()
+    db.put('registration/alice', {'name': 'Alice', 'status': 'present', 'timestamp': T0})
+    db.put('registration/bob', {'name': 'Bob', 'status': 'registered', 'timestamp': T0})
+    db.reset_counts()
+    return db
+
+
+def stored(db, user_id):
+    data = db.data(f'registration/{user_id}')
+    return data['status'], data['timestamp']
+
+
+def test_updates_are_coalesced_per_user(db):
+    updates = StatusUpdates(db, interval=60)
+    for hours in (3, 1, 2):
+        updates.record('alice', T0 + timedelta(hours=hours), live=False)
+    updates.record('bob', T0 + timedelta(hours=1), live=True)
+    assert db.commits == 0
+
+    assert updates.flush() == 2
+    assert db.commits == 1
+    assert stored(db, 'alice') == ('present', T0 + timedelta(hours=3))
+    assert stored(db, 'bob') == ('present', T0 + timedelta(hours=1))
+    assert updates.stats()['recorded'] == 4
+    assert updates.stats()['pending'] == 0
+
+
+def test_live_updates_are_written_without_a_read(db):
+    updates = StatusUpdates(db, interval=0)
+    updates.record('bob', T0 + timedelta(hours=1), live=True)
+    assert (db.reads, db.commits) == (0, 1)
+    assert stored(db, 'bob') == ('present', T0 + timedelta(hours=1))
+
+    updates.record('carol', T0 + timedelta(hours=1), live=True)
+    assert db.data('registration/carol') is None
+    assert updates.stats()['missing_users'] == 1
+    assert updates.stats()['pending'] == 0
+
+
+def test_backdated_updates_skip_newer_registrations(db):
+    updates = StatusUpdates(db, interval=0)
+    updates.record('alice', T0 - timedelta(days=1))
+    assert db.reads == 1
+    assert db.commits == 0
+    assert stored(db, 'alice') == ('present', T0)
+    assert updates.stats()['not_newer'] == 1
+
+
+def test_backdated_update_losing_a_race_is_rechecked(db):
+    updates = StatusUpdates(db, interval=60)
+    updates.record('alice', T0 + timedelta(hours=1))
+
+    # Another worker writes a newer scan between the read and the commit
+    get_all = db.get_all
+
+    def racing_get_all(references, **kwargs):
+        snapshots = list(get_all(references, **kwargs))
+        db.put('registration/alice', {'name': 'Alice', 'status': 'present', 'timestamp': T0 + timedelta(hours=2)})
+        return snapshots
+
+    db.get_all = racing_get_all
+    assert updates.flush() == 0
+    assert stored(db, 'alice') == ('present', T0 + timedelta(hours=2))
+    assert updates.stats()['not_newer'] == 1
+
+
+def test_interval_flushes_in_the_background(db):
+    updates = StatusUpdates(db, interval=0.05)
+    updates.ensure_started()
+    try:
+        updates.record('bob', T0 + timedelta(hours=1), live=True)
+        assert db.commits == 0
+        deadline = time.time() + 5
+        while updates.stats()['written'] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert stored(db, 'bob') == ('present', T0 + timedelta(hours=1))
+    finally:
+        updates.stop()
@@ -0,0 +1,139 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+
+from conftest import add_legacy_records
+from storage import DUPLICATE_ERROR, DUPLICATE_UID_ERROR, INVALID_UID_ERROR
+
+T0 = datetime(2026, 3, 2, 8, 0, tzinfo=pytz.UTC)
+
+
+def user(user_id, nfc_uid, **fields):
+    return {'id': user_id, 'name': user_id.title(), 'department': 'Ops', 'nfc_uid': nfc_uid,
+            'timestamp': T0, 'status': 'present', **fields}
+
+
+def scan(user_id, timestamp):
+    return {'user': {'id': user_id, 'name': user_id.title()}, 'nfc_uid': '04:a2:b6:c8',
+            'device_id': 'gate-1', 'timestamp': timestamp}
+
+
+class FakeJob:
+    """Records checkpoints, optionally giving up after `stop_after` of them"""
+
+    def __init__(self, progress=None, stop_after=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.progress = progress or {}
+        self.stop_after = stop_after
+        self.throttled = 0
+        self.checkpoints = []
+
+    def throttle(self, ops=1):
+        self.throttled += ops
+
+    def checkpoint(self, progress):
+        self.progress = progress
+        self.checkpoints.append(dict(progress))
+        if self.stop_after is not None and len(self.checkpoints) >= self.stop_after:
+            raise KeyboardInterrupt
+
+
+def test_add_users_normalizes_and_rejects(storage):
+    results = storage.add_users([
+        user('alice', '04A2B6C8'),
+        user('bob', '04:a2:b6:c8'),
+        user('carol', 'not a uid'),
+        user('dave', '4:b2:b6:c8'),
+    ])
+    assert results[0][1] is None
+    assert results[1] == (None, DUPLICATE_UID_ERROR)
+    assert results[2] == (None, INVALID_UID_ERROR)
+    assert results[3][1] is None
+
+    assert storage.get_user_by_uid('04-A2-B6-C8')['id'] == 'alice'
+    assert storage.get_user_by_uid('04:b2:b6:c8')['id'] == 'dave'
+    assert storage.get_user_by_uid('11:22:33:44') is None
+    assert set(storage.get_users_by_uids(['04a2b6c8', '04:b2:b6:c8', 'ff:ff:ff:ff'])) == {'04a2b6c8', '04:b2:b6:c8'}
+
+
+def test_re_registering_moves_the_card(storage):
+    storage.add_users([user('alice', '04:a2:b6:c8')])
+    (moved, error), = storage.add_users([user('alice', '04:b2:b6:c8')])
+    assert error is None
+    assert storage.get_user_by_uid('04:a2:b6:c8') is None
+    assert storage.get_user_by_uid('04:b2:b6:c8')['id'] == 'alice'
+
+    # The card is free for someone else now
+    (_, error), = storage.add_users([user('bob', '04:a2:b6:c8')])
+    assert error is None
+
+
+def test_one_check_in_per_day(storage):
+    storage.add_users([user('alice', '04:a2:b6:c8')])
+    first = storage.record_attendance_batch([scan('alice', T0), scan('alice', T0 + timedelta(hours=1))])
+    assert first[0][1] is None
+    assert first[1] == (None, DUPLICATE_ERROR)
+    assert storage.record_attendance_batch([scan('alice', T0 + timedelta(hours=2))]) == [(None, DUPLICATE_ERROR)]
+    assert storage.record_attendance_batch([scan('alice', T0 + timedelta(days=1))])[0][1] is None
+
+    assert storage.day_count('2026-03-02') == 1
+    assert storage.day_count('2026-03-03') == 1
+    assert storage.day_count('2026-03-04') is None
+
+
+def test_record_attendance_group_matches_batch(storage):
+    storage.add_users([user('alice', '04:a2:b6:c8'), user('bob', '04:b2:b6:c8')])
+    results = storage.record_attendance_group([scan('alice', T0), scan('bob', T0), scan('alice', T0)])
+    assert [error for _, error in results] == [None, None, DUPLICATE_ERROR]
+    assert storage.day_count('2026-03-02') == 2
+
+
+def test_status_never_moves_backwards(storage):
+    storage.add_users([user('alice', '04:a2:b6:c8')])
+    later = T0 + timedelta(days=2)
+    storage.record_attendance_batch([scan('alice', later)])
+    # A reader's offline backlog arrives afterwards
+    backlog = dict(scan('alice', T0 + timedelta(days=1)), received_at=later + timedelta(hours=1))
+    storage.record_attendance_batch([backlog])
+    alice, = [user for user in storage.users_page() if user['id'] == 'alice']
+    assert (alice['status'], alice['timestamp']) == ('present', later)
+
+
+def test_migrate_attendance_is_idempotent(storage):
+    add_legacy_records(storage, {
+        f'r{i:04d}': {'date': f'2026-01-0{1 + i % 3}', 'user_id': f'u{i}', 'timestamp': T0} for i in range(1200)
+    })
+    add_legacy_records(storage, {'no-date': {'user_id': 'x'}})
+
+    job = FakeJob()
+    progress = storage.migrate_attendance(job)
+    assert (progress['migrated'], progress['skipped'], progress['failed']) == (1200, 0, 0)
+    assert len(job.checkpoints) >= 3  # at least one per page
+    assert job.throttled >= 1200
+
+    again = storage.migrate_attendance(FakeJob())
+    assert (again['migrated'], again['skipped']) == (0, 1200)
+    assert [day['count'] for day in storage.range_summaries('2026-01-01', '2026-01-03')] == [400, 400, 400]
+
+
+def test_migrate_attendance_resumes_from_checkpoint(storage):
+    add_legacy_records(storage, {f'r{i:04d}': {'date': '2026-01-05', 'user_id': f'u{i}'} for i in range(1100)})
+
+    interrupted = FakeJob(stop_after=1)
+    try:
+        storage.migrate_attendance(interrupted)
+    except KeyboardInterrupt:
+        pass
+    resumed = storage.migrate_attendance(FakeJob(progress=interrupted.progress, job_id=interrupted.id))
+    assert resumed['migrated'] == 1100
+    assert storage.day_count('2026-01-05') == 1100
+
+
+def test_job_states_round_trip(storage):
+    storage.save_job_state('a', {'id': 'a', 'created_at': 1, 'status': 'queued'})
+    storage.save_job_state('b', {'id': 'b', 'created_at': 2, 'status': 'done'})
+    storage.save_job_state('a', {'status': 'running'})
+    assert storage.load_job_state('a') == {'id': 'a', 'created_at': 1, 'status': 'running'}
+    assert [state['id'] for state in storage.list_job_states(10)] == ['b', 'a']
+    assert [state['id'] for state in storage.list_active_job_states()] == ['a']
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from conftest import firestore_backend
+from counters import CounterRollup
+from summary_cache import SummaryCache
+
+TODAY = datetime.now(pytz.UTC)
+
+
+def day(offset):
+    return (TODAY - timedelta(days=offset)).strftime("%Y-%m-%d")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SummaryCache(str(tmp_path / 'summary_cache.db'), open_ttl=0, close_grace=0)
+
+
+class Fetches:
+    """range_summaries stand-in with a fixed count per day, recording each call"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, start, end):
+        self.calls.append((start, end))
+        first = datetime.strptime(start, "%Y-%m-%d")
+        last = datetime.strptime(end, "%Y-%m-%d")
+        days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        return [{'date': d.strftime("%Y-%m-%d"), 'count': d.toordinal() % 97 + 1} for d in days]
+
+
+def test_only_missing_runs_are_fetched(cache):
+    fetch = Fetches()
+    first = cache.get_range(day(364), day(0), fetch)
+    assert len(first) == 365
+    assert fetch.calls == [(day(364), day(0))]
+
+    # Today stays open; everything else is pinned
+    fetch.calls.clear()
+    assert cache.get_range(day(364), day(0), fetch) == first
+    assert fetch.calls == [(day(0), day(0))]
+
+    fetch.calls.clear()
+    cache.invalidate([day(300), day(299), day(100)])
+    cache.get_range(day(364), day(0), fetch)
+    assert fetch.calls == [(day(300), day(299)), (day(100), day(100)), (day(0), day(0))]
+
+
+def test_other_processes_see_invalidations(cache):
+    fetch = Fetches()
+    other = SummaryCache(cache.path, open_ttl=0, close_grace=0)
+    cache.get_range(day(10), day(1), fetch)
+    assert other.get_range(day(10), day(1), fetch) == cache.get_range(day(10), day(1), fetch)
+    assert len(fetch.calls) == 1
+
+    other.invalidate([day(5)])
+    fetch.calls.clear()
+    cache.get_range(day(10), day(1), fetch)
+    assert fetch.calls == [(day(5), day(5))]
+
+
+def test_a_warm_year_costs_firestore_one_read(cache, monkeypatch):
+    backend = firestore_backend(monkeypatch)
+    # Roll-ups are on in production, so date docs carry their totals
+    backend.counter_rollup = CounterRollup(backend.db, backend.counter)
+    for offset in range(365):
+        backend.db.put(f'attendance/{day(offset)}', {'date': day(offset), 'count': offset + 1,
+                                                     'rolled_up_at': TODAY})
+
+    assert len(cache.get_range(day(364), day(0), backend.range_summaries)) == 365
+    backend.db.reset_counts()
+    cache.get_range(day(364), day(0), backend.range_summaries)
+    assert backend.db.reads == 1
+
+    # A day dropped from the middle is read on its own, not with the 300 days after it
+    cache.invalidate([day(300)])
+    backend.db.reset_counts()
+    days = cache.get_range(day(364), day(0), backend.range_summaries)
+    assert backend.db.reads == 2
+    assert {'date': day(300), 'count': 301} in days
@@ -0,0 +1,84 @@
+import pytest
+
+from fake_firestore import FakeFirestore
+from uid_cache import UidCache
+
+
+@pytest.fixture
+def db():
+    db = FakeFirestore()
+    db.put('registration/alice', {'name': 'Alice', 'nfc_uid': '04A2B6C8'})
+    db.put('registration/bob', {'name': 'Bob', 'nfc_uid': '04:b2:b6:c8'})
+    db.reset_counts()
+    return db
+
+
+@pytest.fixture
+def cache(db):
+    cache = UidCache(db.collection('registration'), negative_ttl=60)
+    yield cache
+    cache.stop()
+
+
+def test_warm_lookups_cost_no_reads(db, cache):
+    cache.start()
+    db.reset_counts()
+    assert cache.lookup('04:a2:b6:c8')['id'] == 'alice'
+    assert cache.lookup('04b2b6c8')['name'] == 'Bob'
+    assert cache.lookup('11:22:33:44') is None
+    assert cache.lookup('not a uid') is None
+    assert db.reads == 0
+    stats = cache.stats()
+    assert (stats['hits'], stats['negative_hits'], stats['size'], stats['listening']) == (2, 2, 2, True)
+
+
+def test_listener_follows_edits_and_removals(db, cache):
+    cache.start()
+    db.collection('registration').document('alice').update({'nfc_uid': '04:c2:b6:c8'})
+    assert cache.lookup('04:a2:b6:c8') is None
+    assert cache.lookup('04:c2:b6:c8')['id'] == 'alice'
+
+    db.collection('registration').document('bob').delete()
+    assert cache.lookup('04:b2:b6:c8') is None
+    db.collection('registration').document('carol').set({'name': 'Carol', 'nfc_uid': '04:d2:b6:c8'})
+    assert cache.lookup('04D2B6C8')['id'] == 'carol'
+
+
+def test_cold_cache_queries_and_remembers_misses(db, cache):
+    assert cache.lookup('04:b2:b6:c8')['id'] == 'bob'
+    assert cache.lookup('11:22:33:44') is None
+    assert db.reads == 2
+
+    # An unregistered card tapped again is turned away without a query
+    assert cache.lookup('11:22:33:44') is None
+    assert db.reads == 2
+    cache.invalidate('11:22:33:44')
+    assert cache.lookup('11:22:33:44') is None
+    assert db.reads == 3
+    assert cache.stats()['fallback_queries'] == 3
+
+
+def test_a_closed_listener_falls_back_to_queries(db, cache):
+    cache.start()
+    cache._watch._closed = True
+    db.reset_counts()
+    assert cache.lookup('04:b2:b6:c8')['id'] == 'bob'
+    assert db.reads == 1
+    stats = cache.stats()
+    assert (stats['listening'], stats['listener_errors']) == (False, 1)
+
+
+def test_seed_answers_until_the_first_snapshot(db, cache):
+    assert cache.import_state([{'id': 'alice', 'name': 'Alice', 'nfc_uid': '04A2B6C8'},
+                               {'id': 'gone', 'name': 'Gone', 'nfc_uid': '11:22:33:44'}])
+    assert cache.lookup('04:a2:b6:c8')['id'] == 'alice'
+    assert cache.lookup('11:22:33:44')['id'] == 'gone'
+    assert db.reads == 0
+    assert cache.stats()['seeded_hits'] == 2
+
+    # The listener's full listing replaces the seed, so the removed user goes
+    cache.start()
+    assert cache.lookup('11:22:33:44') is None
+    assert cache.lookup('04:b2:b6:c8')['id'] == 'bob'
+    assert not cache.import_state([])
+    assert {user['id'] for user in cache.export_state()} == {'alice', 'bob'}
@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+
+import firestore_trace
+from nfc_uid import normalize_uid
+
+
+class UidCache:
+    """In-memory NFC UID -> user index kept current by a Firestore listener.
+
+    The index warms from the first snapshot of the `registration` listener and
+    is updated from every change event after that. While the listener is
+    healthy a lookup never touches the network: a UID that is not in the index
+    is simply not registered. Until the first snapshot arrives (or after the
+    listener dies) lookups fall back to the `nfc_uid` query, and unregistered
+    UIDs are remembered for `negative_ttl` seconds so a stray card tapped over
+    and over does not cost a round trip every time.
+
+    A fresh worker can be seeded from a previous process's export_state() (see
+    warm_snapshot). Seeded entries answer lookups for known cards until the
+    first snapshot replaces them; a UID missing from the seed is still queried.
+
+    UIDs are keyed in normalize_uid() form, so a card matches however its UID
+    was typed in at registration. `fallback`, if given, replaces the `nfc_uid`
+    query with the backend's own lookup.
+    """
+
+    def __init__(self, collection_ref, negative_ttl=30.0, warm_timeout=10.0, on_change=None, fallback=None):
+        self.collection_ref = collection_ref
+        self.fallback = fallback
+        self.negative_ttl = negative_ttl
+        self.warm_timeout = warm_timeout
+        # Called after each listener delivery has been applied (see shared_uid_index)
+        self.on_change = on_change
+
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._pid = None
+        self._watch = None
+        self._reset()
+
+    def _reset(self):
+        self._by_uid = {}      # normalized nfc_uid -> user dict (including 'id')
+        self._uid_by_id = {}   # document id -> nfc_uid, to follow edits/removals
+        self._negative = {}    # nfc_uid -> expiry (monotonic)
+        self._seeded = False   # index loaded by import_state(), not yet confirmed by the listener
+        self._ready.clear()
+        self._last_event = None
+        self._version = None
+        self._stats = {
+            'hits': 0,
+            'seeded_hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'fallback_queries': 0,
+            'listener_events': 0,
+            'listener_errors': 0,
+            'remembered': 0,
+        }
+
+    # Listener lifecycle
+    def start(self, wait=True):
+        """Attach the registration listener and optionally wait for warmup"""
+        with self._lock:
+            if self._pid == os.getpid() and self._watch is not None:
+                return
+            if self._pid is not None and self._pid != os.getpid():
+                # Forked child: the parent's listener thread did not come along
+                self._reset()
+            self._pid = os.getpid()
+            try:
+                self._watch = self.collection_ref.on_snapshot(self._on_snapshot)
+            except Exception as e:
+                self._stats['listener_errors'] += 1
+                self._watch = None
+                print(f"UID cache listener failed to start: {e}")
+                return
+
+        if wait:
+            self.wait_warm()
+
+    def wait_warm(self, timeout=None):
+        """Block until the first snapshot has loaded (up to warm_timeout). Returns whether it has"""
+        if self._ready.wait(self.warm_timeout if timeout is None else timeout):
+            return True
+        print("UID cache not warm yet, falling back to queries until it is")
+        return False
+
+    def stop(self):
+        """Detach the listener and drop the index"""
+        with self._lock:
+            if self._watch is not None:
+                try:
+                    self._watch.unsubscribe()
+                except Exception as e:
+                    print(f"Error stopping UID cache listener: {e}")
+            self._watch = None
+            self._pid = None
+            self._reset()
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        # Listener deliveries are billed as reads too
+        firestore_trace.record('listen', self.collection_ref.id, len(changes), 0.0)
+        # Document count and newest update time identify this state of the collection
+        # the same way in every process, whichever snapshot delivered it
+        newest = max((doc.update_time for doc in col_snapshot if doc.update_time), default=None)
+        version = f"{len(col_snapshot)}-{newest.timestamp() if newest else 0}"
+        with self._lock:
+            if self._seeded:
+                # The first snapshot lists every document; drop the seed so removals show
+                self._by_uid = {}
+                self._uid_by_id = {}
+                self._seeded = False
+            self._version = version
+            for change in changes:
+                doc = change.document
+                old_uid = self._uid_by_id.pop(doc.id, None)
+                if old_uid is not None:
+                    self._by_uid.pop(old_uid, None)
+
+                if change.type.name == 'REMOVED':
+                    continue
+
+                data = doc.to_dict() or {}
+                nfc_uid = normalize_uid(data.get('nfc_uid'))
+                if nfc_uid is None:
+                    continue
+                self._by_uid[nfc_uid] = {**data, 'id': doc.id}
+                self._uid_by_id[doc.id] = nfc_uid
+                self._negative.pop(nfc_uid, None)
+
+            self._stats['listener_events'] += 1
+            self._last_event = time.time()
+        self._ready.set()
+        if self.on_change is not None:
+            self.on_change()
+
+    def _listening(self):
+        if self._pid != os.getpid():
+            # Inherited across fork without a live listener
+            return False
+        if self._watch is None or not self._ready.is_set():
+            return False
+        # Watch stops itself on unrecoverable errors; treat that as stale
+        closed = getattr(self._watch, '_closed', False)
+        if closed:
+            self._stats['listener_errors'] += 1
+            self._watch = None
+            self._ready.clear()
+            return False
+        return True
+
+    # Lookups
+    def lookup(self, nfc_uid):
+        """Return the user registered for `nfc_uid`, or None"""
+        if self._pid is not None and self._pid != os.getpid():
+            # First lookup in a forked worker: attach this process's own listener
+            self.start(wait=False)
+
+        key = normalize_uid(nfc_uid)
+        with self._lock:
+            if key is None:
+                # Not a UID at all, so nothing can be registered under it
+                self._stats['negative_hits'] += 1
+                return None
+
+            if self._listening():
+                user = self._by_uid.get(key)
+                if user is not None:
+                    self._stats['hits'] += 1
+                    return dict(user)
+                self._stats['negative_hits'] += 1
+                return None
+
+            if self._seeded and key in self._by_uid:
+                self._stats['seeded_hits'] += 1
+                return dict(self._by_uid[key])
+
+            expiry = self._negative.get(key)
+            if expiry is not None:
+                if expiry > time.monotonic():
+                    self._stats['negative_hits'] += 1
+                    return None
+                del self._negative[key]
+
+            self._stats['misses'] += 1
+            self._stats['fallback_queries'] += 1
+
+        user = self._query(nfc_uid)
+        if user is None:
+            with self._lock:
+                self._negative[key] = time.monotonic() + self.negative_ttl
+        return user
+
+    def _query(self, nfc_uid):
+        if self.fallback is not None:
+            return self.fallback(nfc_uid)
+        query = self.collection_ref.where('nfc_uid', '==', nfc_uid).limit(1)
+        for user in query.get():
+            return {**user.to_dict(), 'id': user.id}
+        return None
+
+    def invalidate(self, nfc_uid=None):
+        """Forget negative entries so the next lookup re-checks Firestore"""
+        with self._lock:
+            if nfc_uid is None:
+                self._negative.clear()
+            else:
+                self._negative.pop(normalize_uid(nfc_uid), None)
+
+    def remember(self, users):
+        """Index users registered through the API before the listener delivers them"""
+        with self._lock:
+            for user in users:
+                uid = normalize_uid(user.get('nfc_uid'))
+                if uid is None:
+                    continue
+                old_uid = self._uid_by_id.pop(user['id'], None)
+                if old_uid is not None:
+                    self._by_uid.pop(old_uid, None)
+                self._by_uid[uid] = dict(user)
+                self._uid_by_id[user['id']] = uid
+                # Until the listener is warm the next lookup queries, and finds them
+                self._negative.pop(uid, None)
+                self._stats['remembered'] += 1
+
+    # Warm restarts
+    def export_state(self):
+        """Registered users as a list for a snapshot, or None unless the listener is live"""
+        with self._lock:
+            if not self._listening():
+                return None
+            return list(self._by_uid.values())
+
+    def import_state(self, users):
+        """Seed the index from export_state() output unless the listener already delivered"""
+        with self._lock:
+            if self._ready.is_set():
+                return False
+            self._by_uid = {normalize_uid(user.get('nfc_uid')): user for user in users}
+            self._by_uid.pop(None, None)
+            self._uid_by_id = {user['id']: nfc_uid for nfc_uid, user in self._by_uid.items()}
+            self._seeded = True
+            return True
+
+    def version(self):
+        """Identifier of the current registration contents, or None without a live listener"""
+        with self._lock:
+            return self._version if self._listening() else None
+
+    def stats(self):
+        """Hit/miss counters plus how stale the listener view is"""
+        with self._lock:
+            listening = self._listening()
+            age = None
+            if self._last_event is not None:
+                age = round(time.time() - self._last_event, 3)
+            return {
+                **self._stats,
+                'listening': listening,
+                'ready': self._ready.is_set(),
+                'seeded': self._seeded,
+                'size': len(self._by_uid),
+                'negative_size': len(self._negative),
+                'seconds_since_last_change': age,
+            }
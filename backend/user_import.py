@@ -0,0 +1,315 @@
+"""Bulk registration import: tens of thousands of badges from a CSV or NDJSON file.
+
+An import runs as an admin job (see admin_jobs). The file is first staged on
+local disk, either uploaded to POST /admin/imports or named on the command
+line:
+
+    python user_import.py staff.csv [--ops-per-second 500] [--resume JOB_ID]
+
+The job reads it a row at a time and validates and de-duplicates UIDs in
+memory. It then writes waves of `parallel` chunks of IMPORT_CHUNK_SIZE users
+at once, each chunk one add_users call that fills 500-write commits. Writes
+are throttled through the job to its ops_per_second budget, so a 50k-user
+import at the default 500 writes per second takes under four minutes.
+
+Rows that fail are appended to `<file>.errors.ndjson` as {"line", "status",
+"error"}. The job checkpoints the last line of each finished wave and resumes
+after it. Users without an id get one derived from the import and their UID,
+so rewriting a wave that was interrupted part way is harmless.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import string
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytz
+
+from nfc_uid import normalize_uid
+from storage import DUPLICATE_UID_ERROR, INVALID_UID_ERROR
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+# Users per add_users call: two writes each, so one full commit
+IMPORT_CHUNK_SIZE = 250
+
+# Chunks committed at the same time
+DEFAULT_PARALLEL_COMMITS = 4
+
+# Failed rows kept in the job result; the errors file has all of them
+ERROR_EXAMPLES = 20
+
+# Fields a registration takes from a CSV column or NDJSON key
+REGISTRATION_FIELDS = ('id', 'name', 'email', 'department', 'nfc_uid')
+
+_ID_ALPHABET = string.ascii_letters + string.digits
+
+
+def new_user_id():
+    # Same shape as the IDs Firestore's add() picks for documents the web form creates
+    return ''.join(secrets.choice(_ID_ALPHABET) for _ in range(20))
+
+
+def import_user_id(import_id, nfc_uid):
+    """A Firestore-style ID that is the same every time `import_id` imports `nfc_uid`"""
+    value = int.from_bytes(hashlib.sha256(f"{import_id}:{nfc_uid}".encode()).digest(), 'big')
+    chars = []
+    for _ in range(20):
+        value, digit = divmod(value, len(_ID_ALPHABET))
+        chars.append(_ID_ALPHABET[digit])
+    return ''.join(chars)
+
+
+def registration_user(data, registered_at, user_id=None):
+    """The registration document for submitted fields, or an error message"""
+    name = str(data.get('name') or '').strip()
+    raw_uid = str(data.get('nfc_uid') or '').strip()
+    if not name:
+        return None, "Missing name"
+    if not raw_uid:
+        return None, "Missing NFC UID"
+    nfc_uid = normalize_uid(raw_uid)
+    if nfc_uid is None:
+        return None, INVALID_UID_ERROR
+
+    return {
+        'id': str(data.get('id') or '').strip() or user_id or new_user_id(),
+        'name': name,
+        'email': str(data.get('email') or '').strip(),
+        'department': str(data.get('department') or '').strip(),
+        'nfc_uid': nfc_uid,
+        'timestamp': registered_at,
+        'status': 'present'
+    }, None
+
+
+def registration_status(error):
+    """How a registration error is reported for a row"""
+    if error == DUPLICATE_UID_ERROR:
+        return 'duplicate'
+    if error == INVALID_UID_ERROR:
+        return 'invalid'
+    return 'error'
+
+
+def detect_format(filename=None, content_type=None):
+    """'csv' or 'ndjson' from a file extension or Content-Type, or None"""
+    if content_type:
+        if 'csv' in content_type:
+            return 'csv'
+        if 'ndjson' in content_type or 'jsonl' in content_type or 'json-seq' in content_type:
+            return 'ndjson'
+    if filename:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.csv':
+            return 'csv'
+        if extension in ('.ndjson', '.jsonl'):
+            return 'ndjson'
+    return None
+
+
+def stage(stream, directory, fmt):
+    """Copy an uploaded body to a new file under `directory` without holding it in memory"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.abspath(os.path.join(directory, f"{uuid.uuid4().hex}.{fmt}"))
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(stream, f, 1 << 16)
+    return path
+
+
+def read_rows(path, fmt):
+    """(line number, fields, error) for every non-blank row of a staged file"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            columns = {(name or '').strip() for name in reader.fieldnames or []}
+            if not {'name', 'nfc_uid'} <= columns:
+                raise ValueError("CSV header must include name and nfc_uid")
+            for row in reader:
+                fields = {key.strip(): value for key, value in row.items()
+                          if key and key.strip() in REGISTRATION_FIELDS}
+                if any((value or '').strip() for value in fields.values()):
+                    yield reader.line_num, fields, None
+            return
+
+        for line_no, raw in enumerate(f, 1):
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                yield line_no, None, "Malformed JSON"
+                continue
+            if not isinstance(data, dict):
+                yield line_no, None, "Expected a JSON object"
+                continue
+            yield line_no, {key: data[key] for key in REGISTRATION_FIELDS if key in data}, None
+
+
+def errors_path(path):
+    return f"{path}.errors.ndjson"
+
+
+def _keep_errors_through(path, line):
+    """Drop error rows a resumed import is about to write again"""
+    if not os.path.exists(path):
+        return
+    tmp_path = f"{path}.tmp"
+    with open(path) as src, open(tmp_path, 'w') as dst:
+        for raw in src:
+            if raw.strip() and json.loads(raw)['line'] <= line:
+                dst.write(raw)
+    os.replace(tmp_path, path)
+
+
+def run_import(job, params, register, parallel=DEFAULT_PARALLEL_COMMITS, chunk_size=IMPORT_CHUNK_SIZE):
+    """Job function body: import params['path'] (params['format']) through `register`
+
+    `register(users)` writes a list of users and returns a (user, error) per
+    user, like StorageBackend.add_users.
+    """
+    path, fmt = params['path'], params['format']
+    registered_at = datetime.fromisoformat(params['registered_at'])
+    progress = {'line': 0, 'rows': 0, 'registered': 0, 'duplicate': 0, 'invalid': 0, 'error': 0,
+                'examples': [], **job.progress}
+    resume_after = progress['line']
+    report_path = errors_path(path)
+    _keep_errors_through(report_path, resume_after)
+
+    seen_uids = {}  # normalized uid -> line it first appeared on
+    seen_ids = {}   # explicit user id -> line
+    wave = []       # (line, user) waiting to be written
+    failed = []     # rows of this wave that will not be written
+
+    def fail(line_no, status, error):
+        failed.append({'line': line_no, 'status': status, 'error': error})
+
+    def flush(last_line):
+        chunks = [wave[i:i + chunk_size] for i in range(0, len(wave), chunk_size)]
+        futures = []
+        for chunk in chunks:
+            job.throttle(2 * len(chunk))
+            futures.append(pool.submit(register, [user for _, user in chunk]))
+        for chunk, future in zip(chunks, futures):
+            for (line_no, _), (user, error) in zip(chunk, future.result()):
+                if user:
+                    progress['registered'] += 1
+                else:
+                    fail(line_no, registration_status(error), error)
+
+        failed.sort(key=lambda row: row['line'])
+        with open(report_path, 'a') as f:
+            for row in failed:
+                f.write(json.dumps(row) + '\n')
+                progress[row['status']] += 1
+        progress['examples'] = (progress['examples'] + failed)[:ERROR_EXAMPLES]
+        progress['line'] = last_line
+        wave.clear()
+        failed.clear()
+        job.checkpoint(dict(progress))
+
+    line_no = resume_after
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='user-import') as pool:
+        for line_no, fields, error in read_rows(path, fmt):
+            user, status = None, 'invalid'
+            if error is None:
+                user, error = registration_user(fields, registered_at,
+                                                import_user_id(job.id, normalize_uid(fields.get('nfc_uid'))))
+            if user is not None:
+                first = seen_uids.setdefault(user['nfc_uid'], line_no)
+                if first == line_no and fields.get('id'):
+                    first = seen_ids.setdefault(user['id'], line_no)
+                if first != line_no:
+                    user, status, error = None, 'duplicate', f"Same NFC UID or id as line {first}"
+            if line_no <= resume_after:
+                # Written (or reported) before the interruption; only its UID is remembered
+                continue
+
+            progress['rows'] += 1
+            if user is None:
+                fail(line_no, status, error)
+            else:
+                wave.append((line_no, user))
+            if len(wave) >= parallel * chunk_size:
+                flush(line_no)
+
+        if wave or failed or line_no > progress['line']:
+            flush(line_no)
+
+    return {k: progress[k] for k in ('rows', 'registered', 'duplicate', 'invalid', 'error', 'examples')}
+
+
+def register_job(runner, register, parallel=DEFAULT_PARALLEL_COMMITS):
+    """Add the 'import_users' job type to a JobRunner, writing through `register`"""
+    runner.register('import_users', lambda job, params: run_import(job, params, register, parallel), single=True)
+
+
+def import_params(path, fmt):
+    return {'path': os.path.abspath(path), 'format': fmt, 'registered_at': datetime.now(pytz.UTC).isoformat()}
+
+
+def main(argv=None):
+    from admin_jobs import DEFAULT_OPS_PER_SECOND, JobRunner
+    from storage import create_storage
+
+    parser = argparse.ArgumentParser(description="Import registrations from a CSV or NDJSON file")
+    parser.add_argument('path', nargs='?', help="CSV (header with name and nfc_uid) or NDJSON file")
+    parser.add_argument('--format', choices=IMPORT_FORMATS, help="Default: from the file extension")
+    parser.add_argument('--ops-per-second', type=float, default=DEFAULT_OPS_PER_SECOND)
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLEL_COMMITS)
+    parser.add_argument('--resume', metavar='JOB_ID', help="Continue an interrupted import instead")
+    args = parser.parse_args(argv)
+
+    storage = create_storage()
+    storage.connect()
+    if not storage.connected:
+        sys.exit("Database not connected")
+
+    def register(users):
+        results = storage.add_users(users)
+        storage.remember_users([user for user, error in results if user])
+        return results
+
+    runner = JobRunner(storage, ops_per_second=args.ops_per_second)
+    register_job(runner, register, args.parallel)
+    if args.resume:
+        state, started = runner.resume(args.resume)
+        if state is None:
+            sys.exit(f"No job {args.resume}")
+    else:
+        if not args.path:
+            parser.error("a file to import is required unless resuming")
+        fmt = args.format or detect_format(args.path)
+        if fmt is None:
+            parser.error("cannot tell the format from the file name; pass --format")
+        state, started = runner.submit('import_users', import_params(args.path, fmt))
+    if not started:
+        sys.exit(f"Import {state['id']} is {state['status']}")
+
+    print(f"Import {state['id']} started")
+    while True:
+        time.sleep(2)
+        state = runner.get(state['id'])
+        progress = state.get('progress') or {}
+        print(f"  line {progress.get('line', 0)}: {progress.get('registered', 0)} registered, "
+              f"{progress.get('duplicate', 0)} duplicate, {progress.get('invalid', 0)} invalid, "
+              f"{progress.get('error', 0)} failed")
+        if state['status'] not in ('queued', 'running'):
+            break
+
+    print(f"Import {state['status']}" + (f": {state['error']}" if state.get('error') else ""))
+    print(f"Failed rows: {errors_path(state['params']['path'])}")
+    sys.exit(0 if state['status'] == 'done' else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import msgpack
+import pytz
+
+# Bumped whenever the layout of the state changes; other files are ignored
+SNAPSHOT_FORMAT = 1
+
+
+def msgpack_default(value):
+    # Firestore hands back datetime subclasses, which msgpack does not pack by itself
+    if isinstance(value, datetime):
+        return msgpack.Timestamp.from_datetime(value)
+    return str(value)
+
+
+class WarmSnapshot:
+    """Periodic msgpack snapshot of a storage backend's process-local caches.
+
+    Every worker starts empty, after each deploy and every time gunicorn
+    recycles it at max_requests. A fresh worker load()s the newest snapshot in
+    a few milliseconds, and the backend's warmup() then reconciles what it
+    seeded with the database in the background. Workers save every `interval`
+    seconds and on exit, each through its own temporary file renamed into
+    place, so a reader never sees a partial file. Snapshots older than
+    `max_age` seconds, or taken by another backend, are ignored.
+
+    Dashboard summaries are not included: the summary cache already keeps
+    them in an SQLite file that outlives the workers.
+    """
+
+    def __init__(self, storage, path, interval=60.0, max_age=86400.0):
+        self.storage = storage
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats = {
+            'loaded': False,
+            'loaded_age_seconds': None,
+            'load_ms': None,
+            'saves': 0,
+            'save_errors': 0,
+            'last_save_bytes': None,
+            'last_saved_at': None,
+        }
+
+    def load(self):
+        """Seed the backend's caches from the snapshot file. Returns whether one was used"""
+        started = time.perf_counter()
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = msgpack.unpackb(f.read(), timestamp=3, strict_map_key=False)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Warm snapshot unreadable, starting cold: {e}")
+            return False
+
+        if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT \
+                or snapshot.get('storage') != self.storage.name:
+            return False
+        age = time.time() - snapshot.get('saved_at', 0)
+        if age > self.max_age:
+            print(f"Warm snapshot is {age:.0f}s old, starting cold")
+            return False
+
+        self.storage.import_warm_state(snapshot['state'], datetime.fromtimestamp(snapshot['saved_at'], pytz.UTC))
+        self._stats['loaded'] = True
+        self._stats['loaded_age_seconds'] = round(age, 1)
+        self._stats['load_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return True
+
+    def save(self):
+        """Write this process's caches to the snapshot file. Returns whether it did"""
+        state = self.storage.export_warm_state()
+        if state is None:
+            return False
+
+        saved_at = time.time()
+        data = msgpack.packb({
+            'format': SNAPSHOT_FORMAT,
+            'storage': self.storage.name,
+            'saved_at': saved_at,
+            'pid': os.getpid(),
+            'state': state,
+        }, datetime=True, default=msgpack_default)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Warm snapshot save failed: {e}")
+            self._stats['save_errors'] += 1
+            return False
+
+        self._stats['saves'] += 1
+        self._stats['last_save_bytes'] = len(data)
+        self._stats['last_saved_at'] = saved_at
+        return True
+
+    # Saver thread
+    def ensure_started(self):
+        """Start this process's saver thread if it is not running yet"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='warm-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                print(f"Warm snapshot save failed: {e}")
+                self._stats['save_errors'] += 1
+
+    def stats(self):
+        return {'path': self.path, **self._stats}
@@ -294,7 +294,7 @@ void sendAttendanceData(String uid) {
             DeserializationError error = deserializeJson(respDoc, response);
             
             // Different handling based on response code
-            if (httpResponseCode == 201) {  // Created status - successful attendance
+            if (httpResponseCode == 201 || httpResponseCode == 202) {  // Created/Accepted (queued) - successful attendance
                 String userName = "User";
                 if (!error && respDoc.containsKey("user")) {
                     userName = respDoc["user"].as<String>();